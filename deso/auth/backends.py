@@ -1,7 +1,3 @@
-from ldap3 import Server, Connection, AUTH_SIMPLE, STRATEGY_SYNC, ALL_ATTRIBUTES, SUBTREE
-from ldap3.core.exceptions import LDAPInvalidCredentialsResult
-
-
 import logging
 
 from django.utils import timezone
@@ -17,14 +13,27 @@ class LDAPBackend(ModelBackend):
     """
     requires ldap3
     https://pypi.python.org/pypi/ldap3
+    (ldap3 is imported on first authentication, processes that do not authenticate do not load it)
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.ldap_server = Server(LDAP_INFORMATION['HOST'], port=LDAP_INFORMATION['PORT'])
+        self._ldap_server = None
 
+    @property
+    def ldap_server(self):
+        if self._ldap_server is None:
+            from ldap3 import Server
+            self._ldap_server = Server(LDAP_INFORMATION['HOST'], port=LDAP_INFORMATION['PORT'])
+        return self._ldap_server
 
     def authenticate(self, username=None, password=None):
         """Authenticate using LDAP"""
+        if not LDAP_INFORMATION['HOST']:
+            # LDAP not configured
+            return None
+        from ldap3 import Connection, AUTH_SIMPLE, STRATEGY_SYNC, ALL_ATTRIBUTES, SUBTREE
+        from ldap3.core.exceptions import LDAPInvalidCredentialsResult
+
         # get user DN
         c = Connection(self.ldap_server,
                        authentication=AUTH_SIMPLE,
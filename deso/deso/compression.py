@@ -0,0 +1,125 @@
+"""
+Helpers for serving pre-compressed (gzip/brotli) response payloads.
+
+Payloads are compressed *once* (at load time, or when first cached) and the stored bytes
+are returned directly with the appropriate 'Content-Encoding' header when the client accepts it.
+"""
+import gzip
+import json
+from io import BytesIO
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli  # optional, https://pypi.python.org/pypi/Brotli
+except ImportError:
+    brotli = None
+
+
+GZIP_COMPRESS_LEVEL = 9  # used for payloads compressed once at load time
+GZIP_FAST_COMPRESS_LEVEL = 5  # used for dynamic payloads compressed per request
+BROTLI_QUALITY = 11
+MINIMUM_COMPRESS_LENGTH = 200  # bytes, smaller payloads are not worth compressing
+
+# preferred order when the client accepts more than one encoding
+CONTENT_ENCODING_PREFERENCE = ("br", "gzip")
+
+
+def gzip_compress(data, compresslevel=GZIP_COMPRESS_LEVEL):
+    """
+    :param data: bytes or str (str is encoded as utf8)
+    :return: gzip compressed bytes
+    """
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    # mtime is fixed so that the same payload always results in the same bytes
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=compresslevel, mtime=0) as out_f:
+        out_f.write(data)
+    return buffer.getvalue()
+
+
+def brotli_compress(data, quality=BROTLI_QUALITY):
+    """
+    :param data: bytes or str (str is encoded as utf8)
+    :return: brotli compressed bytes, or None if the 'brotli' package is not installed.
+    """
+    if brotli is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    return brotli.compress(data, quality=quality)
+
+
+def accepted_encodings(request):
+    """
+    Parse the request 'Accept-Encoding' header
+    :return: set of accepted encodings (q=0 entries are excluded)
+    """
+    header = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    encodings = set()
+    for part in header.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        coding, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def select_content_encoding(request, available=CONTENT_ENCODING_PREFERENCE):
+    """
+    :param request: django request object
+    :param available: encodings that can be served, in order of preference
+    :return: best encoding accepted by the client ('br', 'gzip') or None for identity
+    """
+    accepted = accepted_encodings(request)
+    for encoding in available:
+        if encoding == "br" and brotli is None:
+            continue
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def precompressed_response(content, content_encoding=None, content_type="application/json"):
+    """
+    Create a response for content that is *already* encoded with the given content_encoding.
+    :param content: bytes (already compressed if content_encoding is given)
+    :param content_encoding: 'br', 'gzip' or None (identity)
+    :return: HttpResponse
+    """
+    if isinstance(content, memoryview):
+        # BinaryField values are returned as memoryview objects
+        content = content.tobytes()
+    response = HttpResponse(content, content_type=content_type)
+    if content_encoding:
+        response["Content-Encoding"] = content_encoding
+    response["Content-Length"] = str(len(response.content))
+    patch_vary_headers(response, ("Accept-Encoding", ))
+    return response
+
+
+def json_response(request, obj, content_type="application/json; charset=utf-8"):
+    """
+    Serialize obj to json, and compress the result if the client accepts it.
+    Intended for dynamic listing views, where the response is cached (with the resulting encoding)
+    by 'cache_page' so that compression is not repeated per request.
+    """
+    content = json.dumps(obj).encode("utf8")
+    encoding = None
+    if len(content) >= MINIMUM_COMPRESS_LENGTH:
+        encoding = select_content_encoding(request)
+    if encoding == "br":
+        content = brotli_compress(content, quality=5)
+    elif encoding == "gzip":
+        content = gzip_compress(content, compresslevel=GZIP_FAST_COMPRESS_LEVEL)
+    return precompressed_response(content, encoding, content_type=content_type)
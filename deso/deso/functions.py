@@ -43,7 +43,48 @@ class WelfordRunningVariance(object):
             self._last_mean = self._mean
             self._last_s = self._s
 
-            
+    def merge_aggregate(self, count, mean, variance, minimum=None, maximum=None, total=None):
+        """
+        Merge the aggregate of another set of values (Chan et al. parallel variance algorithm)
+        https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+        :param count: number of values in the set
+        :param mean: mean of the set
+        :param variance: sample variance of the set (as var())
+        :param minimum, maximum, total: min/max/sum of the set [DEFAULT=mean]
+        """
+        if not count:
+            return
+        s = variance * (count - 1) if variance and count > 1 else 0.0
+        minimum = mean if minimum is None else minimum
+        maximum = mean if maximum is None else maximum
+        total = mean * count if total is None else total
+        if self._count == 0:
+            self._mean = mean
+            self._s = s
+            self._min = minimum
+            self._max = maximum
+            self._sum = total
+            self._count = count
+        else:
+            merged_count = self._count + count
+            delta = mean - self._mean
+            self._mean += delta * count / merged_count
+            self._s = (self._s or 0.0) + s + delta * delta * self._count * count / merged_count
+            self._sum += total
+            if maximum > self._max:
+                self._max = maximum
+            if minimum < self._min:
+                self._min = minimum
+            self._count = merged_count
+        self._last_mean = self._mean
+        self._last_s = self._s
+
+    def merge(self, other):
+        """
+        Merge the values sent to another WelfordRunningVariance object
+        """
+        self.merge_aggregate(other.count(), other.mean(), other.var(), other.min(), other.max(), other.sum())
+
     def next(self):
         """
         Mimmicing generator function
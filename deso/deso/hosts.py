@@ -0,0 +1,77 @@
+"""
+Resolution of the host used in the urls served by deso.
+
+Layer urls are stored as paths (for example, '/raster/legend/1/') and expanded to absolute urls per request (expand_url()),
+so that a host change requires no database update and several deso servers may serve the same layers.
+
+settings.HOST (or the DESO_HOST environment variable) is used when set, otherwise the address is detected
+on first use and cached for the life of the process, so that importing settings requires no network access.
+"""
+import socket
+import logging
+import threading
+
+from django.conf import settings
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# address 'connected' to (no packets are sent) to determine the address of the outbound interface
+HOST_DETECTION_ADDRESS = ("8.8.8.8", 80)
+
+_host = None
+_host_lock = threading.Lock()
+
+
+def detect_host_address():
+    """
+    :return: address of the interface used for outbound traffic, or the hostname if no route is available
+    """
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        udp_socket.connect(HOST_DETECTION_ADDRESS)
+        return udp_socket.getsockname()[0]
+    except OSError as e:
+        logger.warning("Unable to detect host address, using hostname (set settings.HOST or DESO_HOST): {}".format(e))
+        return socket.gethostname()
+    finally:
+        udp_socket.close()
+
+
+def get_host():
+    """
+    :return: settings.HOST if set, otherwise the detected host address (resolved once per process)
+    """
+    global _host
+    if _host is None:
+        with _host_lock:
+            if _host is None:
+                _host = settings.HOST or detect_host_address()
+    return _host
+
+
+
+def expand_url(url, request=None):
+    """
+    Expand a stored (relative) url to an absolute url for the given request.
+    :param url: relative path (for example, '/raster/legend/1/') or absolute url (returned unchanged)
+    :param request: if given, the url is expanded with the requested scheme/host, otherwise with get_host() & settings.PORT
+    :return: absolute url
+    """
+    if not url or not url.startswith("/"):
+        return url
+    if request is not None:
+        # not request.build_absolute_uri(), which percent-encodes the braces of tile url templates ('{z}/{x}/{y}')
+        return "{}://{}{}".format(request.scheme, request.get_host(), url)
+    return "http://{}:{}{}".format(get_host(), settings.PORT, url)
+
+
+def expand_tile_url(url, request=None):
+    """
+    Expand a stored (relative) tile url template.
+    If settings.TILE_HOSTS is set, the host is left as '{s}' in the template, selected per tile by the client (see deso.tilerouting).
+    :return: (url template, tile hosts or None)
+    """
+    if url and url.startswith("/") and settings.TILE_HOSTS:
+        return "{s}" + url, list(settings.TILE_HOSTS)
+    return expand_url(url, request), None
@@ -0,0 +1,197 @@
+"""
+Per-request phase timing of the tile serving path.
+
+Views wrapped with 'instrument()' start a PhaseTimer for the current thread,
+code along the request path records into it with:
+
+    with phase("encode"):
+        ...
+    count("rows", len(rows))
+
+(Both are no-ops outside of an instrumented request, for example in management commands)
+
+On completion the timings are:
+ - added to the response as a 'Server-Timing' header
+ - logged as a single JSON line to the 'deso.instrumentation' logger
+ - aggregated into per-layer, per-phase latency histograms (process-local, see get_histograms())
+"""
+import os
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# histogram bucket upper bounds in milliseconds, the last bucket holds all larger values
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_local = threading.local()
+
+
+class PhaseTimer:
+    """
+    Accumulates the duration (ms) of named phases and named counts for a single request.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tags = OrderedDict()
+        self.phases = OrderedDict()  # { phase name: milliseconds, ... }
+        self.counts = OrderedDict()  # { count name: value, ... }
+        self.start = time.perf_counter()
+        self.total = None
+
+    def add_phase(self, name, milliseconds):
+        self.phases[name] = self.phases.get(name, 0.0) + milliseconds
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self):
+        self.total = (time.perf_counter() - self.start) * 1000
+        return self.total
+
+    def server_timing(self):
+        """
+        :return: 'Server-Timing' header value, for example: 'registry;dur=0.021, query;dur=15.2, rows;desc="1520", total;dur=30.1'
+        """
+        metrics = ["{};dur={:.3f}".format(name, milliseconds) for name, milliseconds in self.phases.items()]
+        metrics.extend('{};desc="{}"'.format(name, value) for name, value in self.counts.items())
+        if self.total is not None:
+            metrics.append("total;dur={:.3f}".format(self.total))
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        result = OrderedDict((("event", self.name), ))
+        result.update(self.tags)
+        result["phases"] = OrderedDict((name, round(milliseconds, 3)) for name, milliseconds in self.phases.items())
+        result["counts"] = self.counts
+        result["total"] = round(self.total, 3) if self.total is not None else None
+        return result
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket (HISTOGRAM_BUCKETS_MS) latency histogram.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, milliseconds):
+        index = len(HISTOGRAM_BUCKETS_MS)
+        for i, upper_bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if milliseconds <= upper_bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += milliseconds
+
+    def as_dict(self):
+        labels = ["<={}".format(upper_bound) for upper_bound in HISTOGRAM_BUCKETS_MS] + [">{}".format(HISTOGRAM_BUCKETS_MS[-1])]
+        return OrderedDict((("count", self.count),
+                            ("mean", round(self.sum / self.count, 3) if self.count else None),
+                            ("buckets_ms", OrderedDict(zip(labels, self.buckets)))))
+
+
+# process-local histograms
+# --> { (timer name, layer): { phase name: LatencyHistogram, ... }, ... }
+_HISTOGRAMS = {}
+_HISTOGRAMS_LOCK = threading.Lock()
+
+
+def record_histograms(timer):
+    key = (timer.name, str(timer.tags.get("layer", None)))
+    phases = list(timer.phases.items())
+    if timer.total is not None:
+        phases.append(("total", timer.total))
+    with _HISTOGRAMS_LOCK:
+        histograms = _HISTOGRAMS.setdefault(key, {})
+        for name, milliseconds in phases:
+            if name not in histograms:
+                histograms[name] = LatencyHistogram()
+            histograms[name].add(milliseconds)
+
+
+def get_histograms():
+    """
+    :return: { "pid": <process id>, "<timer name>": { "<layer>": { "<phase>": histogram dict, ... }, ... }, ... }
+    """
+    result = OrderedDict((("pid", os.getpid()), ))
+    with _HISTOGRAMS_LOCK:
+        for (name, layer), histograms in sorted(_HISTOGRAMS.items()):
+            layers = result.setdefault(name, OrderedDict())
+            layers[layer] = OrderedDict((phase_name, histogram.as_dict()) for phase_name, histogram in histograms.items())
+    return result
+
+
+def reset_histograms():
+    with _HISTOGRAMS_LOCK:
+        _HISTOGRAMS.clear()
+
+
+def get_timer():
+    """
+    :return: PhaseTimer of the current (instrumented) request or None
+    """
+    return getattr(_local, "timer", None)
+
+
+def tag(name, value):
+    """
+    Add a tag (for example, 'layer') to the current request's timings.
+    """
+    timer = get_timer()
+    if timer is not None:
+        timer.tags[name] = value
+
+
+@contextmanager
+def phase(name):
+    timer = get_timer()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add_phase(name, (time.perf_counter() - start) * 1000)
+
+
+def count(name, value=1):
+    timer = get_timer()
+    if timer is not None:
+        timer.add_count(name, value)
+
+
+def instrument(name):
+    """
+    View decorator recording the phase timings of the wrapped view.
+    :param name: timing event name (for example, 'tile')
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            timer = PhaseTimer(name)
+            _local.timer = timer
+            try:
+                response = view_func(request, *args, **kwargs)
+            finally:
+                _local.timer = None
+                timer.finish()
+            timer.tags["status"] = response.status_code
+            response["Server-Timing"] = timer.server_timing()
+            logger.info(json.dumps(timer.as_dict()))
+            record_histograms(timer)
+            return response
+        return wrapper
+    return decorator
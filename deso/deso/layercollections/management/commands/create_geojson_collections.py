@@ -32,12 +32,15 @@ def create_collection(geojson_layer, base_maplayer_id=None, host=None, port=8086
     new_collection = MapLayerCollection(name=collection_name)
     new_collection.save()
 
-    full_url = "http://{}:{}{}".format(host, port, geojson_layer.get_absolute_url())
+    layer_url = geojson_layer.get_absolute_url()
+    if host:
+        # layer served by another deso server
+        layer_url = "http://{}:{}{}".format(host, port, layer_url)
     geojson_maplayer = MapLayer(collection=new_collection,
                                 name=geojson_layer.name,
                                 attribution="Nokia",
                                 type="GeoJSON",
-                                url=full_url)
+                                url=layer_url)
     geojson_maplayer.save()
     new_base_maplayer = MapLayer(collection=new_collection,
                                 name=base_maplayer.name,
@@ -61,8 +64,7 @@ class Command(BaseCommand):
                             help="Baselayer ID to use in collection [DEFAULT=None]")
         parser.add_argument("--host",
                             default=None,
-                            required=True,
-                            help="IP or HOST for target collection URL.[DEFAULT=None]")
+                            help="IP or HOST for target collection URL, if not given the URL is relative to the serving host.[DEFAULT=None]")
         parser.add_argument("--port",
                             default=8086,
                             help="host PORT for target collection URL.[DEFAULT=8086]")
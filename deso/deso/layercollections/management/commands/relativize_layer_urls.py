@@ -0,0 +1,59 @@
+"""
+Convert the absolute urls ('http://HOST:PORT/raster/...') of MapLayers served by this deso installation to paths.
+Paths are expanded with the requested host when served, so that later host changes require no update.
+"""
+from urllib.parse import urlsplit, urlunsplit
+
+from django.core.management.base import BaseCommand
+
+from ...models import MapLayer
+
+# paths of layers served by deso
+LOCAL_PATH_PREFIXES = ("/raster/", "/vector/")
+URL_FIELDNAMES = ("url", "hidpi_url", "webp_url", "hidpi_webp_url", "batch_url", "grid_url", "point_url", "legend_url")
+
+
+def get_relative_url(url, hosts=None):
+    """
+    :param hosts: if given, only urls with these 'host:port' values are converted
+    :return: path of the given url if served by deso, otherwise None
+    """
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.path.startswith(LOCAL_PATH_PREFIXES):
+        return None
+    if hosts and parts.netloc not in hosts:
+        return None
+    return urlunsplit(("", "", parts.path, parts.query, parts.fragment))
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hosts",
+                            nargs="+",
+                            default=None,
+                            help="Only convert urls with the given 'HOST:PORT' values [DEFAULT=all hosts]")
+        parser.add_argument("--dry-run",
+                            default=False,
+                            action="store_true",
+                            help="If given, the changes are displayed but not saved")
+
+    def handle(self, *args, **options):
+        updated_count = 0
+        for map_layer in MapLayer.objects.order_by("id"):
+            update_fields = []
+            for fieldname in URL_FIELDNAMES:
+                url = getattr(map_layer, fieldname)
+                relative_url = get_relative_url(url, options["hosts"])
+                if relative_url is not None:
+                    self.stdout.write("[{}] {}.{}: {} -> {}".format(map_layer.id, map_layer.name, fieldname, url, relative_url))
+                    setattr(map_layer, fieldname, relative_url)
+                    update_fields.append(fieldname)
+            if update_fields:
+                updated_count += 1
+                if not options["dry_run"]:
+                    map_layer.save(update_fields=update_fields)
+        self.stdout.write("{} ({}) MapLayer(s)".format("Would update" if options["dry_run"] else "Updated", updated_count))
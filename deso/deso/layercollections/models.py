@@ -4,6 +4,8 @@ from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.auth.models import User
+from deso.hosts import expand_url, expand_tile_url
+from deso.tilerouting import get_routing_options
 
 WGS84_SRID = settings.WGS84_SRID
 METERS_SRID = settings.METERS_SRID
@@ -48,26 +50,74 @@ class MapLayer(models.Model):
                                help_text="Location of MapLayer center")
     description = models.TextField(blank=True)
     type = models.CharField(max_length=25, choices=VALID_LAYER_TYPES)
-    # note this could be a layer within this django project,
-    # or one defined elsewhere.
-    url = models.URLField(help_text=_("Layer URL from which layer is served. (For TileLayers this should be in the form: 'http://HOST:PORT/{z}/{x}/{y}.png')"))
-    legend_url = models.URLField(null=True,
+    # note this could be a layer within this django project (stored as a path, for example '/raster/layer/1/{z}/{x}/{y}.png'
+    # and expanded per request, see deso.hosts.expand_url()), or one defined elsewhere (absolute url).
+    url = models.CharField(max_length=200,
+                           help_text=_("Layer URL or path from which layer is served. (For TileLayers this should be in the form: 'http://HOST:PORT/{z}/{x}/{y}.png' or '/{z}/{x}/{y}.png')"))
+    hidpi_url = models.CharField(max_length=200,
+                                 null=True,
                                  blank=True,
-                                 help_text="(Optional) URL to legend html")
+                                 help_text=_("(Optional) URL of high-dpi (512px, '@2x') tiles covering the same extent as 'url' tiles"))
+    webp_url = models.CharField(max_length=200,
+                                null=True,
+                                blank=True,
+                                help_text=_("(Optional) URL of webp tiles, used instead of 'url' by browsers supporting webp"))
+    hidpi_webp_url = models.CharField(max_length=200,
+                                      null=True,
+                                      blank=True,
+                                      help_text=_("(Optional) URL of high-dpi webp tiles, used instead of 'hidpi_url' by browsers supporting webp"))
+    batch_url = models.CharField(max_length=200,
+                                 null=True,
+                                 blank=True,
+                                 help_text=_("(Optional) URL serving multiple tiles per request (see raster.views.get_tile_batch)"))
+    grid_url = models.CharField(max_length=200,
+                                null=True,
+                                blank=True,
+                                help_text=_("(Optional) URL of UTFGrid interaction tiles (see raster.views.get_grid_tile)"))
+    point_url = models.CharField(max_length=200,
+                                 null=True,
+                                 blank=True,
+                                 help_text=_("(Optional) URL returning the layer values at '?lon=<lon>&lat=<lat>' (see raster.views.get_point_values)"))
+    legend_url = models.CharField(max_length=200,
+                                  null=True,
+                                  blank=True,
+                                  help_text="(Optional) URL to legend html")
 
-    def info(self):
+    def info(self, request=None):
+        """
+        :param request: request used to expand the layer urls (see deso.hosts.expand_url())
+        """
+        if self.type == "GeoJSON":
+            layer_url, tile_hosts = expand_url(self.url, request), None
+        else:
+            layer_url, tile_hosts = expand_tile_url(self.url, request)
         layer_definition = {
             "collections": [i.id for i in self.collections.all()],
             "name": self.name,
             "type": self.type,
-            "layerUrl": self.url,
+            "layerUrl": layer_url,
             "minZoom": self.min_zoom,
             "maxZoom": self.max_zoom,
             "attribution": self.attribution,
             "opacity": self.opacity,
         }
         if self.legend_url:
-            layer_definition["legendUrl"] = self.legend_url
+            layer_definition["legendUrl"] = expand_url(self.legend_url, request)
+        if self.hidpi_url:
+            layer_definition["hiDpiUrl"] = expand_tile_url(self.hidpi_url, request)[0]
+        if self.webp_url:
+            layer_definition["webpUrl"] = expand_tile_url(self.webp_url, request)[0]
+        if self.hidpi_webp_url:
+            layer_definition["hiDpiWebpUrl"] = expand_tile_url(self.hidpi_webp_url, request)[0]
+        if self.batch_url:
+            layer_definition["batchUrl"] = expand_tile_url(self.batch_url, request)[0]
+        if self.grid_url:
+            layer_definition["gridUrl"] = expand_tile_url(self.grid_url, request)[0]
+            layer_definition["gridMinZoom"] = settings.RASTER_UTFGRID_MIN_ZOOM
+        if self.point_url:
+            layer_definition["pointUrl"] = expand_url(self.point_url, request)
+        if tile_hosts:
+            layer_definition["tileRouting"] = get_routing_options(self.url, tile_hosts)
 
         if self.center:
             wgs84_point = self.center.transform(WGS84_SRID, clone=True)
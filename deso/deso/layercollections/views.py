@@ -1,8 +1,9 @@
-import json
 from django.conf import settings
 from django.shortcuts import redirect
 from django.views.decorators.cache import cache_page
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.http import HttpResponseBadRequest, HttpResponseNotFound
+from deso.compression import json_response
+from deso.hosts import get_host
 from .models import MapLayerCollection, MapLayer
 
 @cache_page(60 * 5)
@@ -17,17 +18,17 @@ def get_available_collections(request):
                               "layers": [],
                               }
         for ml in collection.maplayer_set.all():
-            collection_info["layers"].append(ml.info())
+            collection_info["layers"].append(ml.info(request))
         available_collections.append(collection_info)
-    return HttpResponse(json.dumps(available_collections), content_type='application/json')
+    return json_response(request, available_collections, content_type='application/json')
 
 
 @cache_page(60 * 5)
 def get_available_maplayers(request):
     available_maplayers = []
     for maplayer in MapLayer.objects.order_by("created_datetime"):
-        available_maplayers.append(maplayer.info())
-    return HttpResponse(json.dumps(available_maplayers), content_type='application/json')
+        available_maplayers.append(maplayer.info(request))
+    return json_response(request, available_maplayers, content_type='application/json')
 
 
 def get_collection(request, collection_id=None):
@@ -44,9 +45,9 @@ def get_collection(request, collection_id=None):
                       }
 
     for ml in collection.maplayer_set.all():
-        collection_info["layers"].append(ml.info())
+        collection_info["layers"].append(ml.info(request))
 
-    return HttpResponse(json.dumps(collection_info), content_type='application/json')
+    return json_response(request, collection_info, content_type='application/json')
 
 
 def get_collection_map(request, collection_id=None):
@@ -54,7 +55,7 @@ def get_collection_map(request, collection_id=None):
     if not collection_id:
         raise HttpResponseBadRequest("Collection ID not given!")
 
-    url = "http://{host}:{port}/static/index.html?collection={collection_id}".format(host=settings.HOST,
+    url = "http://{host}:{port}/static/index.html?collection={collection_id}".format(host=get_host(),
                                                                                      port=settings.PORT,
                                                                                      collection_id=collection_id)
     return redirect(url)
\ No newline at end of file
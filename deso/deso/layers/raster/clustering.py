@@ -0,0 +1,107 @@
+"""
+Morton (Z-order) clustering of raster pixels.
+
+Pixels are written in the order of the Morton key of their grid index (pixel column/row from the spherical mercator origin),
+so that the pixels of a tile (or metatile) are stored in a few contiguous table pages instead of scattered over the table.
+New pixels are sorted on ingest (see sort_pixels()), existing layers are reclustered with the 'cluster_raster_layers' command.
+
+The same key is computed in SQL (get_grid_index_sql(), get_morton_sql()) to recluster layers within the database.
+"""
+from django.db import connections
+from .tileindex import SPHERICAL_MERCATOR_MAX
+
+# bits of the pixel column/row interleaved in the key
+# --> the spherical mercator extent is < 2 ** 26 one meter pixels wide (the key fits a signed 64 bit integer)
+MORTON_BITS = 26
+MAXIMUM_GRID_INDEX = 2 ** MORTON_BITS - 1
+
+
+def spread_bits(value):
+    """
+    :param value: integer < 2 ** 32
+    :return: value with a zero bit inserted above each bit (bit i moved to bit 2i)
+    """
+    value &= 0xffffffff
+    value = (value | (value << 16)) & 0x0000ffff0000ffff
+    value = (value | (value << 8)) & 0x00ff00ff00ff00ff
+    value = (value | (value << 4)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def morton_key(column, row):
+    return spread_bits(column) | (spread_bits(row) << 1)
+
+
+def get_grid_index(x, y, pixel_size):
+    """
+    :param x, y: settings.METERS_SRID coordinates
+    :return: (column, row) of the pixel grid containing the location
+    """
+    column = int((x + SPHERICAL_MERCATOR_MAX) // pixel_size)
+    row = int((y + SPHERICAL_MERCATOR_MAX) // pixel_size)
+    return min(max(column, 0), MAXIMUM_GRID_INDEX), min(max(row, 0), MAXIMUM_GRID_INDEX)
+
+
+def get_pixel_morton_key(x, y, pixel_size):
+    return morton_key(*get_grid_index(x, y, pixel_size))
+
+
+def sort_pixels(pixels, pixel_size):
+    """
+    Sort pixel objects (NumericRasterAggregateData/TextRasterAggregateData, locations in settings.METERS_SRID) in place by Morton key.
+    """
+    pixels.sort(key=lambda pixel: get_pixel_morton_key(pixel.location.x, pixel.location.y, pixel_size))
+    return pixels
+
+
+def get_grid_index_sql(coordinate_sql, pixel_size):
+    """
+    :param coordinate_sql: SQL expression of a settings.METERS_SRID coordinate (for example, 'ST_X(location)')
+    :return: SQL expression of the pixel column/row (equal to get_grid_index())
+    """
+    return "LEAST(GREATEST(floor(({} + {}) / {})::bigint, 0), {})".format(coordinate_sql,
+                                                                         SPHERICAL_MERCATOR_MAX,
+                                                                         float(pixel_size),
+                                                                         MAXIMUM_GRID_INDEX)
+
+
+def get_morton_sql(column_sql, row_sql):
+    """
+    :param column_sql: SQL expression of the pixel column (an integer column or alias)
+    :param row_sql: SQL expression of the pixel row
+    :return: SQL expression of the Morton key (equal to morton_key())
+    """
+    terms = []
+    for bit in range(MORTON_BITS):
+        terms.append("((({} >> {}) & 1) << {})".format(column_sql, bit, 2 * bit))
+        terms.append("((({} >> {}) & 1) << {})".format(row_sql, bit, 2 * bit + 1))
+    return "(" + " | ".join(terms) + ")"
+
+
+def recluster_layer(layer):
+    """
+    Rewrite the layer's pixels in Morton key order (in a single statement).
+    The replaced rows remain as dead rows until the table is vacuumed.
+    :param layer: RasterAggregatedLayer object
+    :return: number of pixels rewritten
+    """
+    DataModel = layer.get_data_model()
+    connection = connections[layer.pixel_database]
+    table = connection.ops.quote_name(DataModel._meta.db_table)
+    sql = """
+        WITH moved AS (
+            DELETE FROM {table} WHERE layer_id = %s RETURNING *
+        )
+        INSERT INTO {table}
+        SELECT moved.* FROM moved
+        CROSS JOIN LATERAL (SELECT {column} AS grid_column, {row} AS grid_row) AS grid
+        ORDER BY {key}
+    """.format(table=table,
+               column=get_grid_index_sql("ST_X(moved.location)", layer.pixel_size_meters),
+               row=get_grid_index_sql("ST_Y(moved.location)", layer.pixel_size_meters),
+               key=get_morton_sql("grid.grid_column", "grid.grid_row"))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [layer.id])
+        return cursor.rowcount
@@ -0,0 +1,294 @@
+"""
+Memory-mapped columnar storage of raster layer pixels (RasterAggregatedLayer.data_model 'ColumnarRasterData').
+
+A layer file holds one array per column (grid column/row and the aggregate values) for all pixels,
+sorted by block (BLOCK_PIXELS x BLOCK_PIXELS pixels, row-major) with a block directory,
+so that the pixels of a bbox are read from contiguous slices of the memory-mapped file (no database query).
+
+File layout (little-endian, sections 8 byte aligned):
+    header          HEADER_FORMAT
+    block keys      uint64[block count]       (sorted)
+    block offsets   uint64[block count + 1]   (first pixel of each block, pixel count)
+    columns         COLUMNS, each [pixel count]
+
+Pixel locations are the grid column/row multiplied by the pixel size (settings.METERS_SRID), matching the snapped
+locations written to NumericRasterAggregateData by 'create_raster_layer'.
+"""
+import os
+import math
+import mmap
+import array
+import struct
+import bisect
+import threading
+import tempfile
+from collections import OrderedDict
+
+COLUMNAR_MAGIC = b"DCOL"
+COLUMNAR_VERSION = 1
+# magic, version, pixel size, pixel count, block count, block pixels, extent (xmin, ymin, xmax, ymax)
+HEADER_FORMAT = "<4sB3xdQII4d"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+BLOCK_PIXELS = 256
+# added to block column/row so that block keys are positive
+BLOCK_OFFSET = 2 ** 31
+
+# (column name, array typecode), the grid 'column'/'row' are signed, the values are NumericRasterAggregateData fieldnames
+COLUMNS = OrderedDict((
+    ("column", "i"),
+    ("row", "i"),
+    ("samples", "I"),
+    ("mean", "d"),
+    ("variance", "d"),
+    ("stddev", "d"),
+    ("sum", "d"),
+    ("minimum", "d"),
+    ("maximum", "d"),
+))
+VALUE_FIELDNAMES = tuple(name for name in COLUMNS if name not in ("column", "row"))
+
+MISSING_VALUE = float("nan")  # stored for missing (None) aggregate values
+
+
+def get_block_key(column, row):
+    """
+    :return: row-major key of the block containing the given grid column/row
+    """
+    return ((row // BLOCK_PIXELS + BLOCK_OFFSET) << 32) | (column // BLOCK_PIXELS + BLOCK_OFFSET)
+
+
+def _padding(length):
+    return b"\x00" * (-length % 8)
+
+
+def write_columnar_layer(filepath, pixel_size, pixels):
+    """
+    Write a columnar layer file (replacing an existing file once complete).
+    :param pixel_size: layer pixel size (meters)
+    :param pixels: iterable of (x, y, {fieldname: value, ...}) with x, y in settings.METERS_SRID
+    :return: number of pixels written
+    """
+    rows = []
+    for x, y, values in pixels:
+        column = int(math.floor(x / pixel_size + 0.5))
+        row = int(math.floor(y / pixel_size + 0.5))
+        rows.append((get_block_key(column, row), row, column, values))
+    rows.sort(key=lambda item: item[:3])
+
+    columns = OrderedDict((name, array.array(typecode)) for name, typecode in COLUMNS.items())
+    block_keys = array.array("Q")
+    block_offsets = array.array("Q")
+    xmin = ymin = float("inf")
+    xmax = ymax = float("-inf")
+    for index, (block_key, row, column, values) in enumerate(rows):
+        if not block_keys or block_keys[-1] != block_key:
+            block_keys.append(block_key)
+            block_offsets.append(index)
+        columns["column"].append(column)
+        columns["row"].append(row)
+        for name in VALUE_FIELDNAMES:
+            value = values.get(name, None)
+            if name == "samples":
+                columns[name].append(int(value or 0))
+            else:
+                columns[name].append(MISSING_VALUE if value is None else float(value))
+        xmin = min(xmin, column * pixel_size)
+        xmax = max(xmax, column * pixel_size)
+        ymin = min(ymin, row * pixel_size)
+        ymax = max(ymax, row * pixel_size)
+    block_offsets.append(len(rows))
+    if not rows:
+        xmin = ymin = xmax = ymax = 0.0
+
+    header = struct.pack(HEADER_FORMAT, COLUMNAR_MAGIC, COLUMNAR_VERSION, float(pixel_size), len(rows), len(block_keys), BLOCK_PIXELS,
+                         xmin, ymin, xmax, ymax)
+    directory = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_filepath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as out_f:
+            out_f.write(header + _padding(len(header)))
+            for values in [block_keys, block_offsets] + list(columns.values()):
+                data = values.tobytes()
+                out_f.write(data + _padding(len(data)))
+        os.replace(temporary_filepath, filepath)
+    except Exception:
+        os.remove(temporary_filepath)
+        raise
+    return len(rows)
+
+
+class ColumnarLayerReader:
+    """
+    Read-only, memory-mapped access to a columnar layer file.
+    Column values are read from memoryview slices of the mapped file (no copy), safe for use from multiple threads.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, "rb") as in_f:
+            self._mmap = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, self.pixel_size, self.pixel_count, self.block_count, self.block_pixels, *extent = struct.unpack_from(HEADER_FORMAT, view)
+        if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+            raise ValueError("Not a columnar layer file (version {}): {}".format(COLUMNAR_VERSION, filepath))
+        self.extent = tuple(extent)
+
+        offset = HEADER_SIZE + len(_padding(HEADER_SIZE))
+
+        def section(typecode, length):
+            nonlocal offset
+            size = length * array.array(typecode).itemsize
+            values = view[offset:offset + size].cast(typecode)
+            offset += size + len(_padding(size))
+            return values
+
+        self.block_keys = section("Q", self.block_count)
+        self.block_offsets = section("Q", self.block_count + 1)
+        self.columns = OrderedDict((name, section(typecode, self.pixel_count)) for name, typecode in COLUMNS.items())
+
+    def get_ranges(self, column_min, row_min, column_max, row_max):
+        """
+        :return: [(first pixel, end pixel), ...] of the blocks intersecting the given grid bounds
+        """
+        ranges = []
+        for block_row in range(row_min // BLOCK_PIXELS, row_max // BLOCK_PIXELS + 1):
+            first_key = get_block_key(column_min, block_row * BLOCK_PIXELS)
+            last_key = get_block_key(column_max, block_row * BLOCK_PIXELS)
+            first_block = bisect.bisect_left(self.block_keys, first_key)
+            end_block = bisect.bisect_right(self.block_keys, last_key)
+            if first_block < end_block:
+                ranges.append((self.block_offsets[first_block], self.block_offsets[end_block]))
+        return ranges
+
+    def query(self, xmin, ymin, xmax, ymax, fieldname):
+        """
+        :param xmin, ymin, xmax, ymax: bbox in settings.METERS_SRID
+        :param fieldname: value column (see VALUE_FIELDNAMES)
+        :return: [(x, y, value), ...] of the pixels located within the bbox (missing values excluded)
+        """
+        pixel_size = self.pixel_size
+        column_min = int(math.ceil(xmin / pixel_size))
+        column_max = int(math.floor(xmax / pixel_size))
+        row_min = int(math.ceil(ymin / pixel_size))
+        row_max = int(math.floor(ymax / pixel_size))
+        if column_min > column_max or row_min > row_max:
+            return []
+        columns = self.columns["column"]
+        rows = self.columns["row"]
+        values = self.columns[fieldname]
+        results = []
+        for start, end in self.get_ranges(column_min, row_min, column_max, row_max):
+            for column, row, value in zip(columns[start:end], rows[start:end], values[start:end]):
+                if column_min <= column <= column_max and row_min <= row <= row_max and value == value:
+                    results.append((column * pixel_size, row * pixel_size, value))
+        return results
+
+    def query_grid(self, column_min, row_min, column_max, row_max, fieldnames):
+        """
+        :param column_min, row_min, column_max, row_max: grid bounds (inclusive)
+        :param fieldnames: value columns (see VALUE_FIELDNAMES)
+        :return: iterator of (column, row, value, ...) of the pixels within the grid bounds (missing values as None)
+        """
+        columns = self.columns["column"]
+        rows = self.columns["row"]
+        value_columns = [self.columns[name] for name in fieldnames]
+        for start, end in self.get_ranges(column_min, row_min, column_max, row_max):
+            for index in range(start, end):
+                column = columns[index]
+                row = rows[index]
+                if column_min <= column <= column_max and row_min <= row <= row_max:
+                    yield (column, row) + tuple(None if values[index] != values[index] else values[index]
+                                                for values in value_columns)
+
+    def get_pixel(self, column, row, fieldnames):
+        """
+        Look up a single pixel by grid column/row (binary search of the block directory and the block's (row, column) order).
+        :return: (value, ...) of the pixel (missing values as None), or None if the pixel does not exist
+        """
+        block_index = bisect.bisect_left(self.block_keys, get_block_key(column, row))
+        if block_index >= self.block_count or self.block_keys[block_index] != get_block_key(column, row):
+            return None
+        columns = self.columns["column"]
+        rows = self.columns["row"]
+        low = self.block_offsets[block_index]
+        high = self.block_offsets[block_index + 1]
+        while low < high:
+            middle = (low + high) // 2
+            if (rows[middle], columns[middle]) < (row, column):
+                low = middle + 1
+            else:
+                high = middle
+        if low >= self.block_offsets[block_index + 1] or rows[low] != row or columns[low] != column:
+            return None
+        values = (self.columns[name][low] for name in fieldnames)
+        return tuple(None if value != value else value for value in values)
+
+    def iter_pixels(self, fieldnames):
+        """
+        :return: iterator of (x, y, value, ...) for all pixels (missing values as None)
+        """
+        pixel_size = self.pixel_size
+        value_columns = [self.columns[name] for name in fieldnames]
+        for index, (column, row) in enumerate(zip(self.columns["column"], self.columns["row"])):
+            yield (column * pixel_size, row * pixel_size) + tuple(None if values[index] != values[index] else values[index]
+                                                                    for values in value_columns)
+
+    def aggregate(self, fieldname):
+        """
+        :return: {"avg":, "max":, "min":, "stddev":} of the (non-missing) values of the given column, None if no values
+        """
+        count = 0
+        mean = 0.0
+        m2 = 0.0
+        maximum = minimum = None
+        for value in self.columns[fieldname]:
+            if value != value:
+                continue
+            count += 1
+            delta = value - mean
+            mean += delta / count
+            m2 += delta * (value - mean)
+            maximum = value if maximum is None or value > maximum else maximum
+            minimum = value if minimum is None or value < minimum else minimum
+        if not count:
+            return {"avg": None, "max": None, "min": None, "stddev": None}
+        # sample standard deviation (as the PostgreSQL StdDev aggregate used for database layers)
+        stddev = math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+        return {"avg": mean, "max": maximum, "min": minimum, "stddev": stddev}
+
+    def close(self):
+        for values in [self.block_keys, self.block_offsets] + list(self.columns.values()):
+            values.release()
+        self._mmap.close()
+
+
+# process-local readers
+# --> { filepath: (modified time, ColumnarLayerReader), ... }
+_READERS = {}
+_READERS_LOCK = threading.Lock()
+
+
+def get_columnar_reader(filepath):
+    """
+    :return: ColumnarLayerReader of the given file (reopened if the file has been replaced)
+    """
+    modified = os.stat(filepath).st_mtime_ns
+    with _READERS_LOCK:
+        entry = _READERS.get(filepath, None)
+        if entry is None or entry[0] != modified:
+            # a replaced reader is left to be garbage collected, it may still be in use by another thread
+            entry = (modified, ColumnarLayerReader(filepath))
+            _READERS[filepath] = entry
+        return entry[1]
+
+
+def remove_columnar_layer(filepath):
+    """
+    Remove a columnar layer file (if it exists).
+    """
+    with _READERS_LOCK:
+        _READERS.pop(filepath, None)
+    if os.path.exists(filepath):
+        os.remove(filepath)
@@ -0,0 +1,396 @@
+"""
+Benchmark the main data loading and serving paths with generated (synthetic) drive-test CSV and GeoJSON data.
+Results are written as JSON so that results of different releases can be compared.
+
+NOTE: All database changes made by the benchmark are rolled back when the benchmark completes.
+"""
+import os
+import csv
+import json
+import math
+import random
+import shutil
+import platform
+import tempfile
+import time
+import datetime
+import statistics
+from contextlib import ExitStack
+from collections import OrderedDict
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory
+from django.conf import settings
+from ...models import RasterAggregatedLayer, ScaledColorLegend
+from ...tiles import get_tile_layer_manager, render_metatile, encode_tile
+from ....vector.views import get_objects
+from ....vector.management.commands.load_geojson_layer import load_geojson_layer
+from .create_raster_layer import rasterize_csv, load_to_raster_layer
+from .load_raster_csv import load_raster_csv
+from .compare_raster_layers import VALID_METHODS
+
+DEFAULT_ROWS = 100000
+DEFAULT_CENTER = (139.6917, 35.6895)  # lon, lat (Tokyo)
+DEFAULT_SPREAD_METERS = 5000
+DEFAULT_FEATURES = 5000
+DEFAULT_ZOOM = 15
+DEFAULT_TILES = 20
+DEFAULT_COLOR_VALUES = 100000
+DEFAULT_MINIMUM_SAMPLES = 250  # compare_raster_layers default
+
+VALUE_DISTRIBUTIONS = ("normal", "uniform")
+VALUE_FIELDNAME = "rsrp"
+CSV_DATETIME_FORMAT = "%H:%M:%S.%f %d-%m-%Y"  # load_raster_csv default '--datetime-format-str'
+CSV_LON_IDX = 1
+CSV_LAT_IDX = 2
+CSV_VALUE_IDX = 3
+
+METERS_PER_DEGREE = 111320
+DRIVE_STEP_METERS = 10  # distance between generated samples
+
+
+def meters_to_degrees(meters, latitude):
+    """
+    :return: (longitude degrees, latitude degrees) of the given distance at the given latitude
+    """
+    return meters / (METERS_PER_DEGREE * math.cos(math.radians(latitude))), meters / METERS_PER_DEGREE
+
+
+def generate_drive_test_csv(filepath, rows, center=DEFAULT_CENTER, spread_meters=DEFAULT_SPREAD_METERS,
+                            distribution="normal", value_mean=-95.0, value_stddev=10.0, track_seed=0, value_seed=0):
+    """
+    Write a drive-test CSV ('datetime,lon,lat,<VALUE_FIELDNAME>'), a random walk within spread_meters of the center.
+    Files written with the same track_seed contain the same locations (with values determined by value_seed).
+    :return: filepath
+    """
+    track_random = random.Random(track_seed)
+    value_random = random.Random(value_seed)
+    center_lon, center_lat = center
+    x = y = 0.0  # offset from center (meters)
+    lon_offset, lat_offset = meters_to_degrees(1, center_lat)  # degrees per meter
+    heading = track_random.uniform(0, 2 * math.pi)
+    sample_datetime = datetime.datetime(2015, 1, 1)
+    with open(filepath, "wt", encoding="utf8", newline="") as out_f:
+        writer = csv.writer(out_f)
+        writer.writerow(("datetime", "lon", "lat", VALUE_FIELDNAME))
+        for _ in range(rows):
+            heading += track_random.gauss(0, 0.3)
+            x += math.cos(heading) * DRIVE_STEP_METERS
+            y += math.sin(heading) * DRIVE_STEP_METERS
+            if abs(x) > spread_meters or abs(y) > spread_meters:
+                # turn back toward the center
+                heading += math.pi
+                x = max(-spread_meters, min(spread_meters, x))
+                y = max(-spread_meters, min(spread_meters, y))
+            if distribution == "uniform":
+                value = value_random.uniform(value_mean - 2 * value_stddev, value_mean + 2 * value_stddev)
+            else:
+                value = value_random.gauss(value_mean, value_stddev)
+            sample_datetime += datetime.timedelta(seconds=1)
+            writer.writerow((sample_datetime.strftime(CSV_DATETIME_FORMAT),
+                             round(center_lon + x * lon_offset, 7),
+                             round(center_lat + y * lat_offset, 7),
+                             round(value, 2)))
+    return filepath
+
+
+def generate_geojson(filepath, features, center=DEFAULT_CENTER, spread_meters=DEFAULT_SPREAD_METERS, seed=0):
+    """
+    Write a GeoJSON FeatureCollection of (uniquely 'id'ed) Point features within spread_meters of the center.
+    :return: filepath
+    """
+    feature_random = random.Random(seed)
+    center_lon, center_lat = center
+    lon_spread, lat_spread = meters_to_degrees(spread_meters, center_lat)
+    collection = {"type": "FeatureCollection", "features": []}
+    for feature_id in range(1, features + 1):
+        lon = center_lon + feature_random.uniform(-lon_spread, lon_spread)
+        lat = center_lat + feature_random.uniform(-lat_spread, lat_spread)
+        collection["features"].append({"type": "Feature",
+                                       "geometry": {"type": "Point", "coordinates": [round(lon, 7), round(lat, 7)]},
+                                       "properties": {"id": feature_id,
+                                                      "name": "feature-{}".format(feature_id),
+                                                      "value": round(feature_random.uniform(0, 100), 2)}})
+    with open(filepath, "wt", encoding="utf8") as out_f:
+        json.dump(collection, out_f)
+    return filepath
+
+
+def time_function(func, repeat=1, setup=None):
+    """
+    :param setup: if given, called (untimed) before each call of func
+    :return: [elapsed seconds, ...], result of the last call
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def get_result(name, timings, items=None):
+    result = OrderedDict((("name", name),
+                          ("repeat", len(timings)),
+                          ("min_seconds", round(min(timings), 6)),
+                          ("mean_seconds", round(statistics.mean(timings), 6)),
+                          ("max_seconds", round(max(timings), 6))))
+    if items is not None:
+        result["items"] = items
+        result["items_per_second"] = round(items / min(timings), 3) if min(timings) else None
+    return result
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-r", "--rows",
+                            type=int,
+                            default=DEFAULT_ROWS,
+                            help="Generated drive-test CSV rows [DEFAULT={}]".format(DEFAULT_ROWS))
+        parser.add_argument("-s", "--spread-meters",
+                            type=int,
+                            default=DEFAULT_SPREAD_METERS,
+                            help="Maximum distance of generated samples from the center [DEFAULT={}]".format(DEFAULT_SPREAD_METERS))
+        parser.add_argument("--center",
+                            type=float,
+                            nargs=2,
+                            default=DEFAULT_CENTER,
+                            help="Center lon lat of generated data [DEFAULT={} {}]".format(*DEFAULT_CENTER))
+        parser.add_argument("-d", "--distribution",
+                            default="normal",
+                            choices=VALUE_DISTRIBUTIONS,
+                            help="Generated value distribution [DEFAULT='normal']")
+        parser.add_argument("--value-mean",
+                            type=float,
+                            default=-95.0,
+                            help="Generated value mean [DEFAULT=-95.0]")
+        parser.add_argument("--value-stddev",
+                            type=float,
+                            default=10.0,
+                            help="Generated value standard deviation [DEFAULT=10.0]")
+        parser.add_argument("-p", "--pixel-size",
+                            type=int,
+                            default=5,
+                            help="Raster Pixel Size (meters) [DEFAULT=5]")
+        parser.add_argument("-f", "--features",
+                            type=int,
+                            default=DEFAULT_FEATURES,
+                            help="Generated GeoJSON features [DEFAULT={}]".format(DEFAULT_FEATURES))
+        parser.add_argument("-z", "--zoom",
+                            type=int,
+                            default=DEFAULT_ZOOM,
+                            help="Zoom level of rendered tiles [DEFAULT={}]".format(DEFAULT_ZOOM))
+        parser.add_argument("-t", "--tiles",
+                            type=int,
+                            default=DEFAULT_TILES,
+                            help="Number of (occupied) tiles & metatiles to render [DEFAULT={}]".format(DEFAULT_TILES))
+        parser.add_argument("--color-values",
+                            type=int,
+                            default=DEFAULT_COLOR_VALUES,
+                            help="Number of values converted to colors by the color manager [DEFAULT={}]".format(DEFAULT_COLOR_VALUES))
+        parser.add_argument("-m", "--minimum-samples",
+                            type=int,
+                            default=DEFAULT_MINIMUM_SAMPLES,
+                            help="Minimum pixel samples of the compared pixels (as 'compare_raster_layers') [DEFAULT={}]".format(DEFAULT_MINIMUM_SAMPLES))
+        parser.add_argument("-n", "--repeat",
+                            type=int,
+                            default=1,
+                            help="Number of times each benchmark is run (the minimum is used for items/second) [DEFAULT=1]")
+        parser.add_argument("--seed",
+                            type=int,
+                            default=0,
+                            help="Random seed of the generated data [DEFAULT=0]")
+        parser.add_argument("-o", "--output",
+                            default=None,
+                            help="Output JSON filepath [DEFAULT=stdout]")
+
+    def handle(self, *args, **options):
+        if options["distribution"] not in VALUE_DISTRIBUTIONS:
+            raise CommandError("Invalid '--distribution' ({}), expected one of: {}".format(options["distribution"],
+                                                                                            ", ".join(VALUE_DISTRIBUTIONS)))
+        if options["rows"] < 2 or options["repeat"] < 1:
+            raise CommandError("'--rows' must be >= 2 and '--repeat' >= 1")
+        start = datetime.datetime.now()
+        # progress is written to stderr, stdout may be the JSON output
+        self.stderr.write("Start: {}".format(start))
+
+        working_directory = tempfile.mkdtemp(prefix="deso-benchmark-")
+        try:
+            # pixels are written to the pixel databases (settings.RASTER_PIXEL_DATABASES)
+            databases = ["default"] + [database for database in settings.RASTER_PIXEL_DATABASES if database != "default"]
+            with ExitStack() as stack:
+                for database in databases:
+                    stack.enter_context(transaction.atomic(using=database))
+                results = self.run_benchmarks(working_directory, options)
+                for database in databases:
+                    transaction.set_rollback(True, using=database)
+        finally:
+            shutil.rmtree(working_directory, ignore_errors=True)
+
+        parameter_names = ("rows", "spread_meters", "center", "distribution", "value_mean", "value_stddev", "pixel_size",
+                           "features", "zoom", "tiles", "color_values", "repeat", "seed")
+        output = OrderedDict((("created", start.isoformat()),
+                              ("environment", OrderedDict((("python", platform.python_version()),
+                                                           ("django", django.get_version()),
+                                                           ("platform", platform.platform())))),
+                              ("parameters", OrderedDict((name, options[name]) for name in parameter_names)),
+                              ("results", results)))
+        output_json = json.dumps(output, indent=4)
+        if options["output"]:
+            with open(options["output"], "wt", encoding="utf8") as out_f:
+                out_f.write(output_json)
+            self.stderr.write("Results written to: {}".format(options["output"]))
+        else:
+            self.stdout.write(output_json)
+
+        end = datetime.datetime.now()
+        self.stderr.write("End: {}".format(end))
+        elapsed = end - start
+        self.stderr.write("Elapsed: {}".format(elapsed))
+
+    def run_benchmark(self, results, name, func, items=None, setup=None, repeat=1):
+        """
+        Run & record a single benchmark
+        :param items: number of items (rows, pixels, tiles) processed by each call, or a function of the func result
+        :return: result of the last call
+        """
+        self.stderr.write("--> {}...".format(name))
+        timings, result = time_function(func, repeat, setup)
+        if callable(items):
+            items = items(result)
+        results.append(get_result(name, timings, items))
+        self.stderr.write("    {:.3f}s (min)".format(min(timings)))
+        return result
+
+    def run_benchmarks(self, working_directory, options):
+        results = []
+        repeat = options["repeat"]
+        generate_options = {"center": tuple(options["center"]),
+                            "spread_meters": options["spread_meters"],
+                            "distribution": options["distribution"],
+                            "value_mean": options["value_mean"],
+                            "value_stddev": options["value_stddev"],
+                            "track_seed": options["seed"]}
+
+        # generate data
+        # --> the second csv shares the locations of the first, for layer comparison
+        csv_filepaths = []
+        for value_seed in (options["seed"], options["seed"] + 1):
+            filepath = os.path.join(working_directory, "drive-test-{}.csv".format(value_seed))
+            csv_filepaths.append(filepath)
+            self.run_benchmark(results, "generate_drive_test_csv",
+                               lambda: generate_drive_test_csv(filepath, options["rows"], value_seed=value_seed, **generate_options),
+                               items=options["rows"])
+        geojson_filepath = os.path.join(working_directory, "features.geojson")
+        self.run_benchmark(results, "generate_geojson",
+                           lambda: generate_geojson(geojson_filepath, options["features"], tuple(options["center"]),
+                                                    options["spread_meters"], options["seed"]),
+                           items=options["features"])
+
+        # load
+        layers = []
+        for filepath in csv_filepaths:
+            value_fieldname, raster_data = self.run_benchmark(results, "rasterize_csv",
+                                                              lambda: rasterize_csv(filepath,
+                                                                                    options["pixel_size"],
+                                                                                    value_idx=CSV_VALUE_IDX,
+                                                                                    lon_idx=CSV_LON_IDX,
+                                                                                    lat_idx=CSV_LAT_IDX,
+                                                                                    raster_srid=settings.METERS_SRID),
+                                                              items=options["rows"],
+                                                              repeat=repeat)
+            load_options = {"name": None,
+                            "filepath": filepath,
+                            "opacity": 0.75,
+                            "pixel_size": options["pixel_size"],
+                            "minimum_samples": None}
+            layer, pixel_count = self.run_benchmark(results, "load_to_raster_layer",
+                                                    lambda: load_to_raster_layer(raster_data, load_options, value_fieldname),
+                                                    items=len(raster_data),
+                                                    repeat=repeat)
+            layers.append((layer, pixel_count))
+
+        self.run_benchmark(results, "load_raster_csv",
+                           lambda: load_raster_csv(csv_filepaths[0], None, "utf8", options["pixel_size"], settings.WGS84_SRID,
+                                                   [CSV_VALUE_IDX], CSV_LON_IDX, CSV_LAT_IDX, 0, CSV_DATETIME_FORMAT, 0.75),
+                           items=lambda result: result[1],
+                           repeat=repeat)
+
+        # layer operations
+        for layer, pixel_count in layers:
+            legend_name = "{} Legend".format(str(layer))
+            layer.legend = self.run_benchmark(results, "auto_create_legend",
+                                              layer.auto_create_legend,
+                                              setup=lambda: ScaledColorLegend.objects.filter(name=legend_name).delete(),
+                                              repeat=repeat)
+            layer.save()
+            self.run_benchmark(results, "get_center",
+                               lambda: layer.get_center(recalculate=True),
+                               items=pixel_count,
+                               repeat=repeat)
+        layers = [layer for layer, pixel_count in layers]
+        for method_name in ("diff", "percentage"):
+            self.run_benchmark(results, "compare_raster_layers ({})".format(method_name),
+                               lambda: VALID_METHODS[method_name](layers[0], layers[1], options["minimum_samples"]),
+                               items=lambda result: result[1],
+                               repeat=repeat)
+
+        # rendering
+        layer = RasterAggregatedLayer.objects.get(id=layers[0].id)
+        layername = str(layer.id)
+        zoom = options["zoom"]
+        tile_index = layer.update_tile_index()
+        if zoom > tile_index.max_zoom:
+            raise CommandError("--zoom({}) exceeds the layer tile index max zoom({})".format(zoom, tile_index.max_zoom))
+        tilemgr = get_tile_layer_manager(layername)
+        tile_random = random.Random(options["seed"])
+        tile_xys = sorted(tile_index.tiles(zoom))
+        tile_xys = tile_random.sample(tile_xys, min(options["tiles"], len(tile_xys)))
+
+        def render_tiles():
+            for tilex, tiley in tile_xys:
+                tile_image = tilemgr.get_metatile(layername, zoom, tilex, tiley, metatile_size=1)[(tilex, tiley)]
+                encode_tile(tile_image, "png")
+        self.run_benchmark(results, "render_tile", render_tiles, items=len(tile_xys), repeat=repeat)
+
+        def render_metatiles():
+            tile_count = 0
+            for tilex, tiley in tile_xys:
+                tile_count += len(render_metatile(tilemgr, layername, zoom, tilex, tiley, "png", tile_index))
+            return tile_count
+        self.run_benchmark(results, "render_metatile", render_metatiles, items=lambda tile_count: tile_count, repeat=repeat)
+
+        value_random = random.Random(options["seed"])
+        values = [value_random.gauss(options["value_mean"], options["value_stddev"]) for _ in range(options["color_values"])]
+        for legend in (layer.legend, ScaledColorLegend(name="benchmark diff",
+                                                       minimum_value=-options["value_stddev"],
+                                                       maximum_value=options["value_stddev"],
+                                                       color_manager_class="ScaledDiffColorManager")):
+            color_manager = legend.get_color_manager()
+            self.run_benchmark(results, "color_manager ({})".format(legend.color_manager_class),
+                               lambda: [color_manager.value_to_rgb(value) for value in values],
+                               items=len(values),
+                               repeat=repeat)
+
+        # vector
+        geojson_layer = self.run_benchmark(results, "load_geojson_layer",
+                                           lambda: load_geojson_layer(geojson_filepath, 0.75),
+                                           items=options["features"])
+        lon_spread, lat_spread = meters_to_degrees(options["spread_meters"], options["center"][1])
+        bbox = "{},{},{},{}".format(options["center"][0] - lon_spread, options["center"][1] - lat_spread,
+                                    options["center"][0] + lon_spread, options["center"][1] + lat_spread)
+        request_factory = RequestFactory()
+        for content_encoding in ("identity", "gzip"):
+            request = request_factory.get(geojson_layer.get_absolute_url(), {"bbox": bbox}, HTTP_ACCEPT_ENCODING=content_encoding)
+            response = self.run_benchmark(results, "get_objects ({})".format(content_encoding),
+                                          lambda: get_objects(request, layer_id=geojson_layer.id),
+                                          repeat=repeat)
+            results[-1]["bytes"] = len(response.content)
+        return results
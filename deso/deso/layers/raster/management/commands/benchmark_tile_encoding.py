@@ -0,0 +1,77 @@
+"""
+Compare tile encoding size and time (RGBA png, 8-bit palette png, webp) for tiles rendered from a RasterAggregatedLayer.
+"""
+import time
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from ...models import RasterAggregatedLayer
+from ...tiles import get_tile_layer_manager, encode_tile, palette_to_rgba, is_empty_tile_image
+
+DEFAULT_ZOOM = 14
+DEFAULT_METATILES = 10
+
+
+# (name, image mode, image encoding), 'RGBA' images are converted from the rendered (palette) tiles before timing
+ENCODERS = (
+    ("png (rgba)", "RGBA", "png"),
+    ("png (palette)", None, "png"),
+    ("webp", None, "webp"),
+)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i", "--id",
+                            type=int,
+                            required=True,
+                            help="RasterAggregatedLayer id to render tiles from")
+        parser.add_argument("-z", "--zoom",
+                            type=int,
+                            default=DEFAULT_ZOOM,
+                            help="Zoom level of rendered tiles [DEFAULT={}]".format(DEFAULT_ZOOM))
+        parser.add_argument("-n", "--metatiles",
+                            type=int,
+                            default=DEFAULT_METATILES,
+                            help="Number of (randomly selected, occupied) metatiles to render [DEFAULT={}]".format(DEFAULT_METATILES))
+
+    def handle(self, *args, **options):
+        try:
+            layer = RasterAggregatedLayer.objects.get(id=options["id"])
+        except RasterAggregatedLayer.DoesNotExist:
+            raise CommandError("Given RasterAggregatedLayer({}) Does Not Exist!".format(options["id"]))
+        tile_index = layer.get_tile_index()
+        if tile_index is None:
+            raise CommandError("RasterAggregatedLayer({}) has no tile index, run 'update_raster_tile_index'".format(layer.id))
+        zoom = options["zoom"]
+        size = min(settings.RASTER_METATILE_SIZE, 2 ** zoom)
+        origins = sorted(set(((x // size) * size, (y // size) * size) for x, y in tile_index.tiles(zoom)))
+        origins = random.sample(origins, min(options["metatiles"], len(origins)))
+
+        layername = str(layer.id)
+        tilemgr = get_tile_layer_manager(layername)
+        tile_images = []
+        for tilex, tiley in origins:
+            tile_images.extend(tile for tile in tilemgr.get_metatile(layername, zoom, tilex, tiley).values()
+                               if not is_empty_tile_image(tile))
+        if not tile_images:
+            raise CommandError("No non-empty tiles rendered at zoom({})".format(zoom))
+        self.stdout.write("RasterAggregatedLayer: [{}] {}".format(layer.id, layer.name))
+        self.stdout.write("Zoom({}) Tiles({}) Image Mode({})".format(zoom, len(tile_images), tile_images[0].mode))
+
+        images = {None: tile_images,
+                  "RGBA": [palette_to_rgba(tile_image) if tile_image.mode == "P" else tile_image for tile_image in tile_images]}
+        self.stdout.write("{:<16}{:>14}{:>14}{:>16}".format("encoding", "bytes/tile", "ms/tile", "total bytes"))
+        for name, image_mode, image_encoding in ENCODERS:
+            total_bytes = 0
+            start = time.perf_counter()
+            for tile_image in images[image_mode]:
+                total_bytes += len(encode_tile(tile_image, image_encoding))
+            elapsed = time.perf_counter() - start
+            self.stdout.write("{:<16}{:>14}{:>14.3f}{:>16}".format(name,
+                                                                   total_bytes // len(tile_images),
+                                                                   elapsed / len(tile_images) * 1000,
+                                                                   total_bytes))
@@ -0,0 +1,25 @@
+"""
+Remove stored tile images no longer referenced by any cached tile.
+(Tile images are stored once by content and shared by identical tiles, removing a layer's tiles leaves the images in place)
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.core.cache import caches
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-a", "--minimum-age",
+                            type=int,
+                            default=60 * 60,
+                            help="Only remove images not modified within this number of seconds [DEFAULT=3600]")
+
+    def handle(self, *args, **options):
+        cache = caches["tilecache"]
+        if not hasattr(cache, "remove_unreferenced_blobs"):
+            raise CommandError("Configured 'tilecache' backend does not store content-addressed tiles: {}".format(cache.__class__.__name__))
+        self.stdout.write("Removing unreferenced tile images...")
+        kept, removed = cache.remove_unreferenced_blobs(options["minimum_age"])
+        self.stdout.write("--> kept({}) removed({})".format(kept, removed))
+        self.stdout.write("Done!")
@@ -0,0 +1,57 @@
+"""
+Rewrite the pixels of existing RasterAggregatedLayer objects in Morton (Z-order) order of their grid index,
+so that the pixels of each tile are stored in a few contiguous table pages (see deso/layers/raster/clustering.py).
+Layers created by 'create_raster_layer' are written in this order, 'load_raster_csv' layers per loaded chunk.
+
+NOTE: The pixels of a layer are locked while rewritten, and the replaced rows are removed by VACUUM ('--vacuum').
+"""
+import datetime
+from django.core.management.base import BaseCommand
+from django.db import transaction, connections
+from ...models import RasterAggregatedLayer
+from ...clustering import recluster_layer
+from ...partitions import is_partitioned, get_partition_name
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i", "--ids",
+                            type=int,
+                            default=None,
+                            nargs="+",
+                            help="RasterAggregatedLayer ids to cluster [DEFAULT=All Layers]")
+        parser.add_argument("--vacuum",
+                            default=False,
+                            action="store_true",
+                            help="If given, the pixel table (or layer partition) is vacuumed after each layer is rewritten")
+
+    def handle(self, *args, **options):
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        layers = RasterAggregatedLayer.objects.order_by("id")
+        if options["ids"]:
+            layers = layers.filter(id__in=options["ids"])
+        for layer in layers:
+            if layer.is_columnar:
+                self.stdout.write("Skipping columnar RasterAggregatedLayer (stored in block order): [{}] {}".format(layer.id, layer.name))
+                continue
+            self.stdout.write("Clustering RasterAggregatedLayer: [{}] {} ({})...".format(layer.id, layer.name, layer.pixel_database))
+            with transaction.atomic(using=layer.pixel_database):
+                count = recluster_layer(layer)
+            self.stdout.write("--> ({}) pixels rewritten".format(count))
+            if options["vacuum"]:
+                DataModel = layer.get_data_model()
+                table = DataModel._meta.db_table
+                if is_partitioned(DataModel, layer.pixel_database):
+                    table = get_partition_name(table, layer.id)
+                connection = connections[layer.pixel_database]
+                with connection.cursor() as cursor:
+                    # VACUUM cannot run within a transaction (commands run in autocommit mode)
+                    cursor.execute("VACUUM ANALYZE {}".format(connection.ops.quote_name(table)))
+                self.stdout.write("--> vacuumed: {}".format(table))
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        elapsed = end - start
+        self.stdout.write("Elapsed: {}".format(elapsed))
@@ -4,9 +4,12 @@ Functions for generating a new RasterAggregatedLayer object by comparing existin
 import datetime
 from functools import partial
 from django.contrib.gis.geos import GEOSGeometry
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.conf import settings
-from ...models import RasterAggregatedLayer, NumericRasterAggregateData
+from deso import metrics
+from deso.profiling import ProfiledCommand, phase, progress
+from ...models import RasterAggregatedLayer, NumericRasterAggregateData, bulk_create_pixels
+from ...clustering import sort_pixels
 
 WGS84_SRID = settings.WGS84_SRID
 
@@ -32,9 +35,7 @@ def diff(layer_one, layer_two, minimum_samples, fill_value=None, gte_value=None,
                                        minimum_samples=minimum_samples)
     diff_layer.save()
     # expect that x,y is unique in layer
-    first_queryset = layer_one.pixels()
-    second_queryset = layer_two.pixels()
-
+    # (pixels are read with get_pixel_values(), from the pixel table or the columnar layer file)
     kwargs = {"samples__gte": minimum_samples}
     if gte_value is not None:
         kwargs["{}__gte".format(layer_one.value_fieldname)] = gte_value
@@ -42,19 +43,16 @@ def diff(layer_one, layer_two, minimum_samples, fill_value=None, gte_value=None,
         kwargs["{}__lte".format(layer_one.value_fieldname)] = lte_value
 
     # get locations that meet the criteria from both layers
-    ewkt_locations = set(p.ewkt for p in first_queryset.filter(**kwargs).values_list("location", flat=True))
-    ewkt_locations.update(set(p.ewkt for p in second_queryset.filter(**kwargs).values_list("location", flat=True)))
-
-    # reinstantiate querysets after gathering locations
-    first_queryset = layer_one.pixels()
-    second_queryset = layer_two.pixels()
+    with phase("locations"):
+        ewkt_locations = set(p.ewkt for p, in layer_one.get_pixel_values((), **kwargs))
+        ewkt_locations.update(set(p.ewkt for p, in layer_two.get_pixel_values((), **kwargs)))
 
     # ignore extra kwargs in order to get locations that match both layers!
-    first_values = {location.ewkt: value for location, value in first_queryset.filter(samples__gte=minimum_samples).values_list("location", layer_one.value_fieldname) if location.ewkt in ewkt_locations}
+    first_values = {location.ewkt: value for location, value in layer_one.get_pixel_values([layer_one.value_fieldname], samples__gte=minimum_samples) if location.ewkt in ewkt_locations}
     diff_data_items = []
     count = 0
     filled_locations = []
-    for location, second_samples, second_value in second_queryset.filter(samples__gte=minimum_samples).values_list("location", "samples", layer_one.value_fieldname):
+    for location, second_samples, second_value in layer_two.get_pixel_values(["samples", layer_one.value_fieldname], samples__gte=minimum_samples):
         if location.ewkt in first_values:
             if absolute:
                 diff_value = abs(first_values[location.ewkt] - second_value)
@@ -69,7 +67,8 @@ def diff(layer_one, layer_two, minimum_samples, fill_value=None, gte_value=None,
             filled_locations.append(location.ewkt)
 
             if len(diff_data_items) > COMMIT_COUNT:
-                NumericRasterAggregateData.objects.bulk_create(diff_data_items)
+                bulk_create_pixels(sort_pixels(diff_data_items, layer_one.pixel_size_meters))
+                progress("pixels", len(diff_data_items))
                 diff_data_items = []
 
     if fill_value is not None:
@@ -85,11 +84,15 @@ def diff(layer_one, layer_two, minimum_samples, fill_value=None, gte_value=None,
 
     # commit remaining
     if diff_data_items:
-        NumericRasterAggregateData.objects.bulk_create(diff_data_items)
+        bulk_create_pixels(sort_pixels(diff_data_items, layer_one.pixel_size_meters))
+        progress("pixels", len(diff_data_items))
 
-    if not NumericRasterAggregateData.objects.filter(layer=diff_layer).exists():
+    if not diff_layer.pixels().exists():
         raise NoOverlapingData("Diff layer contains no Data! (check that both input layers can be displayed on map after removing browser cache)")
 
+    with phase("tile index"):
+        diff_layer.update_tile_index()
+
     # auto-create legend
     if absolute:
         legend = diff_layer.auto_create_legend(more_is_better=False,
@@ -98,7 +101,8 @@ def diff(layer_one, layer_two, minimum_samples, fill_value=None, gte_value=None,
         legend = diff_layer.auto_create_legend(more_is_better=True,
                                                color_manager_class="ScaledDiffColorManager")
     diff_layer.legend = legend
-    diff_layer.save()
+    # only the legend is saved, data_version is incremented in the database by bulk_create_pixels()
+    diff_layer.save(update_fields=["legend"])
 
     # create MapLayer (for viewing)
     diff_layer.create_map_layer()
@@ -123,9 +127,7 @@ def percentage(layer_one, layer_two, minimum_samples, fill_value=None, gte_value
                                        minimum_samples=minimum_samples)
     compare_layer.save()
     # expect that x,y is unique in layer
-    first_queryset = layer_one.pixels()
-    second_queryset = layer_two.pixels()
-
+    # (pixels are read with get_pixel_values(), from the pixel table or the columnar layer file)
     kwargs = {"samples__gte": minimum_samples}
     if gte_value is not None:
         kwargs["{}__gte".format(layer_one.value_fieldname)] = gte_value
@@ -133,19 +135,16 @@ def percentage(layer_one, layer_two, minimum_samples, fill_value=None, gte_value
         kwargs["{}__lte".format(layer_one.value_fieldname)] = lte_value
 
     # get locations that meet the criteria from both layers
-    ewkt_locations = set(p.ewkt for p in first_queryset.filter(**kwargs).values_list("location", flat=True))
-    ewkt_locations.update(set(p.ewkt for p in second_queryset.filter(**kwargs).values_list("location", flat=True)))
-
-    # reinstantiate querysets
-    first_queryset = layer_one.pixels()
-    second_queryset = layer_two.pixels()
+    with phase("locations"):
+        ewkt_locations = set(p.ewkt for p, in layer_one.get_pixel_values((), **kwargs))
+        ewkt_locations.update(set(p.ewkt for p, in layer_two.get_pixel_values((), **kwargs)))
 
     # ignore extra kwargs in order to get locations that match both layers!
-    first_values = {location.ewkt: sample_count for location, sample_count in first_queryset.filter(samples__gte=minimum_samples).values_list("location", "samples") if location.ewkt in ewkt_locations}
+    first_values = {location.ewkt: sample_count for location, sample_count in layer_one.get_pixel_values(["samples"], samples__gte=minimum_samples) if location.ewkt in ewkt_locations}
     data_items = []
     count = 0
     filled_locations = []
-    for location, second_samples in second_queryset.filter(samples__gte=minimum_samples).values_list("location", "samples"):
+    for location, second_samples in layer_two.get_pixel_values(["samples"], samples__gte=minimum_samples):
         if location.ewkt in first_values:
             if first_values[location.ewkt] > 0:
                 percentage_value = round((second_samples/first_values[location.ewkt]) * 100, 2)
@@ -158,7 +157,8 @@ def percentage(layer_one, layer_two, minimum_samples, fill_value=None, gte_value
                 filled_locations.append(location.ewkt)
 
                 if len(data_items) > COMMIT_COUNT:
-                    NumericRasterAggregateData.objects.bulk_create(data_items)
+                    bulk_create_pixels(sort_pixels(data_items, layer_one.pixel_size_meters))
+                    progress("pixels", len(data_items))
                     data_items = []
 
     if fill_value is not None:
@@ -173,13 +173,18 @@ def percentage(layer_one, layer_two, minimum_samples, fill_value=None, gte_value
 
     # commit remaining
     if data_items:
-        NumericRasterAggregateData.objects.bulk_create(data_items)
+        bulk_create_pixels(sort_pixels(data_items, layer_one.pixel_size_meters))
+        progress("pixels", len(data_items))
+
+    with phase("tile index"):
+        compare_layer.update_tile_index()
 
     # auto-create legend
     legend = compare_layer.auto_create_legend(more_is_better=False,
                                               color_manager_class="ScaledFloatColorManager")
     compare_layer.legend = legend
-    compare_layer.save()
+    # only the legend is saved, data_version is incremented in the database by bulk_create_pixels()
+    compare_layer.save(update_fields=["legend"])
 
     # create MapLayer (for viewing)
     compare_layer.create_map_layer()
@@ -192,7 +197,7 @@ VALID_METHODS = {"diff": diff,
                  "absdiff": partial(diff, absolute=True),
                  "percentage": percentage}
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     help = __doc__
 
     def add_arguments(self, parser):
@@ -251,8 +256,10 @@ class Command(BaseCommand):
         if options["value_lte"]:
             self.stdout.write("(FIRST LAYER VALUE) <= {0} OR (SECOND LAYER VALUE) <= {0} ".format(options["value_lte"]))
 
-        layer, count = compare_function(layer_one, layer_two, options["minimum_samples"], options["fill_value"], gte_value=options["value_gte"], lte_value=options["value_lte"])
+        with phase("compare"):
+            layer, count = compare_function(layer_one, layer_two, options["minimum_samples"], options["fill_value"], gte_value=options["value_gte"], lte_value=options["value_lte"])
         self.stdout.write("--> NumericRasterAggregateData({}) entries created!".format(count))
+        metrics.record_ingest("compare_raster_layers", count, (datetime.datetime.now() - start).total_seconds())
         end = datetime.datetime.now()
         self.stdout.write("End: {}".format(end))
         elapsed = end - start
@@ -0,0 +1,65 @@
+"""
+Convert database RasterAggregatedLayer objects (NumericRasterAggregateData) to columnar layers,
+storing the layer pixels in a memory-mapped file (see deso/layers/raster/columnar.py) and removing the database pixels.
+Intended for read-mostly (analysis) layers, tiles of columnar layers are rendered without database queries.
+"""
+import copy
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from ...models import RasterAggregatedLayer, increment_data_versions
+from ...columnar import write_columnar_layer, VALUE_FIELDNAMES
+from ...tiles import clear_layer_tiles
+from .remove_raster_layers import delete_layer_pixels, DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i", "--ids",
+                            type=int,
+                            default=None,
+                            required=True,
+                            nargs="+",
+                            help="RasterAggregatedLayer ids to convert.")
+        parser.add_argument("--keep-pixels",
+                            default=False,
+                            action="store_true",
+                            help="If given, the layer's database pixels are not removed")
+
+    def handle(self, *args, **options):
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        for layer in RasterAggregatedLayer.objects.filter(id__in=options["ids"]).order_by("id"):
+            if layer.is_columnar:
+                self.stdout.write("Skipping (already columnar): [{}] {}".format(layer.id, layer.name))
+                continue
+            if layer.data_model != "NumericRasterAggregateData":
+                raise CommandError("Only NumericRasterAggregateData layers can be converted: [{}] {}".format(layer.id, layer.name))
+            if layer.value_fieldname not in VALUE_FIELDNAMES:
+                raise CommandError("Layer aggregation_method({}) not stored in columnar layers ({}): [{}] {}".format(layer.value_fieldname,
+                                                                                                                   ", ".join(VALUE_FIELDNAMES),
+                                                                                                                   layer.id,
+                                                                                                                   layer.name))
+            self.stdout.write("Converting RasterAggregatedLayer: [{}] {}...".format(layer.id, layer.name))
+            pixel_values = ((location.x, location.y, dict(zip(VALUE_FIELDNAMES, values)))
+                            for location, *values in layer.get_pixel_values(VALUE_FIELDNAMES))
+            pixel_count = write_columnar_layer(layer.get_columnar_filepath(), layer.pixel_size_meters, pixel_values)
+            self.stdout.write("--> ({}) pixels written: {}".format(pixel_count, layer.get_columnar_filepath()))
+
+            # switch to the (complete) columnar file before the database pixels are removed,
+            # so that the layer is never served without pixels
+            database_layer = copy.copy(layer)
+            layer.data_model = "ColumnarRasterData"
+            layer.save(update_fields=["data_model"])
+            increment_data_versions([layer.id])
+            clear_layer_tiles(layer.id)
+            if not options["keep_pixels"]:
+                deleted = delete_layer_pixels(database_layer, DEFAULT_CHUNK_SIZE, write=self.stdout.write)
+                if deleted is None:
+                    self.stdout.write("--> pixel partition dropped")
+            self.stdout.write("Done!")
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        elapsed = end - start
+        self.stdout.write("Elapsed: {}".format(elapsed))
@@ -8,11 +8,15 @@ import csv
 import sys
 import gzip
 import datetime
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.contrib.gis.geos import Point, GEOSGeometry
 from django.conf import settings
+from deso import metrics
+from deso.profiling import ProfiledCommand, phase, progress, PROGRESS_ROWS
 from .....functions  import WelfordRunningVariance, WelfordRunningVariancedB
-from ...models import RasterAggregatedLayer, NumericRasterAggregateData
+from ...models import RasterAggregatedLayer, NumericRasterAggregateData, bulk_create_pixels
+from ...clustering import get_pixel_morton_key
+from ...columnar import write_columnar_layer
 
 WGS84_SRID = 4326
 SPHERICAL_MERCATOR_SRID = 3857 # google maps projection
@@ -30,8 +34,9 @@ def load_to_raster_layer(raster_data, options, kpi_name):
         layer_name = options["name"]
     else:
         layer_name = "{} ({})".format(os.path.split(options["filepath"])[-1], kpi_name)
+    columnar = options.get("columnar", False)
     layer = RasterAggregatedLayer(filepath=options["filepath"],
-                                  data_model="NumericRasterAggregateData",
+                                  data_model="ColumnarRasterData" if columnar else "NumericRasterAggregateData",
                                   name=layer_name,
                                   opacity=options["opacity"],
                                   aggregation_method=default_aggregation_method,
@@ -42,11 +47,29 @@ def load_to_raster_layer(raster_data, options, kpi_name):
     source_file_datetime = datetime.datetime.fromtimestamp(os.path.getmtime(options["filepath"]))
     count = 0
     numeric_data = []
+    pixel_locations = []
     for pixel_key_ewkt, welford_object in raster_data.items():
         # skip if minimum samples condition is not met
         if options["minimum_samples"] and welford_object.count() < options["minimum_samples"]:
             continue
-        pixel_location = GEOSGeometry(pixel_key_ewkt)
+        pixel_locations.append((GEOSGeometry(pixel_key_ewkt), welford_object))
+    if columnar:
+        # write pixels to the layer's memory-mapped file (see columnar.py)
+        count = write_columnar_layer(layer.get_columnar_filepath(),
+                                     options["pixel_size"],
+                                     ((location.x, location.y, {"samples": welford_object.count(),
+                                                                "mean": welford_object.mean(),
+                                                                "variance": welford_object.var(),
+                                                                "stddev": welford_object.stddev(),
+                                                                "sum": welford_object.sum(),
+                                                                "maximum": welford_object.max(),
+                                                                "minimum": welford_object.min()})
+                                      for location, welford_object in pixel_locations))
+        progress("pixels", count)
+        return layer, count
+    # write pixels in morton order, so that the pixels of a tile are stored together (see clustering.py)
+    pixel_locations.sort(key=lambda item: get_pixel_morton_key(item[0].x, item[0].y, options["pixel_size"]))
+    for pixel_location, welford_object in pixel_locations:
         data = NumericRasterAggregateData(layer=layer,
                                           location=pixel_location,
                                           dt=source_file_datetime,
@@ -60,11 +83,13 @@ def load_to_raster_layer(raster_data, options, kpi_name):
         numeric_data.append(data)
         count += 1
         if len(numeric_data) >= COMMIT_COUNT:
-            NumericRasterAggregateData.objects.bulk_create(numeric_data)
+            bulk_create_pixels(numeric_data)
+            progress("pixels", len(numeric_data))
             numeric_data = []
     # commit remaining
     if numeric_data:
-        NumericRasterAggregateData.objects.bulk_create(numeric_data)
+        bulk_create_pixels(numeric_data)
+        progress("pixels", len(numeric_data))
     return layer, count
 
 
@@ -106,7 +131,9 @@ def rasterize_csv(csv_file, pixel_size_meters=5, csv_srid=WGS84_SRID, raster_sri
         else:
             value_fieldname = "Unknown (no-headers)"
 
-        for line in reader:
+        for line_number, line in enumerate(reader, 1):
+            if line_number % PROGRESS_ROWS == 0:
+                progress("rows", PROGRESS_ROWS)
             point = get_lonlat_point(line, lon_idx, lat_idx, csv_srid)
             # convert to meters srid
             point.transform(raster_srid)
@@ -125,7 +152,7 @@ def rasterize_csv(csv_file, pixel_size_meters=5, csv_srid=WGS84_SRID, raster_sri
     return value_fieldname, raster_data
 
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     help = __doc__
 
     def add_arguments(self, parser):
@@ -178,6 +205,10 @@ class Command(BaseCommand):
                             default=False,
                             action="store_true",
                             help="If given the first line will be *included* as data")
+        parser.add_argument("--columnar",
+                            default=False,
+                            action="store_true",
+                            help="If given, pixels are stored in a memory-mapped columnar file instead of the database (read-mostly layers)")
 
 
     def handle(self, *args, **options):
@@ -194,29 +225,39 @@ class Command(BaseCommand):
         self.stdout.write("Opacity: {}".format(options["opacity"]))
         if options["ifequals"]:
             self.stdout.write("Only using values: {}".format(options["ifequals"]))
-        value_fieldname, raster_data = rasterize_csv(options["filepath"],
-                                    options["pixel_size"],
-                                    options["csv_srid"],
-                                    settings.METERS_SRID,
-                                    options["index"],
-                                    options["lon_idx"],
-                                    options["lat_idx"],
-                                    options["ifequals"],
-                                    options["decibels"],
-                                    options["no_headers"],
-                                    )
-        self.stdout.write("Loading aggregated data to database...")
-        layer, pixel_count = load_to_raster_layer(raster_data, options, value_fieldname)
+        with phase("rasterize"):
+            value_fieldname, raster_data = rasterize_csv(options["filepath"],
+                                                         options["pixel_size"],
+                                                         options["csv_srid"],
+                                                         settings.METERS_SRID,
+                                                         options["index"],
+                                                         options["lon_idx"],
+                                                         options["lat_idx"],
+                                                         options["ifequals"],
+                                                         options["decibels"],
+                                                         options["no_headers"],
+                                                         )
+        self.stdout.write("Loading aggregated data to {}...".format("columnar file" if options["columnar"] else "database"))
+        with phase("load"):
+            layer, pixel_count = load_to_raster_layer(raster_data, options, value_fieldname)
+        metrics.record_ingest("create_raster_layer", pixel_count, (datetime.datetime.now() - start).total_seconds())
+
+        self.stdout.write("Creating Tile Index...")
+        with phase("tile index"):
+            layer.update_tile_index()
 
         # create legend
         self.stdout.write("Creating Related Legend...")
-        legend = layer.auto_create_legend()
-        layer.legend = legend
-        layer.save()
+        with phase("legend"):
+            legend = layer.auto_create_legend()
+            layer.legend = legend
+            # only the legend is saved, data_version is incremented in the database by bulk_create_pixels()
+            layer.save(update_fields=["legend"])
 
         # create map layer
         self.stdout.write("Creating MapLayer() object for viewing...")
-        layer.create_map_layer()
+        with phase("map layer"):
+            layer.create_map_layer()
 
         end = datetime.datetime.now()
         self.stdout.write("End: {}".format(end))
@@ -0,0 +1,193 @@
+"""
+Render a RasterAggregatedLayer to an MBTiles (SQLite) archive for the given zoom range.
+Optionally set the archive as the layer's tile source (--archive) and remove the layer's pixel data (--drop-pixels).
+"""
+import os
+import time
+import datetime
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
+from ...models import RasterAggregatedLayer, increment_data_versions
+from ...mbtiles import MBTilesWriter
+from ...tiles import get_tile_layer_manager, get_empty_tile, render_metatile, clear_layer_tiles
+
+DEFAULT_MIN_ZOOM = 0
+DEFAULT_MAX_ZOOM = 16
+IMAGE_ENCODING = "png"
+
+# per worker process state, set by _initialize_worker()
+_WORKER_STATE = {}
+
+
+def _initialize_worker(layer_id, tile_index):
+    _WORKER_STATE["layername"] = str(layer_id)
+    _WORKER_STATE["tile_index"] = tile_index
+    _WORKER_STATE["tilemgr"] = get_tile_layer_manager(str(layer_id))
+
+
+def _render_metatile_worker(metatile):
+    """
+    :param metatile: (zoom, origin tilex, origin tiley)
+    :return: [(zoom, tilex, tiley, encoded tile bytes), ...] for non-empty tiles
+    """
+    zoom, tilex, tiley = metatile
+    encoded_tiles = render_metatile(_WORKER_STATE["tilemgr"],
+                                    _WORKER_STATE["layername"],
+                                    zoom,
+                                    tilex,
+                                    tiley,
+                                    IMAGE_ENCODING,
+                                    _WORKER_STATE["tile_index"])
+    empty_tile = get_empty_tile(IMAGE_ENCODING)
+    # empty tiles are not stored, the tile view serves the shared empty tile for tiles not in the archive
+    return [(zoom, x, y, content) for (x, y), content in encoded_tiles.items() if content != empty_tile]
+
+
+def get_metatile_origins(tile_index, zoom, metatile_size):
+    """
+    :return: sorted list of (zoom, origin tilex, origin tiley) for metatiles containing occupied tiles
+    """
+    size = min(metatile_size, 2 ** zoom)
+    origins = set(((x // size) * size, (y // size) * size) for x, y in tile_index.tiles(zoom))
+    return [(zoom, x, y) for x, y in sorted(origins)]
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i", "--id",
+                            type=int,
+                            required=True,
+                            help="RasterAggregatedLayer id to export")
+        parser.add_argument("-o", "--output",
+                            default=None,
+                            help="Output MBTiles filepath [DEFAULT=<settings.RASTER_MBTILES_DIRECTORY>/raster-<id>.mbtiles]")
+        parser.add_argument("--min-zoom",
+                            type=int,
+                            default=DEFAULT_MIN_ZOOM,
+                            help="Minimum zoom level to export [DEFAULT={}]".format(DEFAULT_MIN_ZOOM))
+        parser.add_argument("--max-zoom",
+                            type=int,
+                            default=DEFAULT_MAX_ZOOM,
+                            help="Maximum zoom level to export [DEFAULT={}]".format(DEFAULT_MAX_ZOOM))
+        parser.add_argument("-w", "--workers",
+                            type=int,
+                            default=multiprocessing.cpu_count(),
+                            help="Number of rendering processes [DEFAULT={}]".format(multiprocessing.cpu_count()))
+        parser.add_argument("--archive",
+                            default=False,
+                            action="store_true",
+                            help="If given, the layer's tiles will be served from the resulting archive")
+        parser.add_argument("--drop-pixels",
+                            default=False,
+                            action="store_true",
+                            help="If given (with --archive), the layer's pixel data is removed from the database after export")
+
+    def handle(self, *args, **options):
+        try:
+            layer = RasterAggregatedLayer.objects.get(id=options["id"])
+        except RasterAggregatedLayer.DoesNotExist:
+            raise CommandError("Given RasterAggregatedLayer({}) Does Not Exist!".format(options["id"]))
+        if layer.legend is None:
+            raise CommandError("RasterAggregatedLayer({}) has no legend, tiles cannot be rendered!".format(layer.id))
+        if layer.archive_filepath:
+            raise CommandError("RasterAggregatedLayer({}) is already archived: {}".format(layer.id, layer.archive_filepath))
+        if options["drop_pixels"] and not options["archive"]:
+            raise CommandError("--drop-pixels requires --archive")
+        min_zoom = options["min_zoom"]
+        max_zoom = options["max_zoom"]
+        if not 0 <= min_zoom <= max_zoom:
+            raise CommandError("Invalid zoom range: {}-{}".format(min_zoom, max_zoom))
+
+        output_filepath = options["output"]
+        if not output_filepath:
+            output_filepath = os.path.join(settings.RASTER_MBTILES_DIRECTORY, "raster-{}.mbtiles".format(layer.id))
+        output_filepath = os.path.abspath(output_filepath)
+        if os.path.exists(output_filepath):
+            raise CommandError("Output file already exists: {}".format(output_filepath))
+
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        self.stdout.write("RasterAggregatedLayer: [{}] {}".format(layer.id, layer.name))
+        self.stdout.write("Output: {}".format(output_filepath))
+        self.stdout.write("Zooms: {}-{}".format(min_zoom, max_zoom))
+
+        tile_index = layer.get_tile_index()
+        if tile_index is None:
+            self.stdout.write("Creating Tile Index...")
+            tile_index = layer.update_tile_index()
+        if max_zoom > tile_index.max_zoom:
+            raise CommandError("--max-zoom({}) exceeds the layer tile index max zoom({})".format(max_zoom, tile_index.max_zoom))
+
+        # center & extent are stored/recorded before pixels may be dropped
+        center = layer.get_center()
+        extent = layer.extent()
+        metadata = {
+            "name": str(layer),
+            "description": "deso RasterAggregatedLayer({})".format(layer.id),
+            "type": "overlay",
+            "version": "1.0",
+            "format": IMAGE_ENCODING,
+            "minzoom": min_zoom,
+            "maxzoom": max_zoom,
+            "bounds": ",".join(str(round(v, 6)) for v in extent),
+        }
+        if center:
+            wgs84_center = center.transform(settings.WGS84_SRID, clone=True)
+            metadata["center"] = "{},{},{}".format(round(wgs84_center.x, 6), round(wgs84_center.y, 6), min_zoom)
+
+        metatiles = []
+        for zoom in range(min_zoom, max_zoom + 1):
+            metatiles.extend(get_metatile_origins(tile_index, zoom, settings.RASTER_METATILE_SIZE))
+        self.stdout.write("Rendering ({}) metatiles with ({}) workers...".format(len(metatiles), options["workers"]))
+
+        writer = MBTilesWriter(output_filepath, metadata)
+        tile_count = 0
+        initargs = (layer.id, tile_index)
+        pool = None
+        try:
+            if options["workers"] > 1:
+                # DB connections must not be shared with the forked worker processes
+                connections.close_all()
+                pool = multiprocessing.Pool(options["workers"], initializer=_initialize_worker, initargs=initargs)
+                results = pool.imap_unordered(_render_metatile_worker, metatiles, chunksize=4)
+            else:
+                _initialize_worker(*initargs)
+                results = (_render_metatile_worker(metatile) for metatile in metatiles)
+            for rendered_count, tiles in enumerate(results, 1):
+                writer.write_tiles(tiles)
+                tile_count += len(tiles)
+                if rendered_count % 100 == 0:
+                    self.stdout.write("--> {}/{} metatiles ({} tiles)".format(rendered_count, len(metatiles), tile_count))
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                # stop the workers if writing failed (no-op after join())
+                pool.terminate()
+            writer.close()
+        self.stdout.write("Wrote ({}) tiles".format(tile_count))
+
+        if options["archive"]:
+            self.stdout.write("Setting layer tile source to archive...")
+            layer.archive_filepath = output_filepath
+            layer.save(update_fields=["archive_filepath"])
+            increment_data_versions([layer.id])
+            clear_layer_tiles(layer.id)
+            if options["drop_pixels"]:
+                # other processes serve from their cached LayerTileState (without the archive) for up to
+                # RASTER_TILE_INDEX_CACHE_SECONDS, keep the pixels until their states have expired
+                self.stdout.write("Waiting ({}s) for cached layer tile states to expire...".format(settings.RASTER_TILE_INDEX_CACHE_SECONDS))
+                time.sleep(settings.RASTER_TILE_INDEX_CACHE_SECONDS)
+                self.stdout.write("Removing layer pixel data...")
+                layer.delete_pixels()
+
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        elapsed = end - start
+        self.stdout.write("Elapsed: {}".format(elapsed))
@@ -34,11 +34,9 @@ class Command(BaseCommand):
                             nargs="+",
                             default=[14,],
                             help="Zoom Level(s) to cache [DEFAULT=14]")
-        DEFAULT_RASTER_LAYERS_URL = "http://{}:{}/raster/layer/{{layer_id}}/".format(settings.HOST,
-                                                                             settings.PORT)
         parser.add_argument("-u", "--url",
-                            default=DEFAULT_RASTER_LAYERS_URL,
-                            help="Raster Layers URL to send requests to [DEFAULT='{}']".format(DEFAULT_RASTER_LAYERS_URL))
+                            default=None,
+                            help="Raster Layers URL to send requests to [DEFAULT='http://<HOST>:<PORT>/raster/layer/{layer_id}/']")
 
     def handle(self, *args, **options):
         layer_ids = sorted(options["layers"])
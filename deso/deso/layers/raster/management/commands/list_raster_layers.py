@@ -3,6 +3,7 @@ List the loaded RasterAggregatedLayer objects.
 """
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from deso.hosts import expand_url
 from ...models import RasterAggregatedLayer
 
 WGS84_SRID = settings.WGS84_SRID
@@ -19,9 +20,10 @@ class Command(BaseCommand):
                 p = center.transform(WGS84_SRID, clone=True)
                 x = round(p.x, 5)
                 y = round(p.y, 5)
-            self.stdout.write("[{}] {} ({}, {}): {}".format(layer.id,
-                                                 str(layer),
-                                                 x,
-                                                 y,
-                                                 layer.get_layer_url()))
+            self.stdout.write("[{}] {} ({}, {}) [{}]: {}".format(layer.id,
+                                                      str(layer),
+                                                      x,
+                                                      y,
+                                                      layer.pixel_database,
+                                                      expand_url(layer.get_layer_url())))
 
@@ -6,10 +6,14 @@ import os
 import csv
 import gzip
 import datetime
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.contrib.gis.geos import Point
 from django.utils import timezone
-from ...models import RasterAggregatedLayer, NumericRasterAggregateData
+from deso import metrics
+from deso.profiling import ProfiledCommand, phase, progress, PROGRESS_ROWS
+from django.conf import settings
+from ...models import RasterAggregatedLayer, NumericRasterAggregateData, bulk_create_pixels
+from ...clustering import sort_pixels
 
 WGS84_SRID = 4326
 SPHERICAL_MERCATOR_SRID = 3857 # google maps projection
@@ -51,7 +55,9 @@ def load_raster_csv(filepath, layer_name, csv_encoding, pixel_size, csv_srid, in
         count = 0
         pixels = []
         expected_indexes = [lon_idx, lat_idx, datetime_idx]
-        for row in reader:
+        for row_number, row in enumerate(reader, 1):
+            if row_number % PROGRESS_ROWS == 0:
+                progress("rows", PROGRESS_ROWS)
             if row and all(row[idx] for idx in expected_indexes):
                 if no_datetime:
                     datetime_value = timezone.now()
@@ -62,6 +68,8 @@ def load_raster_csv(filepath, layer_name, csv_encoding, pixel_size, csv_srid, in
                 lon = float(row[lon_idx])
                 lat = float(row[lat_idx])
                 p = Point(lon, lat, srid=csv_srid)
+                # transformed here (instead of on insert) for the morton key
+                p.transform(settings.METERS_SRID)
                 for value_idx in indexes:
                     if row[value_idx]:
                         # currently only supporting numeric values!
@@ -73,16 +81,19 @@ def load_raster_csv(filepath, layer_name, csv_encoding, pixel_size, csv_srid, in
                                                           samples=1)
                         pixels.append(data)
             if len(pixels) >= COMMIT_COUNT:
-                NumericRasterAggregateData.objects.bulk_create(pixels)
+                # rows are written in morton order per COMMIT_COUNT chunk (use 'cluster_raster_layers' to order the full layer)
+                bulk_create_pixels(sort_pixels(pixels, pixel_size))
+                progress("pixels", len(pixels))
                 count += len(pixels)
                 pixels = []
         if pixels:
-            NumericRasterAggregateData.objects.bulk_create(pixels)
+            bulk_create_pixels(sort_pixels(pixels, pixel_size))
+            progress("pixels", len(pixels))
             count += len(pixels)
     return index_layers.values(), count
 
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     help = __doc__
 
     def add_arguments(self, parser):
@@ -142,28 +153,35 @@ class Command(BaseCommand):
                             help="If given the first line will be *included* as data")
 
     def handle(self, *args, **options):
-
-        result_layers, count = load_raster_csv(options["filepath"],
-                                               options["name"],
-                                                options["encoding"],
-                                                options["pixel_size"],
-                                                options["csv_srid"],
-                                                options["indexes"],
-                                                options["lon_idx"],
-                                                options["lat_idx"],
-                                                options["datetime_idx"],
-                                                options["datetime_format_str"],
-                                                options["opacity"],
-                                                options["no_datetime"],
-                                                options["no_headers"])
+        start = datetime.datetime.now()
+        with phase("load"):
+            result_layers, count = load_raster_csv(options["filepath"],
+                                                   options["name"],
+                                                   options["encoding"],
+                                                   options["pixel_size"],
+                                                   options["csv_srid"],
+                                                   options["indexes"],
+                                                   options["lon_idx"],
+                                                   options["lat_idx"],
+                                                   options["datetime_idx"],
+                                                   options["datetime_format_str"],
+                                                   options["opacity"],
+                                                   options["no_datetime"],
+                                                   options["no_headers"])
+        metrics.record_ingest("load_raster_csv", count, (datetime.datetime.now() - start).total_seconds())
         self.stdout.write("Created ({}) pixels in the following RasterAggregatedLayer(s): ".format(count))
         for raster_layer in result_layers:
+            with phase("tile index"):
+                raster_layer.update_tile_index()
+
             # auto create legend
-            legend = raster_layer.auto_create_legend(more_is_better=True)
-            raster_layer.legend = legend
-            raster_layer.save()
+            with phase("legend"):
+                legend = raster_layer.auto_create_legend(more_is_better=True)
+                raster_layer.legend = legend
+                # only the legend is saved, data_version is incremented in the database by bulk_create_pixels()
+                raster_layer.save(update_fields=["legend"])
 
             # create map layer (for viewing)
-            raster_layer.create_map_layer()
+            with phase("map layer"):
+                raster_layer.create_map_layer()
             self.stdout.write("[{}] {}".format(raster_layer.id, raster_layer.name))
-
@@ -0,0 +1,50 @@
+"""
+Convert the raster pixel tables (NumericRasterAggregateData, TextRasterAggregateData) to tables partitioned by layer,
+moving the pixels of each existing layer to the layer's partition (see deso/layers/raster/partitions.py).
+Requires PostgreSQL 11+.
+
+NOTE: Each table is locked while converted (tiles of layers not in the tile cache cannot be served), and
+      disk space for a copy of the table is required.
+"""
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction, connections
+from ...models import NumericRasterAggregateData, TextRasterAggregateData
+from ...partitions import partition_table
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-d", "--databases",
+                            default=None,
+                            nargs="+",
+                            help="Database aliases to convert [DEFAULT=settings.RASTER_PIXEL_DATABASES]")
+
+    def handle(self, *args, **options):
+        databases = options["databases"] or settings.RASTER_PIXEL_DATABASES
+        for database in databases:
+            if database not in settings.DATABASES:
+                raise CommandError("Unknown database: {}".format(database))
+            if connections[database].vendor != "postgresql":
+                raise CommandError("Partitioning requires PostgreSQL: {}".format(database))
+            if connections[database].pg_version < 110000:
+                raise CommandError("Partitioning requires PostgreSQL 11+: {}".format(database))
+
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        for database in databases:
+            for DataModel in (NumericRasterAggregateData, TextRasterAggregateData):
+                self.stdout.write("Partitioning {}.{}...".format(database, DataModel._meta.db_table))
+                with transaction.atomic(using=database):
+                    partition_count = partition_table(DataModel, database, write=self.stdout.write)
+                if partition_count is None:
+                    self.stdout.write("--> already partitioned")
+                else:
+                    self.stdout.write("--> ({}) layer partitions created".format(partition_count))
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        elapsed = end - start
+        self.stdout.write("Elapsed: {}".format(elapsed))
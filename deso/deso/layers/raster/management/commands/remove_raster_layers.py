@@ -1,13 +1,56 @@
 """
 Remove RasterAggregatedLayer and Related objects given RasterAggregatedLayer ids.
+Pixels are removed with a partition drop (partitioned pixel tables, see 'partition_raster_pixels') or file removal (columnar layers),
+otherwise with DELETE statements of '--chunk-size' rows (each committed separately, so that tile serving is not blocked).
+The layer's cached tiles and related MapLayer objects are also removed.
 Note: Use the 'list_raster_layers' command to obtain the RasterAggregatedLayer ids.
 """
+import time
+import datetime
+from django.apps import apps
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import connections
 from ...models import RasterAggregatedLayer
+from ...partitions import drop_layer_partition
+from ...tiles import clear_layer_tiles
 
 WGS84_SRID = settings.WGS84_SRID
 
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def delete_layer_pixels(layer, chunk_size=DEFAULT_CHUNK_SIZE, write=None):
+    """
+    Delete the pixels of the given layer, by partition drop if available, otherwise in chunks of 'chunk_size' rows.
+    :param write: function called with progress messages
+    :return: number of pixels deleted (None if the layer's partition or columnar file was dropped)
+    """
+    if layer.is_columnar:
+        layer.delete_pixels()
+        return None
+    DataModel = layer.get_data_model()
+    database = layer.pixel_database
+    if drop_layer_partition(DataModel, database, layer.id):
+        return None
+    connection = connections[database]
+    table = connection.ops.quote_name(DataModel._meta.db_table)
+    sql = "DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE layer_id = %s LIMIT %s)".format(table=table)
+    deleted = 0
+    start = time.perf_counter()
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [layer.id, chunk_size])
+            count = cursor.rowcount
+        if count <= 0:
+            break
+        deleted += count
+        if write is not None:
+            elapsed = time.perf_counter() - start
+            write("--> {} pixels deleted ({:.1f}/s)".format(deleted, deleted / elapsed if elapsed else 0.0))
+    return deleted
+
+
 class Command(BaseCommand):
     help = __doc__
 
@@ -18,16 +61,38 @@ class Command(BaseCommand):
                             required=True,
                             nargs="+",
                             help="RasterAggregatedLayer ids to delete.")
+        parser.add_argument("-c", "--chunk-size",
+                            type=int,
+                            default=DEFAULT_CHUNK_SIZE,
+                            help="Pixels deleted per statement (unpartitioned pixel tables) [DEFAULT={}]".format(DEFAULT_CHUNK_SIZE))
 
     def handle(self, *args, **options):
-        for layer in RasterAggregatedLayer.objects.order_by("id"):
-            self.stdout.write("Removing RasterAggregatedLayer: [{}] {}...".format(layer.id, layer.name))
-            # Delete related DataModel Objects
-            layer.pixels().delete()
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        MapLayer = apps.get_model("layercollections", "MapLayer")
+        layers = list(RasterAggregatedLayer.objects.filter(id__in=options["ids"]).order_by("id"))
+        found_ids = set(layer.id for layer in layers)
+        for missing_id in sorted(set(options["ids"]) - found_ids):
+            self.stderr.write("RasterAggregatedLayer({}) not found, skipping".format(missing_id))
 
-            # delete Layer
-            layer.delete()
+        for layer in layers:
+            self.stdout.write("Removing RasterAggregatedLayer: [{}] {} ({})...".format(layer.id, layer.name, layer.pixel_database))
+            deleted = delete_layer_pixels(layer, options["chunk_size"], write=self.stdout.write)
+            if deleted is None:
+                self.stdout.write("--> pixel partition (or columnar file) dropped")
 
-            self.stdout.write("Done!")
+            map_layers = MapLayer.objects.filter(url__endswith=layer.get_layer_url())
+            for map_layer in map_layers:
+                self.stdout.write("--> removing MapLayer: [{}] {}".format(map_layer.id, map_layer.name))
+                map_layer.delete()
 
+            clear_layer_tiles(layer.id)
+            self.stdout.write("--> cached tiles cleared")
 
+            # delete Layer
+            layer.delete()
+            self.stdout.write("Done!")
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        elapsed = end - start
+        self.stdout.write("Elapsed: {}".format(elapsed))
@@ -0,0 +1,184 @@
+"""
+Simulate serving tiles from multiple shared-nothing tile nodes (settings.TILE_HOSTS) to compare tile routing strategies.
+
+A synthetic (seeded) workload of map viewports is routed to 1..N nodes with:
+    round-robin   the leaflet subdomain selection, (x + y) % nodes
+    consistent    the consistent hash ring of deso.tilerouting (layer, zoom, column band)
+
+Each node is a separate process with its own LRU metatile cache, a cache miss costing '--render-ms' (the metatile render).
+For each node count the cache hit rate, tile throughput and the fraction of tiles moved to another node
+when the node is added are reported.
+
+Note: requests are replayed against simulated nodes (no tiles are rendered, a miss/hit sleeps '--render-ms'/'--hit-ms'),
+so the throughput only reflects the hit rate and the given costs, the hit rate & tiles moved are the results to compare.
+"""
+import time
+import bisect
+import random
+import datetime
+import multiprocessing
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from deso.tilerouting import TileHostRing
+
+STRATEGIES = ("round-robin", "consistent")
+
+DEFAULT_NODES = 4
+DEFAULT_LAYERS = 5
+DEFAULT_VIEWPORTS = 1000
+DEFAULT_VIEWPORT_TILES = (6, 4)  # columns, rows
+DEFAULT_HOTSPOTS = 20
+DEFAULT_CACHE_METATILES = 200
+DEFAULT_RENDER_MS = 5.0
+DEFAULT_HIT_MS = 0.2
+ZOOM_LEVELS = (12, 13, 14, 15, 16)
+
+
+def generate_viewport_requests(layers, viewports, hotspots, viewport_tiles=DEFAULT_VIEWPORT_TILES, seed=None):
+    """
+    Generate tile requests of map viewports panned around 'hotspots' popular locations.
+    :param layers: number of layers (layer routing keys '/raster/layer/<id>/')
+    :param viewports: number of viewports
+    :param hotspots: number of popular viewport locations (selected with a zipf-like distribution)
+    :param viewport_tiles: (columns, rows) of tiles per viewport
+    :param seed: random seed
+    :return: [(layer key, zoom, tilex, tiley), ...]
+    """
+    rng = random.Random(seed)
+    # hotspot locations as fractions of the (zoom 12) area covered
+    locations = [(rng.random(), rng.random()) for _ in range(hotspots)]
+    # cumulative weights of the hotspots (1 / rank)
+    cumulative_weights = []
+    total = 0.0
+    for rank in range(hotspots):
+        total += 1.0 / (rank + 1)
+        cumulative_weights.append(total)
+    columns, rows = viewport_tiles
+    requests = []
+    for _ in range(viewports):
+        key = "/raster/layer/{}/".format(rng.randint(1, layers))
+        zoom = rng.choice(ZOOM_LEVELS)
+        location_x, location_y = locations[min(bisect.bisect_right(cumulative_weights, rng.random() * total), hotspots - 1)]
+        # area of 64 zoom 12 tiles, doubled per zoom level
+        extent = 64 * 2 ** (zoom - ZOOM_LEVELS[0])
+        left = int(location_x * extent) + rng.randint(-columns, columns)
+        bottom = int(location_y * extent) + rng.randint(-rows, rows)
+        for tilex in range(left, left + columns):
+            for tiley in range(bottom, bottom + rows):
+                requests.append((key, zoom, tilex, tiley))
+    return requests
+
+
+def simulate_node(node_requests, cache_metatiles, metatile_size, render_ms, hit_ms):
+    """
+    Serve the given requests with an LRU metatile cache (run in a node process).
+    :return: (hits, misses, elapsed seconds)
+    """
+    cache = OrderedDict()
+    hits = misses = 0
+    start = time.perf_counter()
+    for key, zoom, tilex, tiley in node_requests:
+        metatile = (key, zoom, tilex // metatile_size, tiley // metatile_size)
+        if metatile in cache:
+            cache.move_to_end(metatile)
+            hits += 1
+            time.sleep(hit_ms / 1000)
+        else:
+            misses += 1
+            time.sleep(render_ms / 1000)
+            cache[metatile] = True
+            if len(cache) > cache_metatiles:
+                cache.popitem(last=False)
+    return hits, misses, time.perf_counter() - start
+
+
+def get_node_assignments(requests, strategy, nodes, metatile_size):
+    """
+    :return: node index of each request
+    """
+    if strategy == "round-robin":
+        return [(tilex + tiley) % nodes for key, zoom, tilex, tiley in requests]
+    ring = TileHostRing(["node{}".format(index) for index in range(nodes)], band_columns=metatile_size)
+    return [ring.get_host_index(key, zoom, tilex) for key, zoom, tilex, tiley in requests]
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--nodes",
+                            type=int,
+                            default=DEFAULT_NODES,
+                            help="Maximum number of tile nodes simulated (1..nodes) [DEFAULT={}]".format(DEFAULT_NODES))
+        parser.add_argument("-l", "--layers",
+                            type=int,
+                            default=DEFAULT_LAYERS,
+                            help="Number of layers requested [DEFAULT={}]".format(DEFAULT_LAYERS))
+        parser.add_argument("--viewports",
+                            type=int,
+                            default=DEFAULT_VIEWPORTS,
+                            help="Number of viewports requested [DEFAULT={}]".format(DEFAULT_VIEWPORTS))
+        parser.add_argument("--hotspots",
+                            type=int,
+                            default=DEFAULT_HOTSPOTS,
+                            help="Number of popular viewport locations [DEFAULT={}]".format(DEFAULT_HOTSPOTS))
+        parser.add_argument("-c", "--cache-metatiles",
+                            type=int,
+                            default=DEFAULT_CACHE_METATILES,
+                            help="Metatiles cached per node [DEFAULT={}]".format(DEFAULT_CACHE_METATILES))
+        parser.add_argument("--render-ms",
+                            type=float,
+                            default=DEFAULT_RENDER_MS,
+                            help="Simulated metatile render (cache miss) milliseconds [DEFAULT={}]".format(DEFAULT_RENDER_MS))
+        parser.add_argument("--hit-ms",
+                            type=float,
+                            default=DEFAULT_HIT_MS,
+                            help="Simulated cache hit milliseconds [DEFAULT={}]".format(DEFAULT_HIT_MS))
+        parser.add_argument("--seed",
+                            type=int,
+                            default=None,
+                            help="Random seed of the generated workload")
+
+    def handle(self, *args, **options):
+        if options["nodes"] < 1 or options["layers"] < 1 or options["viewports"] < 1 or options["hotspots"] < 1:
+            raise CommandError("'--nodes', '--layers', '--viewports' and '--hotspots' must be >= 1")
+        start = datetime.datetime.now()
+        self.stdout.write("Start: {}".format(start))
+        metatile_size = settings.RASTER_METATILE_SIZE
+        requests = generate_viewport_requests(options["layers"],
+                                              options["viewports"],
+                                              options["hotspots"],
+                                              seed=options["seed"])
+        self.stdout.write("Tile requests: {} (metatile size: {})".format(len(requests), metatile_size))
+        self.stdout.write("{:<14}{:>6}{:>10}{:>14}{:>10}".format("strategy", "nodes", "hit %", "tiles/s", "moved %"))
+        for strategy in STRATEGIES:
+            previous_assignments = None
+            for nodes in range(1, options["nodes"] + 1):
+                assignments = get_node_assignments(requests, strategy, nodes, metatile_size)
+                node_requests = [[] for _ in range(nodes)]
+                for request, node in zip(requests, assignments):
+                    node_requests[node].append(request)
+
+                node_arguments = [(node_request, options["cache_metatiles"], metatile_size, options["render_ms"], options["hit_ms"])
+                                  for node_request in node_requests]
+                wall_start = time.perf_counter()
+                with multiprocessing.Pool(processes=nodes) as pool:
+                    node_results = pool.starmap(simulate_node, node_arguments)
+                wall_elapsed = time.perf_counter() - wall_start
+
+                hits = sum(result[0] for result in node_results)
+                moved = ""
+                if previous_assignments is not None:
+                    moved_count = sum(1 for previous, current in zip(previous_assignments, assignments) if previous != current)
+                    moved = "{:.1f}".format(moved_count / len(requests) * 100)
+                previous_assignments = assignments
+                self.stdout.write("{:<14}{:>6}{:>10.1f}{:>14.1f}{:>10}".format(strategy,
+                                                                              nodes,
+                                                                              hits / len(requests) * 100,
+                                                                              len(requests) / wall_elapsed,
+                                                                              moved))
+        end = datetime.datetime.now()
+        self.stdout.write("End: {}".format(end))
+        self.stdout.write("Elapsed: {}".format(end - start))
@@ -0,0 +1,28 @@
+"""
+(Re)build the tile occupancy index for existing RasterAggregatedLayer objects.
+The index allows tiles outside of a layer's data coverage to be served without a DB query or render.
+"""
+from django.core.management.base import BaseCommand
+from ...models import RasterAggregatedLayer
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("-i", "--ids",
+                            type=int,
+                            default=None,
+                            nargs="+",
+                            help="RasterAggregatedLayer ids to index [DEFAULT=All Layers]")
+
+    def handle(self, *args, **options):
+        layers = RasterAggregatedLayer.objects.order_by("id")
+        if options["ids"]:
+            layers = layers.filter(id__in=options["ids"])
+        for layer in layers:
+            self.stdout.write("Indexing RasterAggregatedLayer: [{}] {}...".format(layer.id, layer.name))
+            tile_index = layer.update_tile_index()
+            self.stdout.write("--> ({}) tiles at zoom {}".format(tile_index.zooms[tile_index.max_zoom].count(),
+                                                                 tile_index.max_zoom))
+        self.stdout.write("Done!")
@@ -0,0 +1,116 @@
+"""
+MBTiles (SQLite) tile archive reading and writing.
+https://github.com/mapbox/mbtiles-spec/blob/master/1.2/spec.md
+
+NOTE: MBTiles 'tile_row' uses the TMS scheme (y origin at the bottom), matching the tile y used by deso.
+"""
+import os
+import sqlite3
+import threading
+
+MBTILES_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)",
+    "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)",
+)
+
+
+class MBTilesWriter:
+    """
+    Write tiles to a new (or existing) MBTiles file.
+    Intended for use by a single writer process.
+    """
+
+    def __init__(self, filepath, metadata=None):
+        self.filepath = filepath
+        self.connection = sqlite3.connect(filepath)
+        # archive is written once, durability during the export is not required
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("PRAGMA journal_mode=MEMORY")
+        for statement in MBTILES_SCHEMA:
+            self.connection.execute(statement)
+        if metadata:
+            self.set_metadata(metadata)
+
+    def set_metadata(self, metadata):
+        """
+        :param metadata: { name: value, ... }
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                                    [(name, str(value)) for name, value in metadata.items()])
+        self.connection.commit()
+
+    def write_tiles(self, tiles):
+        """
+        :param tiles: iterable of (zoom, tilex, tiley, encoded tile bytes)
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                                    ((z, x, y, sqlite3.Binary(data)) for z, x, y, data in tiles))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.execute("ANALYZE")
+        self.connection.commit()
+        self.connection.close()
+
+
+class MBTilesReader:
+    """
+    Thread-safe read-only access to an MBTiles file.
+    (sqlite3 connections may not be shared between threads, a connection is opened per thread)
+    """
+
+    def __init__(self, filepath):
+        if not os.path.exists(filepath):
+            raise IOError("MBTiles file not found: {}".format(filepath))
+        self.filepath = filepath
+        self._local = threading.local()
+        self._tile_format = None
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect("file:{}?mode=ro".format(self.filepath), uri=True)
+            self._local.connection = connection
+        return connection
+
+    def get_metadata(self):
+        """
+        :return: { name: value, ... }
+        """
+        return dict(self._get_connection().execute("SELECT name, value FROM metadata").fetchall())
+
+    @property
+    def tile_format(self):
+        """
+        :return: image encoding of the archived tiles ('png', 'jpg', 'webp')
+        """
+        if self._tile_format is None:
+            self._tile_format = self.get_metadata().get("format", "png")
+        return self._tile_format
+
+    def get_tile(self, zoom, tilex, tiley):
+        """
+        :return: encoded tile bytes or None if the tile is not in the archive
+        """
+        row = self._get_connection().execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                             (zoom, tilex, tiley)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+
+# process-local cache of opened archives
+# --> { filepath: MBTilesReader, ... }
+_READERS = {}
+_READERS_LOCK = threading.Lock()
+
+
+def get_mbtiles_reader(filepath):
+    with _READERS_LOCK:
+        reader = _READERS.get(filepath, None)
+        if reader is None:
+            reader = MBTilesReader(filepath)
+            _READERS[filepath] = reader
+        return reader
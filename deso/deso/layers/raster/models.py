@@ -1,5 +1,6 @@
 import logging
 import os
+from collections import OrderedDict
 from colorsys import rgb_to_hls, hls_to_rgb
 
 from django.contrib.gis.geos import Point
@@ -7,11 +8,18 @@ from django.contrib.gis.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.apps import apps
-from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext as _
-from django.db.models import Avg, Max, Min, StdDev
+from django.db.models import Avg, Max, Min, StdDev, F
 from deso.functions import WelfordRunningVariance
+from deso.hosts import expand_url, expand_tile_url
+from deso.tilerouting import get_routing_options
+from .tileindex import TileOccupancyIndex, build_tile_index
+from .mbtiles import get_mbtiles_reader
+from .tiles import clear_layer_tiles, get_scale_suffix, HIDPI_SCALE
+from .routers import get_pixel_database, map_pixel_databases
+from .partitions import ensure_layer_partitions, drop_layer_partition, truncate_layer_partition
+from .columnar import get_columnar_reader, remove_columnar_layer
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -75,22 +83,31 @@ class ScaledColorLegend(models.Model):
     color_manager_class = models.CharField(max_length=25,
                                            default="ScaledFloatColorManager",
                                            choices=VALID_COLOR_MANAGERS)
+    version = models.PositiveIntegerField(default=1,
+                                          editable=False,
+                                          help_text=_("Incremented when the legend is changed (used for tile & legend ETags)"))
 
     def clean(self):
         if len(self.hex_max_color) != 6 or len(self.hex_min_color) != 6:
             raise ValidationError("'hex_max_color' or 'hex_min_color' are not the expected 6-digits long!")
 
     def save(self, *args, **kwargs):
+        changed = False
         if self.id:
             # check if legend changed
             previous = ScaledColorLegend.objects.get(id=self.id)
-            for fieldname in ("hex_min_color", "hex_max_color", "minimum_value", "maximum_value",):
+            for fieldname in ("hex_min_color", "hex_max_color", "minimum_value", "maximum_value", "color_manager_class", "display_band_count"):
                 if getattr(self, fieldname) != getattr(previous, fieldname):
-                    # clear cache if legend was changed, so raster is recreated.
-                    cache = caches["tilecache"]
-                    cache.clear()
+                    changed = True
+                    self.version = previous.version + 1
+                    if kwargs.get("update_fields") is not None:
+                        kwargs["update_fields"] = list(kwargs["update_fields"]) + ["version"]
                     break
         super(ScaledColorLegend, self).save(*args, **kwargs) # Call the "real" save() method.
+        if changed:
+            # clear cached tiles of related layers if legend was changed, so raster is recreated.
+            for layer_id in self.rasteraggregatedlayer_set.values_list("id", flat=True):
+                clear_layer_tiles(layer_id)
 
     def __str__(self):
         return "[{}] {} ({} to {})".format(self.id,
@@ -99,9 +116,7 @@ class ScaledColorLegend(models.Model):
                                             self.maximum_value)
 
     def get_absolute_url(self):
-        return "http://{}:{}/raster/legend/{}/".format(settings.HOST,
-                                                        settings.PORT,
-                                                        self.id)
+        return "/raster/legend/{}/".format(self.id)
 
     def get_color_manager(self):
         if self.color_manager_class == "ScaledFloatColorManager":
@@ -129,10 +144,16 @@ class ScaledColorLegend(models.Model):
         :param model_value_fieldname: fieldname in the model that holds the target 'value"
         :return: Color as 'hsl()' string.
         """
+        value = getattr(model_instance, model_value_fieldname)
+        return self.get_value_color_str(value)
+
+    def get_value_color_str(self, value):
+        """
+        :param value: value to 'colorize'
+        :return: Color as 'hsl()' string.
+        """
         if not hasattr(self, "color_manager"):
             self.get_color_manager()  # populates self.color_manager
-
-        value = getattr(model_instance, model_value_fieldname)
         return self.color_manager.value_to_hsl(value, as_str=True)
 
 
@@ -427,6 +448,8 @@ class ScaledDiffColorManager(ScaledFloatColorManager):
 VALID_DATA_MODELS = (
     ("NumericRasterAggregateData", "NumericRasterAggregateData"),
     ("TextRasterAggregateData", "TextRasterAggregateData"),
+    # pixels stored in a memory-mapped file (see columnar.py)
+    ("ColumnarRasterData", "ColumnarRasterData"),
 )
 
 
@@ -452,6 +475,16 @@ class RasterAggregatedLayer(models.Model):
     pixel_size_meters = models.IntegerField(choices=BIN_SIZE_CHOICES)
     minimum_samples = models.PositiveIntegerField(null=True,
                                                   help_text=_("Minimum sample size for bin"))
+    tile_index = models.BinaryField(null=True,
+                                    editable=False,
+                                    help_text=_("Serialized TileOccupancyIndex of tiles containing layer data"))
+    archive_filepath = models.CharField(max_length=512,
+                                        null=True,
+                                        blank=True,
+                                        help_text=_("If set, layer tiles are served from this MBTiles archive (see 'export_raster_mbtiles')"))
+    data_version = models.PositiveIntegerField(default=0,
+                                               editable=False,
+                                               help_text=_("Incremented when the layer's pixel data changes (used for tile ETags)"))
 
     objects = models.GeoManager()
 
@@ -464,13 +497,73 @@ class RasterAggregatedLayer(models.Model):
             # check if legend changed
             previous = RasterAggregatedLayer.objects.get(id=self.id)
             if self.legend != previous.legend:
-                cache = caches["tilecache"]
-                cache.clear()
+                clear_layer_tiles(self.id)
         super(RasterAggregatedLayer, self).save(*args, **kwargs) # Call the "real" save() method.
 
+    def delete(self, *args, **kwargs):
+        # pixels may be stored in another database (not reached by the cascade delete)
+        if self.is_columnar:
+            remove_columnar_layer(self.get_columnar_filepath())
+        elif not drop_layer_partition(self.get_data_model(), self.pixel_database, self.id):
+            self.pixels().delete()
+        super(RasterAggregatedLayer, self).delete(*args, **kwargs)
+
+    def delete_pixels(self):
+        """
+        Delete the layer's pixels (a partition TRUNCATE if the pixel table is partitioned, see partitions.py)
+        """
+        if self.is_columnar:
+            remove_columnar_layer(self.get_columnar_filepath())
+        elif not truncate_layer_partition(self.get_data_model(), self.pixel_database, self.id):
+            self.pixels().delete()
+        increment_data_versions([self.id])
+
+    @property
+    def is_columnar(self):
+        return self.data_model == "ColumnarRasterData"
+
+    def get_columnar_filepath(self):
+        """
+        :return: filepath of the layer's columnar pixel file (data_model 'ColumnarRasterData')
+        """
+        return os.path.join(settings.RASTER_COLUMNAR_DIRECTORY, "layer_{}.dcol".format(self.id))
+
+    def get_columnar_reader(self):
+        """
+        :return: columnar.ColumnarLayerReader, or None if the layer's columnar file does not exist
+        """
+        filepath = self.get_columnar_filepath()
+        if not os.path.exists(filepath):
+            return None
+        return get_columnar_reader(filepath)
+
+    @property
+    def pixel_database(self):
+        """
+        :return: database alias where the layer's pixels are stored (see routers.get_pixel_database())
+        """
+        return get_pixel_database(self.id)
 
     def extent(self, as_wgs84=True):
-        result = NumericRasterAggregateData.objects.filter(layer=self).extent()
+        if self.is_columnar:
+            reader = self.get_columnar_reader()
+            result = reader.extent if reader is not None and reader.pixel_count else None
+        elif hasattr(self, "_pixel_extent"):
+            # set by prefetch_pixel_extents()
+            result = self._pixel_extent
+        else:
+            result = NumericRasterAggregateData.objects.using(self.pixel_database).filter(layer=self).extent()
+        if result is None and self.archive_filepath:
+            # pixels removed after archiving, use the (wgs84) bounds recorded in the archive
+            bounds = get_mbtiles_reader(self.archive_filepath).get_metadata().get("bounds", None)
+            if bounds is None:
+                return None
+            result = tuple(float(v) for v in bounds.split(","))
+            if not as_wgs84:
+                min_p = Point(*result[:2], srid=settings.WGS84_SRID).transform(settings.METERS_SRID, clone=True)
+                max_p = Point(*result[2:], srid=settings.WGS84_SRID).transform(settings.METERS_SRID, clone=True)
+                result = (min_p.x, min_p.y, max_p.x, max_p.y)
+            return result
         if as_wgs84:
             min_p = Point(*result[:2], srid=settings.METERS_SRID).transform(settings.WGS84_SRID, clone=True)
             max_p = Point(*result[2:], srid=settings.METERS_SRID).transform(settings.WGS84_SRID, clone=True)
@@ -492,9 +585,15 @@ class RasterAggregatedLayer(models.Model):
             legend = related_legends[0]
         else:
             # calculate distribution
-            RelatedModel = self.get_data_model()
             fieldname = self.value_fieldname
-            results = RelatedModel.objects.filter(layer=self).aggregate(Avg(fieldname), Max(fieldname), Min(fieldname), StdDev(fieldname))
+            if self.is_columnar:
+                reader = self.get_columnar_reader()
+                # no values (as a database layer without pixels) if the columnar file has not been written
+                aggregates = reader.aggregate(fieldname) if reader is not None else dict.fromkeys(("avg", "max", "min", "stddev"))
+                results = {"{}__{}".format(fieldname, name): value for name, value in aggregates.items()}
+            else:
+                RelatedModel = self.get_data_model()
+                results = RelatedModel.objects.using(self.pixel_database).filter(layer=self).aggregate(Avg(fieldname), Max(fieldname), Min(fieldname), StdDev(fieldname))
             # get rounded average
             avg_key = "{}__avg".format(fieldname)
             rounded_average = round(results[avg_key])
@@ -555,22 +654,28 @@ class RasterAggregatedLayer(models.Model):
         if not self.center or recalculate:
             welfords_x = WelfordRunningVariance()
             welfords_y = WelfordRunningVariance()
-            numeric_raster_data = NumericRasterAggregateData.objects.filter(layer=self)
-            for n in numeric_raster_data:
-                welfords_x.send(n.location.x)
-                welfords_y.send(n.location.y)
-
-            text_raster_data = TextRasterAggregateData.objects.filter(layer=self)
-            for t in text_raster_data:
-                welfords_x.send(t.location.x)
-                welfords_y.send(t.location.y)
+            if self.is_columnar:
+                reader = self.get_columnar_reader()
+                for x, y in (reader.iter_pixels(()) if reader is not None else ()):
+                    welfords_x.send(x)
+                    welfords_y.send(y)
+            else:
+                numeric_raster_data = NumericRasterAggregateData.objects.using(self.pixel_database).filter(layer=self)
+                for n in numeric_raster_data:
+                    welfords_x.send(n.location.x)
+                    welfords_y.send(n.location.y)
+
+                text_raster_data = TextRasterAggregateData.objects.using(self.pixel_database).filter(layer=self)
+                for t in text_raster_data:
+                    welfords_x.send(t.location.x)
+                    welfords_y.send(t.location.y)
             mean_x = welfords_x.mean()
             mean_y = welfords_y.mean()
             if mean_x and mean_y:
                 p = Point(mean_x, mean_y, srid=self.srid)
                 p.transform(METERS_SRID)
                 self.center = p
-                self.save()
+                self.save(update_fields=["center"])
         else:
             p = self.center
         return p
@@ -583,9 +688,10 @@ class RasterAggregatedLayer(models.Model):
         else:
             raise Exception("Unknown data_model: {}".format(self.data_model))
 
-    def info(self):
+    def info(self, request=None):
         """
         layer information dictionary to be converted to json
+        :param request: request used to expand the layer urls (see deso.hosts.expand_url())
         """
         layer_center_point = self.get_center()
         if layer_center_point:
@@ -594,17 +700,27 @@ class RasterAggregatedLayer(models.Model):
         layer_unique_id = "{}:raster:{}".format(self._state.db,
                                                 self.id)
         source_value = os.path.split(self.filepath)[-1] if self.filepath else None
+        layer_url, tile_hosts = expand_tile_url(self.get_layer_url(), request)
         layer_info = {
                  "source": source_value,
                  "created_datetime": self.created_datetime.isoformat(),
                  "id": layer_unique_id,
-                 "url": self.get_layer_url(),
+                 "url": layer_url,
+                 "hiDpiUrl": expand_tile_url(self.get_hidpi_layer_url(), request)[0],
+                 "webpUrl": expand_tile_url(self.get_webp_layer_url(), request)[0],
+                 "hiDpiWebpUrl": expand_tile_url(self.get_webp_layer_url(scale=HIDPI_SCALE), request)[0],
+                 "batchUrl": expand_tile_url(self.get_batch_url(), request)[0],
+                 "gridUrl": expand_tile_url(self.get_grid_url(), request)[0],
+                 "gridMinZoom": settings.RASTER_UTFGRID_MIN_ZOOM,
+                 "pointUrl": expand_url(self.get_point_url(), request),
                  "type": "TileLayer-overlay",
                  "extent": self.extent(),
                  "opacity": self.opacity,
                  }
         if self.legend:
-            layer_info["legendUrl"] = self.legend.get_absolute_url()
+            layer_info["legendUrl"] = expand_url(self.legend.get_absolute_url(), request)
+        if tile_hosts:
+            layer_info["tileRouting"] = get_routing_options(self.get_layer_url(), tile_hosts)
         if layer_center_point:
             layer_info["centerlon"] = round(layer_center_point.x, 6)
             layer_info["centerlat"] = round(layer_center_point.y, 6)
@@ -624,27 +740,168 @@ class RasterAggregatedLayer(models.Model):
                      type="TileLayer-overlay",
                      center=self.get_center(),
                      opacity=self.opacity,
-                     url=self.get_layer_url())
+                     url=self.get_layer_url(),
+                     hidpi_url=self.get_hidpi_layer_url(),
+                     webp_url=self.get_webp_layer_url(),
+                     hidpi_webp_url=self.get_webp_layer_url(scale=HIDPI_SCALE),
+                     batch_url=self.get_batch_url(),
+                     grid_url=self.get_grid_url(),
+                     point_url=self.get_point_url())
         if self.legend:
             m.legend_url = self.legend.get_absolute_url()
         m.save()
         return m
 
-    def get_layer_url(self):
+    def get_layer_url(self, scale=1, image_encoding="png"):
+        """
+        :param scale: tile resolution multiplier (HIDPI_SCALE for the 512 pixel '@2x' tiles)
+        :param image_encoding: tile image encoding (see tiles.TILE_IMAGE_ENCODINGS)
+        :return: URL path (template) from which layer is served (see deso.hosts.expand_tile_url())
+        """
+        return "/raster/layer/{}/{{z}}/{{x}}/{{y}}{}.{}".format(self.id, get_scale_suffix(scale), image_encoding)
+
+    def get_webp_layer_url(self, scale=1):
+        """
+        :param scale: tile resolution multiplier (HIDPI_SCALE for the 512 pixel '@2x' tiles)
+        :return: URL from which the layer's webp tiles are served, or None if not available (archived layers, settings.RASTER_TILE_WEBP_URLS)
+        """
+        if self.archive_filepath or not settings.RASTER_TILE_WEBP_URLS:
+            return None
+        return self.get_layer_url(scale=scale, image_encoding="webp")
+
+    def get_batch_url(self):
         """
-        :return: URL from which layer is served
+        :return: URL from which multiple layer tiles are served in a single request (see views.get_tile_batch())
         """
-        return "http://{}:{}/raster/layer/{}/{{z}}/{{x}}/{{y}}.png".format(settings.HOST,
-                                                                            settings.PORT,
-                                                                            self.id)
+        return "/raster/batch/{}/".format(self.id)
+
+    def get_grid_url(self):
+        """
+        :return: URL path (template) from which the layer's UTFGrid interaction tiles are served (see views.get_grid_tile())
+        """
+        return "/raster/grid/{}/{{z}}/{{x}}/{{y}}.json".format(self.id)
+
+    def get_point_url(self):
+        """
+        :return: URL returning the pixel values at a location, '?lon=<lon>&lat=<lat>' (see views.get_point_values())
+        """
+        return "/raster/point/{}/".format(self.id)
+
+    def get_hidpi_layer_url(self):
+        """
+        :return: URL from which the layer's high-dpi tiles are served, or None if not available (archived layers)
+        """
+        if self.archive_filepath:
+            return None
+        return self.get_layer_url(scale=HIDPI_SCALE)
 
     def pixels(self):
+        """
+        :return: queryset of the layer's pixels (in the layer's pixel database)
+        """
         DataModel = self.get_data_model()
-        return DataModel.objects.filter(layer=self)
+        return DataModel.objects.using(self.pixel_database).filter(layer=self)
+
+    def get_pixel_values(self, fieldnames, **filters):
+        """
+        Retrieve pixel locations & values from the layer's pixel table or columnar file.
+        :param fieldnames: value fieldnames
+        :param filters: pixel filters, for columnar layers only '<fieldname>__gte' & '<fieldname>__lte' filters are supported
+        :return: iterable of (location, value, ...)
+        """
+        if not self.is_columnar:
+            return self.pixels().filter(**filters).values_list("location", *fieldnames)
+        conditions = []
+        for name, limit in filters.items():
+            fieldname, operator = name.rsplit("__", 1)
+            if operator not in ("gte", "lte"):
+                raise ValueError("Unsupported columnar layer filter: {}".format(name))
+            conditions.append((len(fieldnames) + len(conditions), operator, limit))
+        filter_fieldnames = [name.rsplit("__", 1)[0] for name in filters]
+
+        def iter_values():
+            reader = self.get_columnar_reader()
+            if reader is None:
+                return
+            for x, y, *values in reader.iter_pixels(list(fieldnames) + filter_fieldnames):
+                if all(values[index] is not None and (values[index] >= limit if operator == "gte" else values[index] <= limit)
+                       for index, operator, limit in conditions):
+                    yield (Point(x, y, srid=METERS_SRID),) + tuple(values[:len(fieldnames)])
+        return iter_values()
+
+    def update_tile_index(self, max_zoom=None):
+        """
+        (Re)build the layer's tile occupancy index from the layer's pixels and save it.
+        Should be called once pixel data has been loaded.
+        :return: TileOccupancyIndex
+        """
+        if max_zoom is None:
+            max_zoom = settings.RASTER_TILE_INDEX_MAX_ZOOM
+        index = build_tile_index(self, max_zoom=max_zoom)
+        self.tile_index = index.to_bytes()
+        self.save(update_fields=["tile_index"])
+        return index
+
+    def get_tile_index(self):
+        """
+        :return: TileOccupancyIndex or None if the index has not been built for the layer
+        """
+        if self.tile_index is None:
+            return None
+        return TileOccupancyIndex.from_bytes(self.tile_index)
+
+
+def prefetch_pixel_extents(layers):
+    """
+    Query the pixel extents of the given layers, one query per pixel database (in parallel),
+    so that layer.extent() makes no further queries.
+    :param layers: RasterAggregatedLayer objects
+    :return: layers
+    """
+    layers = list(layers)
+
+    def get_extents(database, database_layers):
+        rows = NumericRasterAggregateData.objects.using(database) \
+                                                 .filter(layer_id__in=[layer.id for layer in database_layers]) \
+                                                 .values_list("layer") \
+                                                 .annotate(models.Extent("location"))
+        return dict(rows)
+
+    # columnar layer extents are read from the layer files
+    extents = map_pixel_databases(get_extents, [layer for layer in layers if not layer.is_columnar])
+    for layer in layers:
+        if not layer.is_columnar:
+            layer._pixel_extent = extents.get(layer.id, None)
+    return layers
+
+
+def bulk_create_pixels(pixels):
+    """
+    Create the given (unsaved) pixel objects in the pixel databases of their layers.
+    :param pixels: NumericRasterAggregateData/TextRasterAggregateData objects
+    """
+    groups = OrderedDict()
+    for pixel in pixels:
+        groups.setdefault((type(pixel), get_pixel_database(pixel.layer_id)), []).append(pixel)
+    for (DataModel, database), database_pixels in groups.items():
+        ensure_layer_partitions(DataModel, database, (pixel.layer_id for pixel in database_pixels))
+        DataModel.objects.using(database).bulk_create(database_pixels)
+    increment_data_versions(set(pixel.layer_id for database_pixels in groups.values() for pixel in database_pixels))
+
+
+def increment_data_versions(layer_ids):
+    """
+    Increment the RasterAggregatedLayer.data_version of the given layers (pixel data changed, see tiles.get_tile_etag()).
+    :param layer_ids: RasterAggregatedLayer ids
+    """
+    layer_ids = list(layer_ids)
+    if layer_ids:
+        RasterAggregatedLayer.objects.filter(id__in=layer_ids).update(data_version=F("data_version") + 1)
 
 
+# NOTE: pixel tables may be in another database than the layer table (see routers.py), so no foreign key constraint is created
 class NumericRasterAggregateData(models.Model):
-    layer = models.ForeignKey(RasterAggregatedLayer)
+    layer = models.ForeignKey(RasterAggregatedLayer, db_constraint=False)
     location = models.PointField(srid=METERS_SRID)
     dt = models.DateTimeField(null=True)
     samples = models.PositiveIntegerField(help_text="Number of samples for pixel")
@@ -667,7 +924,7 @@ class NumericRasterAggregateData(models.Model):
 
 
 class TextRasterAggregateData(models.Model):
-    layer = models.ForeignKey(RasterAggregatedLayer)
+    layer = models.ForeignKey(RasterAggregatedLayer, db_constraint=False)
     location = models.PointField(srid=METERS_SRID)
     dt = models.DateTimeField(null=True)
     value = models.CharField(max_length=255)
@@ -0,0 +1,144 @@
+"""
+Per-layer partitioning of raster pixel tables (PostgreSQL declarative LIST partitioning on layer_id).
+
+Pixel tables converted with the 'partition_raster_pixels' command store the pixels of each layer in a separate partition,
+'<table>_layer_<layer id>', so that tile queries scan only the layer's partition (and its spatial index),
+and the pixels of a layer are removed with a partition DROP/TRUNCATE instead of a DELETE.
+
+Partitioning is detected per database/table, unconverted tables (and PostgreSQL < 10 databases) continue to be used as before.
+Layer partitions are created on pixel insert (see models.bulk_create_pixels()).
+"""
+import logging
+
+from django.db import connections
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+MINIMUM_PG_VERSION = 100000  # PostgreSQL 10, connection.pg_version format
+
+# process-local caches
+# --> { (database, table): bool, ... }
+_PARTITIONED_TABLES = {}
+# --> set((database, table, layer_id), ...)
+_LAYER_PARTITIONS = set()
+
+
+def get_partition_name(table, layer_id):
+    return "{}_layer_{}".format(table, int(layer_id))
+
+
+def is_partitioned(DataModel, database):
+    """
+    :param DataModel: NumericRasterAggregateData or TextRasterAggregateData
+    :param database: database alias
+    :return: True if the model's table is a partitioned table in the database
+    """
+    table = DataModel._meta.db_table
+    key = (database, table)
+    if key not in _PARTITIONED_TABLES:
+        connection = connections[database]
+        if connection.vendor != "postgresql" or connection.pg_version < MINIMUM_PG_VERSION:
+            # declarative partitioning (and pg_partitioned_table) is only available from PostgreSQL 10
+            _PARTITIONED_TABLES[key] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+                _PARTITIONED_TABLES[key] = cursor.fetchone() is not None
+    return _PARTITIONED_TABLES[key]
+
+
+def create_layer_partition(connection, cursor, table, layer_id):
+    cursor.execute("CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES IN (%s)".format(
+        partition=connection.ops.quote_name(get_partition_name(table, layer_id)),
+        table=connection.ops.quote_name(table)), [int(layer_id)])
+
+
+def ensure_layer_partitions(DataModel, database, layer_ids):
+    """
+    Create the partitions of the given layers, if the model's table is partitioned.
+    """
+    if not is_partitioned(DataModel, database):
+        return
+    table = DataModel._meta.db_table
+    missing = [layer_id for layer_id in set(layer_ids) if (database, table, layer_id) not in _LAYER_PARTITIONS]
+    if not missing:
+        return
+    connection = connections[database]
+    with connection.cursor() as cursor:
+        for layer_id in missing:
+            create_layer_partition(connection, cursor, table, layer_id)
+            _LAYER_PARTITIONS.add((database, table, layer_id))
+
+
+def drop_layer_partition(DataModel, database, layer_id):
+    """
+    :return: True if the layer's partition was dropped, False if the model's table is not partitioned
+    """
+    if not is_partitioned(DataModel, database):
+        return False
+    table = DataModel._meta.db_table
+    connection = connections[database]
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {}".format(connection.ops.quote_name(get_partition_name(table, layer_id))))
+    _LAYER_PARTITIONS.discard((database, table, layer_id))
+    logger.info("Dropped partition of layer({}) in {}.{}".format(layer_id, database, table))
+    return True
+
+
+def truncate_layer_partition(DataModel, database, layer_id):
+    """
+    :return: True if the layer's partition was truncated, False if the model's table is not partitioned
+    """
+    if not is_partitioned(DataModel, database):
+        return False
+    table = DataModel._meta.db_table
+    partition = get_partition_name(table, layer_id)
+    connection = connections[database]
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [partition])
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("TRUNCATE TABLE {}".format(connection.ops.quote_name(partition)))
+    return True
+
+
+def partition_table(DataModel, database, write=None):
+    """
+    Convert the model's (unpartitioned) table to a table partitioned by layer_id, moving the existing pixels to layer partitions.
+    Run in a single transaction, the table is locked while converting.
+    :param write: function called with progress messages
+    :return: number of layer partitions created, or None if the table is already partitioned
+    """
+    if is_partitioned(DataModel, database):
+        return None
+    connection = connections[database]
+    quote_name = connection.ops.quote_name
+    table = DataModel._meta.db_table
+    source_table = "{}_unpartitioned".format(table)
+    with connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(quote_name(table), quote_name(source_table)))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [source_table])
+        sequence = cursor.fetchone()[0]
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY LIST (layer_id)".format(quote_name(table),
+                                                                                                           quote_name(source_table)))
+        # the partition key must be part of the primary key
+        cursor.execute("ALTER TABLE {} ADD PRIMARY KEY (id, layer_id)".format(quote_name(table)))
+        # indexes of the partitioned table are created on each partition
+        cursor.execute("CREATE INDEX {} ON {} USING GIST (location)".format(quote_name("{}_location_part".format(table)),
+                                                                             quote_name(table)))
+        cursor.execute("SELECT DISTINCT layer_id FROM {} ORDER BY layer_id".format(quote_name(source_table)))
+        layer_ids = [row[0] for row in cursor.fetchall()]
+        for layer_id in layer_ids:
+            create_layer_partition(connection, cursor, table, layer_id)
+            cursor.execute("INSERT INTO {} SELECT * FROM {} WHERE layer_id = %s".format(quote_name(table),
+                                                                                       quote_name(source_table)), [layer_id])
+            if write is not None:
+                write("--> layer({}): {} pixels".format(layer_id, cursor.rowcount))
+        if sequence:
+            # keep the id sequence when the source table is dropped
+            cursor.execute("ALTER SEQUENCE {} OWNED BY {}.id".format(sequence, quote_name(table)))
+        cursor.execute("DROP TABLE {}".format(quote_name(source_table)))
+        cursor.execute("ANALYZE {}".format(quote_name(table)))
+    _PARTITIONED_TABLES[(database, table)] = True
+    _LAYER_PARTITIONS.update((database, table, layer_id) for layer_id in layer_ids)
+    return len(layer_ids)
@@ -0,0 +1,82 @@
+"""
+Point queries (pixel inspect) of raster layers.
+
+Pixel locations are the upper-left corner of the drawn pixel (see tiles.MetaTileLayerManager.get_metatile()),
+so the pixel drawn under a location is the one located at grid column floor(x / pixel size), row ceil(y / pixel size).
+Columnar layers are looked up by this grid index in the layer file, database layers by the snapped location
+(column * pixel size, row * pixel size): an index scan of the half pixel around it, so that exactly one grid location
+matches regardless of floating point differences in the stored locations.
+"""
+import math
+
+from django.conf import settings
+from django.db import connections
+
+from .columnar import VALUE_FIELDNAMES
+from .models import AGGREGATION_METHOD_CHOICES
+
+METERS_SRID = settings.METERS_SRID
+
+
+def get_point_fieldnames(layer):
+    """
+    :return: pixel value fieldnames returned by point queries of the given layer
+    """
+    if layer.is_columnar:
+        return VALUE_FIELDNAMES
+    if layer.data_model == "TextRasterAggregateData":
+        return ("value", "mode")
+    return ("samples",) + tuple(name for name, _ in AGGREGATION_METHOD_CHOICES)
+
+
+def get_pixel_grid_index(x, y, pixel_size):
+    """
+    :param x, y: settings.METERS_SRID coordinates
+    :return: (column, row) of the pixel drawn at the location
+    """
+    return int(math.floor(x / pixel_size)), int(math.ceil(y / pixel_size))
+
+
+def query_pixel(layer, x, y, fieldnames=None):
+    """
+    :param layer: RasterAggregatedLayer object
+    :param x, y: settings.METERS_SRID coordinates
+    :param fieldnames: pixel value fieldnames [DEFAULT=get_point_fieldnames(layer)]
+    :return: ((pixel x, pixel y), {fieldname: value, ...}) of the pixel drawn at the location, or None
+    """
+    if fieldnames is None:
+        fieldnames = get_point_fieldnames(layer)
+    pixel_size = layer.pixel_size_meters
+    if layer.is_columnar:
+        reader = layer.get_columnar_reader()
+        if reader is None:
+            return None
+        column, row = get_pixel_grid_index(x, y, pixel_size)
+        values = reader.get_pixel(column, row, fieldnames)
+        if values is None:
+            return None
+        return (column * pixel_size, row * pixel_size), dict(zip(fieldnames, values))
+
+    DataModel = layer.get_data_model()
+    connection = connections[layer.pixel_database]
+    column, row = get_pixel_grid_index(x, y, pixel_size)
+    sql = """
+        SELECT ST_X(location), ST_Y(location), {fields}
+        FROM {table}
+        WHERE layer_id = %(layer_id)s
+          AND location && ST_MakeEnvelope(%(x)s - %(half)s, %(y)s - %(half)s, %(x)s + %(half)s, %(y)s + %(half)s, %(srid)s)
+        ORDER BY ST_Distance(location, ST_SetSRID(ST_Point(%(x)s, %(y)s), %(srid)s)), id
+        LIMIT 1
+    """.format(table=connection.ops.quote_name(DataModel._meta.db_table),
+               fields=", ".join(connection.ops.quote_name(name) for name in fieldnames))
+    params = {"layer_id": layer.id,
+              "x": column * pixel_size,
+              "y": row * pixel_size,
+              "half": pixel_size / 2,
+              "srid": METERS_SRID}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return (row[0], row[1]), dict(zip(fieldnames, row[2:]))
@@ -0,0 +1,112 @@
+"""
+Placement of raster pixel data (NumericRasterAggregateData, TextRasterAggregateData) across databases.
+
+Layers (and all other models) are stored in the 'default' database,
+the pixels of each layer are stored in one of settings.RASTER_PIXEL_DATABASES selected by layer id.
+
+Querysets without an instance hint cannot be routed by layer, so pixel queries are made with
+RasterAggregatedLayer.pixels() (or .using(layer.pixel_database)).
+
+NOTE: Changing settings.RASTER_PIXEL_DATABASES changes the database of existing layers,
+pixel data must be moved to the new placement.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+PIXEL_APP_LABEL = "raster"
+PIXEL_MODEL_NAMES = ("numericrasteraggregatedata", "textrasteraggregatedata")
+
+
+def is_pixel_model(model):
+    return model._meta.app_label == PIXEL_APP_LABEL and model._meta.model_name in PIXEL_MODEL_NAMES
+
+
+def get_pixel_database(layer_id):
+    """
+    :param layer_id: RasterAggregatedLayer.id
+    :return: database alias where the pixels of the layer are stored
+    """
+    databases = settings.RASTER_PIXEL_DATABASES
+    if layer_id is None:
+        return databases[0]
+    return databases[layer_id % len(databases)]
+
+
+def group_by_pixel_database(layers):
+    """
+    :param layers: RasterAggregatedLayer objects
+    :return: { database alias: [layer, ...], ... }
+    """
+    groups = OrderedDict()
+    for layer in layers:
+        groups.setdefault(get_pixel_database(layer.id), []).append(layer)
+    return groups
+
+
+def _run_on_database(func, database, layers):
+    try:
+        return func(database, layers)
+    finally:
+        # connections are per thread, close the worker thread's connection
+        connections[database].close()
+
+
+def map_pixel_databases(func, layers):
+    """
+    Call func(database, layers) for the layers of each pixel database, in parallel (one thread per database).
+    :param func: function of (database alias, [layer, ...]) returning a dictionary
+    :param layers: RasterAggregatedLayer objects
+    :return: merged dictionary of func results
+    """
+    groups = group_by_pixel_database(layers)
+    results = {}
+    if len(groups) <= 1:
+        for database, database_layers in groups.items():
+            results.update(func(database, database_layers))
+        return results
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [executor.submit(_run_on_database, func, database, database_layers)
+                   for database, database_layers in groups.items()]
+        for future in futures:
+            results.update(future.result())
+    return results
+
+
+class PixelDatabaseRouter:
+    """
+    Routes pixel models to the database of their layer (settings.RASTER_PIXEL_DATABASES),
+    for queries made with an instance hint (pixel.save(), layer.numericrasteraggregatedata_set, ...).
+    """
+
+    def _get_database(self, model, **hints):
+        instance = hints.get("instance", None)
+        if instance is None:
+            return None
+        if is_pixel_model(model):
+            if is_pixel_model(type(instance)):
+                return get_pixel_database(instance.layer_id)
+            # related manager of a layer
+            return get_pixel_database(instance.pk)
+        if is_pixel_model(type(instance)):
+            # objects related to pixels (pixel.layer) are in the default database
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_read = _get_database
+    db_for_write = _get_database
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_pixel_model(type(obj1)) or is_pixel_model(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == PIXEL_APP_LABEL and model_name in PIXEL_MODEL_NAMES:
+            return db == DEFAULT_DB_ALIAS or db in settings.RASTER_PIXEL_DATABASES
+        if db != DEFAULT_DB_ALIAS and db in settings.RASTER_PIXEL_DATABASES:
+            # pixel databases only hold pixel tables
+            return False
+        return None
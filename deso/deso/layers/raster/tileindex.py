@@ -0,0 +1,272 @@
+"""
+Per-layer tile occupancy index.
+
+Records, for each zoom level, which TMS tiles contain (or may contain) layer pixels.
+Used by the tile view to answer requests outside of the layer's data coverage with a shared
+transparent tile, without querying the database or rendering.
+
+Occupied tiles are stored sparsely, as BLOCK_TILES x BLOCK_TILES tile blocks: only blocks containing occupied tiles
+are kept (sorted block keys), each as BLOCK_TILES row bitmaps, so the index size follows the layer's occupied
+tiles rather than its extent (a dense bitmap of a country-wide layer at zoom 19 runs to hundreds of MB).
+"""
+import math
+import array
+import bisect
+import struct
+import zlib
+
+from django.db import connections
+
+
+# Spherical Mercator extents (matches tmstiler.rtm.RasterTileManager)
+SPHERICAL_MERCATOR_MAX = 20037508.34
+SPHERICAL_MERCATOR_WIDTH = SPHERICAL_MERCATOR_MAX * 2
+
+DEFAULT_MAX_ZOOM = 19
+
+BLOCK_TILES = 64  # block width/height in tiles (one uint64 bitmap per block row)
+BLOCK_SHIFT = 6
+BLOCK_MASK = BLOCK_TILES - 1
+ROW_MASK = 2 ** BLOCK_TILES - 1
+
+INDEX_MAGIC = b"DTOI"
+INDEX_VERSION = 1
+HEADER_FORMAT = "<4sBB"  # magic, version, zoom count
+ZOOM_HEADER_FORMAT = "<BII"  # zoom, block count, compressed length (block keys uint64[block count], block rows uint64[block count * BLOCK_TILES])
+
+
+def tile_meters(zoom):
+    """
+    :param zoom: zoom level
+    :return: width (and height) of a tile at the given zoom in spherical-mercator meters
+    """
+    return SPHERICAL_MERCATOR_WIDTH / (2 ** zoom)
+
+
+def get_block_key(tilex, tiley):
+    """
+    :return: row-major key of the block containing the given tile
+    """
+    return ((tiley >> BLOCK_SHIFT) << 32) | (tilex >> BLOCK_SHIFT)
+
+
+def compact_bits(value):
+    """
+    :param value: 64 bit row bitmap
+    :return: 32 bit bitmap, bit i set if bit 2i or 2i + 1 of value is set (parent tiles of a row)
+    """
+    value = (value | (value >> 1)) & 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value >> 4)) & 0x00ff00ff00ff00ff
+    value = (value | (value >> 8)) & 0x0000ffff0000ffff
+    value = (value | (value >> 16)) & 0x00000000ffffffff
+    return value
+
+
+class ZoomBitmap:
+    """
+    Sparse bitmap of occupied tiles for a single zoom level.
+    """
+
+    def __init__(self, zoom, block_keys=None, rows=None):
+        """
+        :param block_keys: array('Q') of the (sorted) occupied block keys, see get_block_key()
+        :param rows: array('Q') of BLOCK_TILES row bitmaps per block (bit n: tilex block x + n), in block key order
+        """
+        self.zoom = zoom
+        self.block_keys = block_keys if block_keys is not None else array.array("Q")
+        self.rows = rows if rows is not None else array.array("Q")
+
+    @classmethod
+    def from_blocks(cls, zoom, blocks):
+        """
+        :param blocks: { block key: [row bitmap, ...(BLOCK_TILES)], ... }
+        """
+        bitmap = cls(zoom)
+        for block_key in sorted(blocks):
+            block_rows = blocks[block_key]
+            if any(block_rows):
+                bitmap.block_keys.append(block_key)
+                bitmap.rows.extend(block_rows)
+        return bitmap
+
+    @classmethod
+    def from_tiles(cls, zoom, tiles):
+        """
+        :param tiles: iterable of (tilex, tiley) tuples
+        """
+        blocks = {}
+        for tilex, tiley in tiles:
+            block_key = get_block_key(tilex, tiley)
+            if block_key not in blocks:
+                blocks[block_key] = [0] * BLOCK_TILES
+            blocks[block_key][tiley & BLOCK_MASK] |= 1 << (tilex & BLOCK_MASK)
+        return cls.from_blocks(zoom, blocks)
+
+    def parent(self):
+        """
+        :return: ZoomBitmap of the parent tiles (zoom - 1)
+        """
+        blocks = {}
+        for block_index, block_key in enumerate(self.block_keys):
+            block_x = block_key & 0xffffffff
+            block_y = block_key >> 32
+            parent_key = ((block_y >> 1) << 32) | (block_x >> 1)
+            if parent_key not in blocks:
+                blocks[parent_key] = [0] * BLOCK_TILES
+            parent_rows = blocks[parent_key]
+            x_shift = (block_x & 1) * (BLOCK_TILES // 2)
+            y_offset = (block_y & 1) * (BLOCK_TILES // 2)
+            first = block_index * BLOCK_TILES
+            for row in range(BLOCK_TILES // 2):
+                value = self.rows[first + 2 * row] | self.rows[first + 2 * row + 1]
+                if value:
+                    parent_rows[y_offset + row] |= compact_bits(value) << x_shift
+        return ZoomBitmap.from_blocks(self.zoom - 1, blocks)
+
+    def contains(self, tilex, tiley):
+        if tilex < 0 or tiley < 0:
+            return False
+        block_key = get_block_key(tilex, tiley)
+        block_index = bisect.bisect_left(self.block_keys, block_key)
+        if block_index >= len(self.block_keys) or self.block_keys[block_index] != block_key:
+            return False
+        return bool((self.rows[block_index * BLOCK_TILES + (tiley & BLOCK_MASK)] >> (tilex & BLOCK_MASK)) & 1)
+
+    def tiles(self):
+        """
+        :return: generator of occupied (tilex, tiley) tuples
+        """
+        for block_index, block_key in enumerate(self.block_keys):
+            min_tilex = (block_key & 0xffffffff) << BLOCK_SHIFT
+            min_tiley = (block_key >> 32) << BLOCK_SHIFT
+            for row in range(BLOCK_TILES):
+                value = self.rows[block_index * BLOCK_TILES + row]
+                while value:
+                    low_bit = value & -value
+                    yield min_tilex + low_bit.bit_length() - 1, min_tiley + row
+                    value ^= low_bit
+
+    def count(self):
+        return sum(bin(value).count("1") for value in self.rows)
+
+
+class TileOccupancyIndex:
+    """
+    Collection of ZoomBitmap objects for zooms 0 to max_zoom.
+    Tiles requested at zooms *above* max_zoom are reported as occupied (unknown).
+    """
+
+    def __init__(self, max_zoom=DEFAULT_MAX_ZOOM):
+        self.max_zoom = max_zoom
+        self.zooms = {}
+
+    @classmethod
+    def from_tile_ranges(cls, tile_ranges, max_zoom=DEFAULT_MAX_ZOOM):
+        """
+        :param tile_ranges: iterable of (min tilex, max tilex, min tiley, max tiley) at max_zoom
+        :return: TileOccupancyIndex
+        """
+        blocks = {}
+        for min_tilex, max_tilex, min_tiley, max_tiley in tile_ranges:
+            for tiley in range(min_tiley, max_tiley + 1):
+                # set the range bits of each block row spanned
+                for block_tilex in range(min_tilex & ~BLOCK_MASK, max_tilex + 1, BLOCK_TILES):
+                    first_tilex = max(block_tilex, min_tilex)
+                    last_tilex = min(block_tilex | BLOCK_MASK, max_tilex)
+                    block_key = get_block_key(first_tilex, tiley)
+                    if block_key not in blocks:
+                        blocks[block_key] = [0] * BLOCK_TILES
+                    bits = ((1 << (last_tilex - first_tilex + 1)) - 1) << (first_tilex & BLOCK_MASK)
+                    blocks[block_key][tiley & BLOCK_MASK] |= bits
+        index = cls(max_zoom)
+        bitmap = ZoomBitmap.from_blocks(max_zoom, blocks)
+        for zoom in range(max_zoom, -1, -1):
+            index.zooms[zoom] = bitmap
+            if zoom:
+                bitmap = bitmap.parent()
+        return index
+
+    def contains(self, zoom, tilex, tiley):
+        if zoom > self.max_zoom or zoom not in self.zooms:
+            return True
+        return self.zooms[zoom].contains(tilex, tiley)
+
+    def tiles(self, zoom):
+        """
+        :return: generator of occupied (tilex, tiley) tuples at the given zoom
+        """
+        return self.zooms[zoom].tiles()
+
+    def to_bytes(self):
+        parts = [struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, len(self.zooms))]
+        for zoom in sorted(self.zooms):
+            bitmap = self.zooms[zoom]
+            compressed = zlib.compress(bitmap.block_keys.tobytes() + bitmap.rows.tobytes())
+            parts.append(struct.pack(ZOOM_HEADER_FORMAT, zoom, len(bitmap.block_keys), len(compressed)))
+            parts.append(compressed)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        magic, version, zoom_count = struct.unpack_from(HEADER_FORMAT, data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Unsupported tile index (magic={}, version={})".format(magic, version))
+        offset = struct.calcsize(HEADER_FORMAT)
+        zoom_header_size = struct.calcsize(ZOOM_HEADER_FORMAT)
+        index = cls(max_zoom=-1)
+        for _ in range(zoom_count):
+            zoom, block_count, length = struct.unpack_from(ZOOM_HEADER_FORMAT, data, offset)
+            offset += zoom_header_size
+            values = array.array("Q", zlib.decompress(data[offset:offset + length]))
+            offset += length
+            index.zooms[zoom] = ZoomBitmap(zoom, values[:block_count], values[block_count:])
+            index.max_zoom = max(index.max_zoom, zoom)
+        return index
+
+
+def build_tile_index(layer, max_zoom=DEFAULT_MAX_ZOOM):
+    """
+    Build the TileOccupancyIndex for the given RasterAggregatedLayer from the layer's pixel data.
+
+    Tile requests query pixels *within* the tile bbox buffered by the layer pixel size,
+    so each pixel location marks all tiles within +/- pixel_size of the location.
+    :param layer: RasterAggregatedLayer object
+    :return: TileOccupancyIndex
+    """
+    pixel_size = layer.pixel_size_meters
+    size = tile_meters(max_zoom)
+    maximum_tile = 2 ** max_zoom - 1
+    if layer.is_columnar:
+        reader = layer.get_columnar_reader()
+        tile_ranges = set()
+        if reader is not None:
+            for x, y in reader.iter_pixels(()):
+                tile_ranges.add((math.floor((x - pixel_size + SPHERICAL_MERCATOR_MAX) / size),
+                                 math.floor((x + pixel_size + SPHERICAL_MERCATOR_MAX) / size),
+                                 math.floor((y - pixel_size + SPHERICAL_MERCATOR_MAX) / size),
+                                 math.floor((y + pixel_size + SPHERICAL_MERCATOR_MAX) / size)))
+        tile_ranges = [tuple(min(max(int(v), 0), maximum_tile) for v in row) for row in tile_ranges]
+        return TileOccupancyIndex.from_tile_ranges(tile_ranges, max_zoom=max_zoom)
+    DataModel = layer.get_data_model()
+    connection = connections[layer.pixel_database]
+    sql = """
+        SELECT DISTINCT
+            floor((ST_X(location) - %(pixel_size)s + %(offset)s) / %(size)s)::bigint,
+            floor((ST_X(location) + %(pixel_size)s + %(offset)s) / %(size)s)::bigint,
+            floor((ST_Y(location) - %(pixel_size)s + %(offset)s) / %(size)s)::bigint,
+            floor((ST_Y(location) + %(pixel_size)s + %(offset)s) / %(size)s)::bigint
+        FROM {table}
+        WHERE layer_id = %(layer_id)s
+    """.format(table=connection.ops.quote_name(DataModel._meta.db_table))
+    params = {"pixel_size": pixel_size,
+              "offset": SPHERICAL_MERCATOR_MAX,
+              "size": size,
+              "layer_id": layer.id}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        # ranges are streamed from the cursor (not materialized as a list)
+        tile_ranges = (tuple(min(max(int(v), 0), maximum_tile) for v in row) for row in cursor)
+        return TileOccupancyIndex.from_tile_ranges(tile_ranges, max_zoom=max_zoom)
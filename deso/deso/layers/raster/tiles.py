@@ -0,0 +1,476 @@
+"""
+Tile serving helpers shared by the raster tile views and management commands.
+"""
+import time
+import logging
+import mimetypes
+from io import BytesIO
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.gis.geos import Polygon
+from PIL import Image, ImageDraw, ImageColor
+from tmstiler.django import DjangoRasterTileLayerManager, LayerNotConfigured, SPHERICAL_MERCATOR_SRID
+
+from deso import singleflight
+from deso import metrics
+from deso.instrumentation import phase, count
+from .tileindex import TileOccupancyIndex
+from .mbtiles import get_mbtiles_reader
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+TILE_PIXELS = 256
+HIDPI_SCALE = 2  # '@2x' tiles, TILE_PIXELS * HIDPI_SCALE pixels covering the same extent
+TRANSPARENT = (255, 255, 255, 0)
+TRANSPARENT_PALETTE_INDEX = 0
+MAXIMUM_PALETTE_COLORS = 255  # excluding the transparent palette entry
+
+# image encodings available for rendered tiles
+# --> encoding: response mimetype
+TILE_IMAGE_ENCODINGS = OrderedDict((
+    ("png", "image/png"),
+    ("webp", "image/webp"),
+))
+
+# tile serving state of a layer
+# --> tile_index: TileOccupancyIndex or None, archive_filepath: MBTiles archive path or None,
+#     legend_id & legend_version: identify the colors of rendered tiles,
+#     data_version: identifies the layer's pixel data (legend & data versions are used for tile ETags)
+LayerTileState = namedtuple("LayerTileState", ("tile_index", "archive_filepath", "legend_id", "legend_version", "data_version"))
+
+# process-local cache of LayerTileState objects
+# --> { layer_id: (loaded timestamp, LayerTileState or None), ... }
+_LAYER_TILE_STATES = {}
+
+# process-local cache of encoded empty (fully transparent) tiles
+# --> { (image_encoding, scale): bytes, ... }
+_EMPTY_TILES = {}
+
+
+def get_scale_suffix(scale=1):
+    """
+    :return: tile name suffix for the given tile scale ('' or '@2x')
+    """
+    return "@{}x".format(scale) if scale != 1 else ""
+
+
+def get_metatile_size(scale=1):
+    """
+    :return: default metatile size (in tiles) for the given tile scale,
+             scaled tiles use smaller metatiles so that the rendered image size stays the same
+    """
+    return max(1, settings.RASTER_METATILE_SIZE // scale)
+
+
+def get_tile_cache_key(layer_id, zoom, tilex, tiley, image_encoding="png", scale=1):
+    """
+    :return: 'tilecache' key for the given layer tile
+    """
+    return "raster:{}:{}:{}:{}{}.{}".format(layer_id, zoom, tilex, tiley, get_scale_suffix(scale), image_encoding)
+
+
+def get_metatile_cache_key(layer_id, zoom, tilex, tiley, image_encoding="png", metatile_size=None, scale=1):
+    """
+    :return: key identifying the metatile containing the given tile (used to coalesce concurrent renders)
+    """
+    if metatile_size is None:
+        metatile_size = get_metatile_size(scale)
+    size = min(metatile_size, 2 ** zoom)
+    return "raster-meta:{}:{}:{}:{}{}.{}".format(layer_id, zoom, tilex // size, tiley // size, get_scale_suffix(scale), image_encoding)
+
+
+def get_tile_etag(layer_id, layer_state, zoom, tilex, tiley, image_encoding="png", scale=1):
+    """
+    :param layer_state: LayerTileState
+    :return: ETag of the given layer tile, changes when the layer legend or pixel data (data_version) is changed
+    """
+    return '"raster-{}-{}.{}-{}-{}-{}-{}{}.{}"'.format(layer_id,
+                                                      layer_state.legend_id,
+                                                      layer_state.legend_version,
+                                                      layer_state.data_version,
+                                                      zoom,
+                                                      tilex,
+                                                      tiley,
+                                                      get_scale_suffix(scale),
+                                                      image_encoding)
+
+
+def clear_layer_tiles(layer_id):
+    """
+    Remove the cached tiles of the given layer from the 'tilecache'.
+    If the configured cache backend does not support namespace deletion, the full cache is cleared.
+    """
+    # reload the layer's tile state (legend version) on the next request in this process
+    _LAYER_TILE_STATES.pop(int(layer_id), None)
+    cache = caches["tilecache"]
+    if hasattr(cache, "delete_namespace"):
+        cache.delete_namespace("raster:{}".format(layer_id))
+    else:
+        cache.clear()
+
+
+def get_tile_mimetype(image_encoding):
+    if image_encoding in TILE_IMAGE_ENCODINGS:
+        return TILE_IMAGE_ENCODINGS[image_encoding]
+    return mimetypes.types_map.get(".{}".format(image_encoding), "application/octet-stream")
+
+
+def encode_tile(tile_pil_img_object, image_encoding="png"):
+    """
+    :param tile_pil_img_object: PIL Image object ('P' palette mode with TRANSPARENT_PALETTE_INDEX, or 'RGBA')
+    :return: encoded image bytes
+    """
+    # pillow tile_pil_img_object.tobytes() returns raw pixel data, encode to the image format via BytesIO()
+    image_fileio = BytesIO()
+    if image_encoding == "png":
+        options = {"compress_level": settings.RASTER_PNG_COMPRESS_LEVEL}
+        if tile_pil_img_object.mode == "P":
+            # 8-bit palette png
+            options["transparency"] = TRANSPARENT_PALETTE_INDEX
+        tile_pil_img_object.save(image_fileio, "png", **options)
+    elif image_encoding == "webp":
+        if tile_pil_img_object.mode == "P":
+            tile_pil_img_object = palette_to_rgba(tile_pil_img_object)
+        tile_pil_img_object.save(image_fileio, "webp", **settings.RASTER_WEBP_OPTIONS)
+    else:
+        if tile_pil_img_object.mode == "P":
+            tile_pil_img_object = palette_to_rgba(tile_pil_img_object)
+        tile_pil_img_object.save(image_fileio, image_encoding)
+    return image_fileio.getvalue()
+
+
+def palette_to_rgba(tile_pil_img_object):
+    """
+    :param tile_pil_img_object: 'P' mode PIL Image object with TRANSPARENT_PALETTE_INDEX
+    :return: 'RGBA' PIL Image object
+    """
+    tile_pil_img_object.info["transparency"] = TRANSPARENT_PALETTE_INDEX
+    return tile_pil_img_object.convert("RGBA")
+
+
+def new_palette_image(size, rgb_colors):
+    """
+    :param size: (width, height)
+    :param rgb_colors: list of up to MAXIMUM_PALETTE_COLORS (r, g, b) tuples,
+                       the color at rgb_colors[i] is drawn with the palette index i + 1
+    :return: 'P' mode PIL Image object filled with the TRANSPARENT_PALETTE_INDEX
+    """
+    assert len(rgb_colors) <= MAXIMUM_PALETTE_COLORS
+    image = Image.new("P", size, TRANSPARENT_PALETTE_INDEX)
+    palette = list(TRANSPARENT[:3])
+    for rgb in rgb_colors:
+        palette.extend(rgb)
+    image.putpalette(palette)
+    return image
+
+
+def get_empty_tile(image_encoding="png", scale=1):
+    """
+    :return: encoded fully transparent tile (shared for all layers)
+    """
+    key = (image_encoding, scale)
+    if key not in _EMPTY_TILES:
+        tile_image = new_palette_image((TILE_PIXELS * scale, TILE_PIXELS * scale), [])
+        _EMPTY_TILES[key] = encode_tile(tile_image, image_encoding)
+    return _EMPTY_TILES[key]
+
+
+def get_layer_tile_state(layer_id):
+    """
+    Retrieve the tile serving state of the given layer.
+    States are cached in-process for settings.RASTER_TILE_INDEX_CACHE_SECONDS,
+    so that serving a tile does not require a database query per tile request.
+    :param layer_id: RasterAggregatedLayer.id
+    :return: LayerTileState or None if the layer does not exist
+    """
+    from .models import RasterAggregatedLayer  # avoid circular import
+
+    layer_id = int(layer_id)
+    now = time.time()
+    cached = _LAYER_TILE_STATES.get(layer_id, None)
+    if cached and now - cached[0] < settings.RASTER_TILE_INDEX_CACHE_SECONDS:
+        return cached[1]
+    state = None
+    values = RasterAggregatedLayer.objects.filter(id=layer_id).values_list("tile_index",
+                                                                           "archive_filepath",
+                                                                           "legend_id",
+                                                                           "legend__version",
+                                                                           "data_version").first()
+    if values is not None:
+        tile_index_data, archive_filepath, legend_id, legend_version, data_version = values
+        tile_index = None
+        if tile_index_data is not None:
+            tile_index = TileOccupancyIndex.from_bytes(tile_index_data)
+        state = LayerTileState(tile_index, archive_filepath, legend_id, legend_version, data_version)
+    _LAYER_TILE_STATES[layer_id] = (now, state)
+    return state
+
+
+def get_tile_layer_manager(layername):
+    """
+    :param layername: requested layer name (RasterAggregatedLayer.id)
+    :return: MetaTileLayerManager configured for the requested layer
+    """
+    from .models import RasterAggregatedLayer  # avoid circular import
+
+    layers = OrderedDict()
+    raster_layers = RasterAggregatedLayer.objects.none()
+    if str(layername).isdigit():
+        raster_layers = RasterAggregatedLayer.objects.filter(id=int(layername))
+    for raster_layer in raster_layers:
+        if raster_layer.legend is not None:
+            # Only add layers with defined legends
+            #  --> raster tiles cannot be created without a color scheme, a legend is necessary for tile generation!
+            if raster_layer.is_columnar:
+                # pixels are read from the memory-mapped layer file
+                qs = None
+                columnar_reader = raster_layer.get_columnar_reader()
+            else:
+                qs = raster_layer.pixels()
+                columnar_reader = None
+            layers[str(raster_layer.id)] = {
+                        "pixel_size": raster_layer.pixel_size_meters,  # currently hard-coded in measurements.management.commands.load_safecast_csv
+                        "point_position": "upperleft",
+                        "model_queryset": qs,
+                        "columnar_reader": columnar_reader,
+                        "model_point_fieldname": "location",
+                        "model_value_fieldname": raster_layer.value_fieldname,
+                        "round_pixels": False,
+                        "legend_instance": raster_layer.legend,  # object with '.get_color_str()' method that returns an rgb() or hsl() color string.
+                        }
+        else:
+            logger.warn("RasterAggregatedLayer:  {} has no legend defined!".format(str(raster_layer)))
+
+    return MetaTileLayerManager(layers)
+
+
+def is_empty_tile_image(tile_pil_img_object):
+    """
+    :return: True if all pixels of the given 'P' (TRANSPARENT_PALETTE_INDEX) or 'RGBA' image are fully transparent
+    """
+    if tile_pil_img_object.mode == "P":
+        return tile_pil_img_object.getbbox() is None
+    alpha = tile_pil_img_object.split()[-1]
+    return alpha.getbbox() is None
+
+
+class MetaTileLayerManager(DjangoRasterTileLayerManager):
+    """
+    Extends the tmstiler DjangoRasterTileLayerManager with metatile rendering.
+    A metatile is an NxN block of tiles rendered from a single query and image, then sliced to individual tiles.
+    """
+
+    def get_metatile_origin(self, zoom, tilex, tiley, metatile_size):
+        """
+        :return: size, (origin tilex, origin tiley) of the metatile containing the given tile
+        """
+        size = min(metatile_size, 2 ** zoom)
+        return size, ((tilex // size) * size, (tiley // size) * size)
+
+    def get_metatile(self, layername, zoom, tilex, tiley, metatile_size=None, scale=1):
+        """
+        Render the metatile containing the given tile.
+        :param layername: Needed to retrieve layer specific configuration
+        :param zoom: Zoom Level
+        :param tilex: tile x value of a tile within the metatile
+        :param tiley: tile y value of a tile within the metatile
+        :param metatile_size: number of tiles per metatile dimension [DEFAULT=get_metatile_size(scale)]
+        :param scale: tile resolution multiplier (2 for 512 pixel '@2x' tiles of the same extent)
+        :return: { (tilex, tiley): <tile PIL image object>, ... }
+        """
+        layer_config = self.layers_config.get(layername, None)
+        if not layer_config:
+            raise LayerNotConfigured("layers_config[{}] not found in: {}".format(layername, str(self.layers_config.keys())))
+        if metatile_size is None:
+            metatile_size = get_metatile_size(scale)
+        tile_pixels_width = self.tile_pixels_width * scale
+        tile_pixels_height = self.tile_pixels_height * scale
+
+        size, (origin_tilex, origin_tiley) = self.get_metatile_origin(zoom, tilex, tiley, metatile_size)
+        # (xmin, ymin, xmax, ymax) of the full metatile in SPHERICAL_MERCATOR_SRID
+        meta_xmin, meta_ymin, _, _ = self.tile_sphericalmercator_extent(zoom, origin_tilex, origin_tiley)
+        _, _, meta_xmax, meta_ymax = self.tile_sphericalmercator_extent(zoom, origin_tilex + size - 1, origin_tiley + size - 1)
+        meta_bbox = Polygon.from_bbox((meta_xmin, meta_ymin, meta_xmax, meta_ymax))
+        meta_bbox.srid = SPHERICAL_MERCATOR_SRID
+        pixel_size = layer_config["pixel_size"]
+        # expand bbox by 1 pixel(bin_size) to assure edge data is included
+        buffered_bbox = meta_bbox.buffer(pixel_size, quadsegs=2)
+
+        image_pixels = size * tile_pixels_width
+        meters_per_pixel = (meta_xmax - meta_xmin) / image_pixels
+
+        # retrieve only the point x/y and value to avoid model & geometry object creation per pixel
+        legend = layer_config["legend_instance"]
+        point_fieldname = layer_config["model_point_fieldname"]
+        value_fieldname = layer_config["model_value_fieldname"]
+        kwargs = {"{}__within".format(point_fieldname): buffered_bbox, }
+        with phase("query"):
+            columnar_reader = layer_config.get("columnar_reader", None)
+            if columnar_reader is not None:
+                pixel_values = columnar_reader.query(meta_xmin - pixel_size, meta_ymin - pixel_size,
+                                                     meta_xmax + pixel_size, meta_ymax + pixel_size,
+                                                     value_fieldname)
+            elif layer_config["model_queryset"] is None:
+                pixel_values = []  # columnar layer file not (yet) written
+            else:
+                pixel_values = layer_config["model_queryset"].filter(**kwargs).extra(
+                    select={"pixel_x": "ST_X({})".format(point_fieldname),
+                            "pixel_y": "ST_Y({})".format(point_fieldname)}
+                ).values_list("pixel_x", "pixel_y", value_fieldname)
+                pixel_values = [row for row in pixel_values if row[2] is not None]
+        count("rows", len(pixel_values))
+
+        with phase("color"):
+            # legend colors of the metatile values
+            # --> { value: color str, ... }
+            value_colors = {}
+            for _, _, value in pixel_values:
+                if value not in value_colors:
+                    value_colors[value] = legend.get_value_color_str(value)
+            color_strs = sorted(set(value_colors.values()))
+            if settings.RASTER_TILE_PALETTE and len(color_strs) <= MAXIMUM_PALETTE_COLORS:
+                # legends produce few distinct colors, draw with palette indexes for 8-bit palette tiles
+                meta_image = new_palette_image((image_pixels, image_pixels), [ImageColor.getrgb(c) for c in color_strs])
+                color_indexes = {color_str: index for index, color_str in enumerate(color_strs, 1)}
+                colors = {value: color_indexes[color_str] for value, color_str in value_colors.items()}
+            else:
+                meta_image = Image.new("RGBA", (image_pixels, image_pixels), TRANSPARENT)
+                colors = value_colors
+
+        with phase("draw"):
+            draw = ImageDraw.Draw(meta_image)
+            for x, y, value in pixel_values:
+                # model points represent the upper-left of the pixel
+                left = int((x - meta_xmin) / meters_per_pixel)
+                top = int((meta_ymax - y) / meters_per_pixel)
+                right = int((x + pixel_size - meta_xmin) / meters_per_pixel)
+                bottom = int((meta_ymax - (y - pixel_size)) / meters_per_pixel)
+                draw.rectangle((left, top, right, bottom), fill=colors[value])
+
+            # slice metatile into tiles
+            # --> TMS tiley increases from the bottom, image rows increase from the top
+            tiles = {}
+            for x_offset in range(size):
+                for y_offset in range(size):
+                    row = size - 1 - y_offset
+                    box = (x_offset * tile_pixels_width,
+                           row * tile_pixels_height,
+                           (x_offset + 1) * tile_pixels_width,
+                           (row + 1) * tile_pixels_height)
+                    tiles[(origin_tilex + x_offset, origin_tiley + y_offset)] = meta_image.crop(box)
+        return tiles
+
+
+def render_metatile(tilemgr, layername, zoom, tilex, tiley, image_encoding="png", tile_index=None, cache=None, scale=1):
+    """
+    Render, encode and cache (if cache is given) all tiles of the metatile containing the given tile.
+    Tiles outside of the tile_index (if given) are not cached, as they are served without rendering.
+    :param tilemgr: MetaTileLayerManager
+    :param scale: tile resolution multiplier (see MetaTileLayerManager.get_metatile())
+    :return: { (tilex, tiley): encoded tile bytes, ... }
+    """
+    tile_images = tilemgr.get_metatile(layername, zoom, tilex, tiley, scale=scale)
+    encoded_tiles = {}
+    with phase("encode"):
+        for (x, y), tile_image in tile_images.items():
+            if tile_index is not None and not tile_index.contains(zoom, x, y):
+                continue
+            if is_empty_tile_image(tile_image):
+                encoded_tiles[(x, y)] = get_empty_tile(image_encoding, scale)
+            else:
+                encoded_tiles[(x, y)] = encode_tile(tile_image, image_encoding)
+        if (tilex, tiley) not in encoded_tiles:
+            # requested tile is expected to be served even if not in the index
+            encoded_tiles[(tilex, tiley)] = encode_tile(tile_images[(tilex, tiley)], image_encoding)
+    count("encoded_tiles", len(encoded_tiles))
+
+    if cache is not None:
+        with phase("cache_set"):
+            cache.set_many({get_tile_cache_key(layername, zoom, x, y, image_encoding, scale): content
+                            for (x, y), content in encoded_tiles.items()},
+                           settings.RASTER_TILE_CACHE_SECONDS)
+    return encoded_tiles
+
+
+def get_layer_tiles(layername, layer_state, zoom, tile_xys, image_encoding="png", scale=1):
+    """
+    Retrieve the encoded tiles of a layer.
+    Tiles outside of the layer tile index are not looked up, archived layers are read from the layer archive,
+    otherwise tiles are read from the 'tilecache' and missing tiles are rendered once per metatile.
+    :param layername: RasterAggregatedLayer.id
+    :param layer_state: LayerTileState
+    :param tile_xys: iterable of (tilex, tiley) at the given zoom
+    :return: { (tilex, tiley): encoded tile bytes, ... }
+    """
+    tile_index = layer_state.tile_index
+    empty_tile = get_empty_tile(image_encoding, scale)
+    encoded_tiles = {}
+    requested_xys = []
+    for tilex, tiley in tile_xys:
+        if tile_index is not None and not tile_index.contains(zoom, tilex, tiley):
+            encoded_tiles[(tilex, tiley)] = empty_tile
+        else:
+            requested_xys.append((tilex, tiley))
+    if not requested_xys:
+        return encoded_tiles
+
+    if layer_state.archive_filepath:
+        with phase("archive"):
+            archive = get_mbtiles_reader(layer_state.archive_filepath)
+            for tilex, tiley in requested_xys:
+                content = archive.get_tile(zoom, tilex, tiley)
+                encoded_tiles[(tilex, tiley)] = content if content is not None else empty_tile
+        return encoded_tiles
+
+    cache = caches["tilecache"]
+    cache_keys = OrderedDict((get_tile_cache_key(layername, zoom, x, y, image_encoding, scale), (x, y)) for x, y in requested_xys)
+    with phase("cache_get"):
+        cached_tiles = cache.get_many(list(cache_keys.keys()))
+    count("cache_hits", len(cached_tiles))
+    metrics.incr("tile_cache_hits_total", len(cached_tiles), layer=layername)
+    metrics.incr("tile_cache_misses_total", len(cache_keys) - len(cached_tiles), layer=layername)
+
+    # group missing tiles by metatile
+    # --> { metatile key: [(tilex, tiley), ...], ... }
+    metatiles = OrderedDict()
+    for cache_key, (tilex, tiley) in cache_keys.items():
+        if cache_key in cached_tiles:
+            encoded_tiles[(tilex, tiley)] = cached_tiles[cache_key]
+        else:
+            metatile_key = get_metatile_cache_key(layername, zoom, tilex, tiley, image_encoding, scale=scale)
+            metatiles.setdefault(metatile_key, []).append((tilex, tiley))
+
+    tilemgrs = []  # created on first render, shared by the following metatiles
+    for metatile_key, metatile_xys in metatiles.items():
+        # render the metatile with a single query, all resulting tiles are cached
+        # --> concurrent requests for tiles in the same metatile wait for a single render (across threads & processes)
+        def render(tilex=metatile_xys[0][0], tiley=metatile_xys[0][1]):
+            if not tilemgrs:
+                tilemgrs.append(get_tile_layer_manager(layername))
+            start = time.perf_counter()
+            rendered_tiles = render_metatile(tilemgrs[0], layername, zoom, tilex, tiley, image_encoding, tile_index, cache, scale)
+            metrics.observe("tile_render_ms", (time.perf_counter() - start) * 1000, layer=layername)
+            return rendered_tiles
+
+        def fetch(metatile_xys=metatile_xys):
+            keys = {get_tile_cache_key(layername, zoom, x, y, image_encoding, scale): (x, y) for x, y in metatile_xys}
+            with phase("cache_get"):
+                fetched = cache.get_many(list(keys.keys()))
+            if len(fetched) != len(keys):
+                return None
+            return {keys[key]: content for key, content in fetched.items()}
+
+        # 'render' includes the query, color, draw, encode & cache_set phases, or the time waiting for another render
+        with phase("render"):
+            metatile_tiles = singleflight.do(metatile_key, render, fetch)
+        for tilex, tiley in metatile_xys:
+            content = metatile_tiles.get((tilex, tiley), None)
+            if content is None:
+                # coalesced result did not include this tile
+                metatile_tiles = render(tilex, tiley)
+                content = metatile_tiles[(tilex, tiley)]
+            encoded_tiles[(tilex, tiley)] = content
+    return encoded_tiles
@@ -1,10 +1,15 @@
 from django.conf.urls import patterns, url
-from django.views.decorators.cache import cache_page
-from .views import RasterLayersTileView, get_legend, get_layers
+from deso.instrumentation import instrument
+from .views import RasterLayersTileView, get_legend, get_layers, get_tile_batch, get_tile_timings, get_zonal_stats, \
+    get_point_values, get_grid_tile
 
-FIVE_DAYS = (60 * 60 * 24 * 5)  # seconds * minutes * hours * days
 urlpatterns = patterns('',
     url(r'^layers/$', get_layers),
-    url(r'^layer/', cache_page(FIVE_DAYS, cache="tilecache")(RasterLayersTileView.as_view())),
+    url(r'^layer/', instrument("tile")(RasterLayersTileView.as_view())),  # tiles are cached to the 'tilecache' by the view
+    url(r'^batch/(?P<layer_id>\d+)/$', instrument("tile-batch")(get_tile_batch)),  # multiple tiles per request, see static/js/tilebatch.js
+    url(r'^timings/$', get_tile_timings),  # tile phase timing histograms (ops)
+    url(r'^grid/(?P<layer_id>\d+)/(?P<zoom>\d+)/(?P<tilex>\d+)/(?P<tiley>\d+)\.json$', instrument("grid")(get_grid_tile)),  # UTFGrid tiles, see utfgrid.py
+    url(r'^point/(?P<layer_id>\d+)/$', instrument("point")(get_point_values)),  # pixel values at a lon/lat
+    url(r'^zonal/(?P<layer_id>\d+)/$', instrument("zonal")(get_zonal_stats)),  # statistics within a polygon, see zonal.py
     url(r'^legend/(?P<legend_id>\d+)/$', get_legend),  # for display on leaflet map
 )
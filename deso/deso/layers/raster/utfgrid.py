@@ -0,0 +1,150 @@
+"""
+UTFGrid interaction tiles of raster layers (https://github.com/mapbox/utfgrid-spec, version 1.2).
+
+Each grid tile maps the (TILE_PIXELS / UTFGRID_RESOLUTION)^2 cells of a tile to the pixel drawn at the cell center,
+and includes the pixel values (see pointquery.get_point_fieldnames()), so that the map displays the values under
+the mouse without a request per mouse move.
+Encoded grids are stored gzip compressed in the 'tilecache', alongside (and cleared with) the layer's image tiles.
+"""
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from deso.compression import gzip_compress
+from deso.instrumentation import phase, count
+from .tileindex import SPHERICAL_MERCATOR_MAX, tile_meters
+from .tiles import TILE_PIXELS, get_tile_cache_key
+from .models import RasterAggregatedLayer
+from .pointquery import get_point_fieldnames
+
+METERS_SRID = settings.METERS_SRID
+
+UTFGRID_RESOLUTION = 4  # tile pixels per grid cell
+UTFGRID_ENCODING = "grid.json"  # 'tilecache' key suffix
+
+_EMPTY_UTFGRID = None
+
+
+def encode_grid_id(index):
+    """
+    :return: UTFGrid character of the given key index (skipping '"' and '\\')
+    """
+    code = index + 32
+    if code >= 34:
+        code += 1
+    if code >= 92:
+        code += 1
+    return chr(code)
+
+
+def get_empty_utfgrid():
+    """
+    :return: gzip compressed UTFGrid json of a tile without pixels (shared for all layers)
+    """
+    global _EMPTY_UTFGRID
+    if _EMPTY_UTFGRID is None:
+        dimension = TILE_PIXELS // UTFGRID_RESOLUTION
+        _EMPTY_UTFGRID = gzip_compress(json.dumps({"grid": [" " * dimension] * dimension, "keys": [""], "data": {}}))
+    return _EMPTY_UTFGRID
+
+
+def query_tile_pixels(layer, xmin, ymin, xmax, ymax, fieldnames):
+    """
+    :param xmin, ymin, xmax, ymax: bbox in settings.METERS_SRID
+    :return: [(x, y, value, ...), ...] of the layer's pixels located within the bbox
+    """
+    pixel_size = layer.pixel_size_meters
+    if layer.is_columnar:
+        reader = layer.get_columnar_reader()
+        if reader is None:
+            return []
+        bounds = (int(xmin // pixel_size), int(ymin // pixel_size), int(xmax // pixel_size) + 1, int(ymax // pixel_size) + 1)
+        return [(column * pixel_size, row * pixel_size) + tuple(values)
+                for column, row, *values in reader.query_grid(*bounds, fieldnames=fieldnames)]
+
+    DataModel = layer.get_data_model()
+    connection = connections[layer.pixel_database]
+    sql = """
+        SELECT ST_X(location), ST_Y(location), {fields}
+        FROM {table}
+        WHERE layer_id = %(layer_id)s
+          AND location && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s)
+    """.format(table=connection.ops.quote_name(DataModel._meta.db_table),
+               fields=", ".join(connection.ops.quote_name(name) for name in fieldnames))
+    params = {"layer_id": layer.id, "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax, "srid": METERS_SRID}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def render_utfgrid(layer, zoom, tilex, tiley):
+    """
+    :param layer: RasterAggregatedLayer object
+    :param tilex, tiley: TMS tile
+    :return: UTFGrid dictionary of the tile
+    """
+    pixel_size = layer.pixel_size_meters
+    size = tile_meters(zoom)
+    tile_xmin = tilex * size - SPHERICAL_MERCATOR_MAX
+    tile_ymax = (tiley + 1) * size - SPHERICAL_MERCATOR_MAX
+    dimension = TILE_PIXELS // UTFGRID_RESOLUTION
+    cell_meters = size / dimension
+    fieldnames = get_point_fieldnames(layer)
+    with phase("query"):
+        # pixel locations are the upper-left of the drawn pixel
+        pixels = query_tile_pixels(layer, tile_xmin - pixel_size, tile_ymax - size, tile_xmin + size, tile_ymax + pixel_size, fieldnames)
+    count("rows", len(pixels))
+
+    with phase("draw"):
+        # key index per cell (0: no pixel), pixels are drawn in query order as in the image tiles
+        cells = [[0] * dimension for _ in range(dimension)]
+        for index, (x, y, *_) in enumerate(pixels, 1):
+            # cells with centers within [x, x + pixel_size], [y - pixel_size, y]
+            first_column = max(int(math.ceil((x - tile_xmin) / cell_meters - 0.5)), 0)
+            last_column = min(int(math.floor((x + pixel_size - tile_xmin) / cell_meters - 0.5)), dimension - 1)
+            first_row = max(int(math.ceil((tile_ymax - y) / cell_meters - 0.5)), 0)
+            last_row = min(int(math.floor((tile_ymax - y + pixel_size) / cell_meters - 0.5)), dimension - 1)
+            for row in range(first_row, last_row + 1):
+                cells_row = cells[row]
+                for column in range(first_column, last_column + 1):
+                    cells_row[column] = index
+
+    with phase("encode"):
+        # only pixels visible in the grid are included in the keys & data
+        keys = [""]
+        data = {}
+        characters = {0: " "}
+        grid = []
+        for cells_row in cells:
+            for index in cells_row:
+                if index not in characters:
+                    x, y, *values = pixels[index - 1]
+                    key = "{:.0f}:{:.0f}".format(x, y)
+                    characters[index] = encode_grid_id(len(keys))
+                    keys.append(key)
+                    data[key] = dict(zip(fieldnames, values))
+            grid.append("".join(characters[index] for index in cells_row))
+    return {"grid": grid, "keys": keys, "data": data}
+
+
+def get_layer_utfgrid(layer_id, zoom, tilex, tiley):
+    """
+    Retrieve the gzip compressed UTFGrid json of a layer tile from the 'tilecache', rendering (and caching) missing grids.
+    :param layer_id: RasterAggregatedLayer.id
+    :return: gzip compressed UTFGrid json bytes
+    """
+    cache = caches["tilecache"]
+    cache_key = get_tile_cache_key(layer_id, zoom, tilex, tiley, UTFGRID_ENCODING)
+    with phase("cache_get"):
+        content = cache.get(cache_key)
+    if content is not None:
+        count("cache_hits")
+        return content
+    layer = RasterAggregatedLayer.objects.get(id=layer_id)
+    content = gzip_compress(json.dumps(render_utfgrid(layer, zoom, tilex, tiley)))
+    with phase("cache_set"):
+        cache.set(cache_key, content, settings.RASTER_TILE_CACHE_SECONDS)
+    return content
@@ -1,20 +1,47 @@
-import logging
+import time
+import gzip
 import json
-from collections import OrderedDict
-from io import BytesIO
+import struct
+import logging
 from colorsys import hls_to_rgb
 
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.apps import apps
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, GEOSException, Point
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, Http404
+from django.utils.cache import patch_response_headers
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
-from tmstiler.django import DjangoRasterTileLayerManager, LayerNotConfigured
+from tmstiler.rtm import RasterTileManager
+from tmstiler.django import LayerNotConfigured
 
-from .models import RasterAggregatedLayer, ScaledColorLegend
+from deso import instrumentation
+from deso import metrics
+from deso.compression import json_response, precompressed_response, accepted_encodings
+from deso.tilecache import content_digest
+from .models import RasterAggregatedLayer, ScaledColorLegend, prefetch_pixel_extents
+from .tiles import get_layer_tiles, get_tile_mimetype, get_empty_tile, get_layer_tile_state, get_tile_etag, get_scale_suffix, TILE_IMAGE_ENCODINGS, HIDPI_SCALE
+from .mbtiles import get_mbtiles_reader
+from .zonal import get_zonal_statistics, ZonalQueryError
+from .pointquery import query_pixel
+from .utfgrid import get_layer_utfgrid, get_empty_utfgrid
 
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+WGS84_SRID = settings.WGS84_SRID
+METERS_SRID = settings.METERS_SRID
+
+# batch tile response record header: zoom, tilex, tiley, encoded tile length
+BATCH_RECORD_HEADER_FORMAT = "<BIII"
+
+# process-local cache of legend HTML
+# --> { legend_id: (loaded timestamp, legend version, html), ... }
+_LEGEND_HTML = {}
+
+
 
 class Legend:
 
@@ -131,53 +158,217 @@ def get_layers(request):
     }
     """
     available_layers =[]
-    for layer in RasterAggregatedLayer.objects.order_by("id"):
-        available_layers.append(layer.info())
-    return HttpResponse(json.dumps(available_layers), content_type='application/json')
+    # layer extents are queried from each pixel database in parallel
+    for layer in prefetch_pixel_extents(RasterAggregatedLayer.objects.order_by("id")):
+        available_layers.append(layer.info(request))
+    return json_response(request, available_layers, content_type='application/json')
 
 
 class LegendNotDefined(Exception):
     pass
 
+
+def is_not_modified(request, etag):
+    """
+    :return: True if the given ETag is listed in the request 'If-None-Match' header
+    """
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH", None)
+    return if_none_match is not None and (etag in if_none_match or if_none_match.strip() == "*")
+
+
+def cached_response(request, content, content_type, etag, cache_timeout):
+    """
+    :param etag: quoted ETag value
+    :return: 304 response if the client holds the given ETag, otherwise a response with content
+    """
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    patch_response_headers(response, cache_timeout=cache_timeout)
+    return response
+
+
+def tile_response(request, content, mimetype, etag=None):
+    """
+    :param content: encoded tile bytes
+    :param etag: tile ETag [DEFAULT=content based ETag]
+    :return: tile response
+    """
+    if etag is None:
+        # identical tiles (for example empty tiles) share the ETag and may be reused by the browser
+        etag = '"{}"'.format(content_digest(content))
+    return cached_response(request, content, mimetype, etag, settings.RASTER_TILE_CACHE_SECONDS)
+
+
+def get_archive_error(layername, layer_state, image_encoding, scale=1):
+    """
+    Archived layers are served from the layer's MBTiles archive, only in the archive image format and scale.
+    :return: error message if the requested tiles are not available from the layer archive, otherwise None
+    """
+    if not layer_state.archive_filepath:
+        return None
+    if scale != 1:
+        return "Requested RasterLayer({}) is archived, high-dpi tiles are not available".format(layername)
+    archive = get_mbtiles_reader(layer_state.archive_filepath)
+    if image_encoding != archive.tile_format:
+        return "Requested RasterLayer({}) is archived, only available as: {}".format(layername, archive.tile_format)
+    return None
+
+
 class RasterLayersTileView(View):
+    tile_manager = RasterTileManager()  # url parsing only, no layer configuration
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        layers = OrderedDict()
-        for raster_layer in RasterAggregatedLayer.objects.order_by("id"):
-            if raster_layer.legend is not None:
-                # Only add layers with defined legends
-                #  --> raster tiles cannot be created without a color scheme, a legend is necessary for tile generation!
-                DataModel = raster_layer.get_data_model()
-                qs = DataModel.objects.filter(layer=raster_layer)
-                layers[str(raster_layer.id)] = {
-                            "pixel_size": raster_layer.pixel_size_meters,  # currently hard-coded in measurements.management.commands.load_safecast_csv
-                            "point_position": "upperleft",
-                            "model_queryset": qs,
-                            "model_point_fieldname": "location",
-                            "model_value_fieldname": raster_layer.value_fieldname,
-                            "round_pixels": False,
-                            "legend_instance": raster_layer.legend,  # object with '.get_color_str()' method that returns an rgb() or hsl() color string.
-                            }
-            else:
-                logger.warn("RasterAggregatedLayer:  {} has no legend defined!".format(str(raster_layer)))
-
-        self.tilemgr = DjangoRasterTileLayerManager(layers)
+    def parse_url(self, path):
+        """
+        :param path: tile path in the form '/raster/layer/<layer_id>/<z>/<x>/<y>.png' or, for high-dpi tiles, '<y>@2x.png'
+        :return: layername, zoom, x, y, image_format, scale
+        """
+        scale = 1
+        hidpi_suffix = "{}.".format(get_scale_suffix(HIDPI_SCALE))
+        if hidpi_suffix in path:
+            path = path.replace(hidpi_suffix, ".")
+            scale = HIDPI_SCALE
+        layername, zoom, x, y, image_format = self.tile_manager.parse_url(path)
+        return layername, zoom, x, y, image_format, scale
 
     def get(self, request):
-        layername, zoom, x, y, image_format = self.tilemgr.parse_url(request.path)
-        logger.info("layername({}) zoom({}) x({}) y({}) image_format({})".format(layername, zoom, x, y, image_format))
+        layername, zoom, x, y, image_format, scale = self.parse_url(request.path)
+        logger.info("layername({}) zoom({}) x({}) y({}) image_format({}) scale({})".format(layername, zoom, x, y, image_format, scale))
+        image_encoding = image_format.replace(".", "")
+        if image_encoding not in TILE_IMAGE_ENCODINGS:
+            return HttpResponseBadRequest("Unsupported tile format({}), expected one of: {}".format(image_encoding,
+                                                                                                    ", ".join(TILE_IMAGE_ENCODINGS)))
+
+        instrumentation.tag("layer", layername)
+        instrumentation.tag("z", zoom)
+        with instrumentation.phase("registry"):
+            layer_state = get_layer_tile_state(layername) if layername.isdigit() else None
+        if layer_state is None:
+            return HttpResponseBadRequest("Requested RasterLayer({}) Does Not Exist!".format(layername))
+
+        response = self.get_tile(request, layername, layer_state, zoom, x, y, image_encoding, scale)
+        metrics.incr("tile_requests_total", layer=layername, format=image_encoding)
+        metrics.incr("tile_bytes_served_total", len(response.content), layer=layername)
+        return response
+
+    def get_tile(self, request, layername, layer_state, zoom, x, y, image_encoding, scale=1):
+        """
+        :param layer_state: LayerTileState
+        :param scale: tile resolution multiplier (HIDPI_SCALE for '@2x' tiles)
+        :return: tile response
+        """
+        mimetype = get_tile_mimetype(image_encoding)
+        tile_index = layer_state.tile_index
+
+        # tiles outside of the layer's data coverage are served without a DB query, render or cache entry
+        if tile_index is not None and not tile_index.contains(zoom, x, y):
+            return tile_response(request, get_empty_tile(image_encoding, scale), mimetype)
+
+        # tile content only changes with the layer legend & pixel data (data_version), revalidation is answered without a lookup or render
+        etag = get_tile_etag(layername, layer_state, zoom, x, y, image_encoding, scale)
+        if is_not_modified(request, etag):
+            return cached_response(request, b"", mimetype, etag, settings.RASTER_TILE_CACHE_SECONDS)
+
+        archive_error = get_archive_error(layername, layer_state, image_encoding, scale)
+        if archive_error:
+            return HttpResponseBadRequest(archive_error)
         try:
-            mimetype, tile_pil_img_object = self.tilemgr.get_tile(layername, zoom, x, y)
+            content = get_layer_tiles(layername, layer_state, zoom, [(x, y)], image_encoding, scale)[(x, y)]
         except LayerNotConfigured:
             return HttpResponseBadRequest("Requested RasterLayer({}) Does Not Exist!".format(layername))
-        image_encoding = image_format.replace(".", "")
+        return tile_response(request, content, mimetype, etag)
 
-        # pillow tile_pil_img_object.tobytes() doesn't seem to work, workaround to serve raw bytes via BytesIO()
-        image_fileio = BytesIO()
-        tile_pil_img_object.save(image_fileio, image_encoding)
-        image_fileio.seek(0)
-        return HttpResponse(image_fileio, content_type=mimetype)
+
+def parse_batch_tiles(request, zoom):
+    """
+    Parse the tiles requested from the batch endpoint, given as either:
+        tiles=<x>,<y>;<x>,<y>;...
+        range=<minx>,<miny>,<maxx>,<maxy>  (inclusive)
+    :param zoom: zoom level of the requested tiles (tile x/y are expected within 0 to 2**zoom - 1)
+    :return: list of (tilex, tiley)
+    """
+    maximum_tile = 2 ** zoom - 1
+    if "range" in request.GET:
+        minx, miny, maxx, maxy = [int(v) for v in request.GET["range"].split(",")]
+        if maxx < minx or maxy < miny:
+            raise ValueError("reversed range")
+        if minx < 0 or miny < 0 or maxx > maximum_tile or maxy > maximum_tile:
+            raise ValueError("range outside of zoom {} tiles".format(zoom))
+        if (maxx - minx + 1) * (maxy - miny + 1) > settings.RASTER_TILE_BATCH_MAX_TILES:
+            raise ValueError("range exceeds RASTER_TILE_BATCH_MAX_TILES")
+        return [(x, y) for x in range(minx, maxx + 1) for y in range(miny, maxy + 1)]
+    tile_xys = []
+    for xy in request.GET.get("tiles", "").split(";"):
+        if xy:
+            x, y = xy.split(",")
+            x, y = int(x), int(y)
+            if not (0 <= x <= maximum_tile and 0 <= y <= maximum_tile):
+                raise ValueError("tile outside of zoom {} tiles".format(zoom))
+            tile_xys.append((x, y))
+    return tile_xys
+
+
+def get_tile_batch(request, layer_id):
+    """
+    Get multiple tiles of a layer in a single response.
+    Query parameters:
+        z: zoom level of the requested tiles
+        tiles|range: requested tiles (see parse_batch_tiles())
+        format: tile image format [DEFAULT='png']
+        scale: 1 or 2 (high-dpi tiles) [DEFAULT=1]
+
+    The response body is a sequence of records, each a BATCH_RECORD_HEADER_FORMAT header (zoom, tilex, tiley, length),
+    followed by 'length' bytes of encoded tile image.  A length of 0 indicates an empty (fully transparent) tile.
+    """
+    try:
+        zoom = int(request.GET["z"])
+        if not 0 <= zoom <= 30:
+            raise ValueError("invalid zoom: {}".format(zoom))
+        tile_xys = parse_batch_tiles(request, zoom)
+        scale = int(request.GET.get("scale", 1))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Expected query parameters: z=<zoom>&tiles=<x>,<y>;... or z=<zoom>&range=<minx>,<miny>,<maxx>,<maxy> "
+                                      "(up to {} tiles, 0 <= x, y < 2**zoom, min <= max)".format(settings.RASTER_TILE_BATCH_MAX_TILES))
+    image_encoding = request.GET.get("format", "png")
+    if image_encoding not in TILE_IMAGE_ENCODINGS:
+        return HttpResponseBadRequest("Unsupported tile format({}), expected one of: {}".format(image_encoding,
+                                                                                                ", ".join(TILE_IMAGE_ENCODINGS)))
+    if scale not in (1, HIDPI_SCALE):
+        return HttpResponseBadRequest("Unsupported scale({}), expected one of: 1, {}".format(scale, HIDPI_SCALE))
+    if not 0 < len(tile_xys) <= settings.RASTER_TILE_BATCH_MAX_TILES:
+        return HttpResponseBadRequest("1 to {} tiles may be requested".format(settings.RASTER_TILE_BATCH_MAX_TILES))
+
+    instrumentation.tag("layer", layer_id)
+    instrumentation.tag("z", zoom)
+    instrumentation.count("tiles", len(tile_xys))
+    with instrumentation.phase("registry"):
+        layer_state = get_layer_tile_state(layer_id)
+    if layer_state is None:
+        return HttpResponseBadRequest("Requested RasterLayer({}) Does Not Exist!".format(layer_id))
+    archive_error = get_archive_error(layer_id, layer_state, image_encoding, scale)
+    if archive_error:
+        return HttpResponseBadRequest(archive_error)
+    try:
+        encoded_tiles = get_layer_tiles(layer_id, layer_state, zoom, tile_xys, image_encoding, scale)
+    except LayerNotConfigured:
+        return HttpResponseBadRequest("Requested RasterLayer({}) Does Not Exist!".format(layer_id))
+
+    empty_tile = get_empty_tile(image_encoding, scale)
+    parts = []
+    for tilex, tiley in tile_xys:
+        content = encoded_tiles[(tilex, tiley)]
+        if content == empty_tile:
+            content = b""
+        parts.append(struct.pack(BATCH_RECORD_HEADER_FORMAT, zoom, tilex, tiley, len(content)))
+        parts.append(content)
+    response = HttpResponse(b"".join(parts), content_type="application/octet-stream")
+    metrics.incr("tile_requests_total", len(tile_xys), layer=layer_id, format=image_encoding)
+    metrics.incr("tile_bytes_served_total", len(response.content), layer=layer_id)
+    response["X-Tile-Content-Type"] = get_tile_mimetype(image_encoding)
+    patch_response_headers(response, cache_timeout=settings.RASTER_TILE_CACHE_SECONDS)
+    return response
 
 
 def get_legend(request, legend_id=None):
@@ -187,9 +378,156 @@ def get_legend(request, legend_id=None):
     :param legend_id:
     :return:
     """
-    legend = ScaledColorLegend.objects.get(id=legend_id)
-    color_manager = legend.get_color_manager()
-    return HttpResponse(color_manager.html(), content_type="text/html")
+    # legend html is cached in-process per legend version,
+    # the legend version is re-checked after settings.RASTER_LEGEND_CACHE_SECONDS
+    legend_id = int(legend_id)
+    now = time.time()
+    cached = _LEGEND_HTML.get(legend_id, None)
+    if cached is None or now - cached[0] >= settings.RASTER_LEGEND_CACHE_SECONDS:
+        version = ScaledColorLegend.objects.filter(id=legend_id).values_list("version", flat=True).first()
+        if version is None:
+            raise Http404("ScaledColorLegend({}) Does Not Exist!".format(legend_id))
+        if cached is not None and cached[1] == version:
+            html = cached[2]
+        else:
+            legend = ScaledColorLegend.objects.get(id=legend_id)
+            color_manager = legend.get_color_manager()
+            html = color_manager.html()
+        cached = (now, version, html)
+        _LEGEND_HTML[legend_id] = cached
+    _, version, html = cached
+    etag = '"legend-{}.{}"'.format(legend_id, version)
+    return cached_response(request, html, "text/html", etag, settings.RASTER_LEGEND_CACHE_SECONDS)
 
 
 
+def parse_zonal_geometry(params):
+    """
+    Parse the zonal statistics polygon, given as either:
+        geometry=<GeoJSON geometry/feature or WKT>&srid=<srid> [DEFAULT srid=settings.WGS84_SRID]
+        vector_layer=<GeoJsonLayer id>&feature=<feature 'id' properties attribute>
+    :return: GEOSGeometry
+    """
+    if "vector_layer" in params:
+        GeoJsonLayer = apps.get_model("vector", "GeoJsonLayer")
+        vector_layer = GeoJsonLayer.objects.filter(id=int(params["vector_layer"])).first()
+        if vector_layer is None:
+            raise ValueError("GeoJsonLayer({}) Does Not Exist!".format(params["vector_layer"]))
+        geometry = vector_layer.get_feature_geometry(params.get("feature", ""))
+        if geometry is None:
+            raise ValueError("Feature({}) not found in GeoJsonLayer({})".format(params.get("feature", ""), vector_layer.id))
+        return geometry
+    geometry_text = params["geometry"].strip()
+    if geometry_text.startswith("{"):
+        geojson = json.loads(geometry_text)
+        if geojson.get("type") == "Feature":
+            geojson = geojson["geometry"]
+        geometry_text = json.dumps(geojson)
+    geometry = GEOSGeometry(geometry_text)
+    geometry.srid = int(params.get("srid", settings.WGS84_SRID))
+    return geometry
+
+
+@csrf_exempt  # read-only, polygons may exceed the url length limit (POST)
+def get_zonal_stats(request, layer_id):
+    """
+    Statistics of the layer's pixels within a polygon (see zonal.get_zonal_statistics()).
+    Parameters (GET or POST):
+        geometry|vector_layer & feature: the polygon (see parse_zonal_geometry())
+        bins: value histogram bins [DEFAULT=settings.RASTER_ZONAL_HISTOGRAM_BINS]
+    """
+    params = request.POST if request.method == "POST" else request.GET
+    try:
+        geometry = parse_zonal_geometry(params)
+        bins = int(params.get("bins", settings.RASTER_ZONAL_HISTOGRAM_BINS))
+        if not 0 < bins <= 1000:
+            raise ValueError("bins expected to be 1 to 1000: {}".format(bins))
+    except KeyError:
+        return HttpResponseBadRequest("Expected parameters: geometry=<GeoJSON or WKT polygon>[&srid=<srid>] or vector_layer=<id>&feature=<id>")
+    except (ValueError, GEOSException) as e:
+        return HttpResponseBadRequest(str(e))
+
+    layer = RasterAggregatedLayer.objects.filter(id=int(layer_id)).first()
+    if layer is None:
+        raise Http404("RasterAggregatedLayer({}) Does Not Exist!".format(layer_id))
+    instrumentation.tag("layer", layer_id)
+    try:
+        with instrumentation.phase("aggregate"):
+            result = get_zonal_statistics(layer, geometry, bins=bins)
+    except ZonalQueryError as e:
+        return HttpResponseBadRequest(str(e))
+    result["layer"] = layer.id
+    instrumentation.count("pixels", result["pixels"])
+    return json_response(request, result, content_type="application/json")
+
+
+def get_point_values(request, layer_id):
+    """
+    Values of the layer pixel drawn at a location (see pointquery.query_pixel()).
+    Query parameters:
+        lon, lat: WGS84 location
+    Response:
+        {"layer": <id>, "lon":, "lat":, "pixel": {"lon":, "lat":, "values": {<fieldname>: <value>, ...}}}
+        ('pixel' is null if no pixel is drawn at the location)
+    """
+    try:
+        lon = float(request.GET["lon"])
+        lat = float(request.GET["lat"])
+        if not (-180.0 <= lon <= 180.0 and -85.06 <= lat <= 85.06):
+            raise ValueError("location outside of the spherical mercator extent")
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Expected query parameters: lon=<longitude>&lat=<latitude>")
+    layer = RasterAggregatedLayer.objects.filter(id=int(layer_id)).first()
+    if layer is None:
+        raise Http404("RasterAggregatedLayer({}) Does Not Exist!".format(layer_id))
+    instrumentation.tag("layer", layer_id)
+    point = Point(lon, lat, srid=WGS84_SRID)
+    point.transform(METERS_SRID)
+    with instrumentation.phase("query"):
+        result = query_pixel(layer, point.x, point.y)
+    pixel = None
+    if result is not None:
+        (x, y), values = result
+        location = Point(x, y, srid=METERS_SRID).transform(WGS84_SRID, clone=True)
+        pixel = {"lon": round(location.x, 6), "lat": round(location.y, 6), "values": values}
+    return json_response(request, {"layer": layer.id, "lon": lon, "lat": lat, "pixel": pixel}, content_type="application/json")
+
+
+def get_grid_tile(request, layer_id, zoom, tilex, tiley):
+    """
+    UTFGrid interaction tile of a layer (see utfgrid.py), for zoom levels >= settings.RASTER_UTFGRID_MIN_ZOOM.
+    """
+    zoom, tilex, tiley = int(zoom), int(tilex), int(tiley)
+    if not settings.RASTER_UTFGRID_MIN_ZOOM <= zoom <= 30 or tilex >= 2 ** zoom or tiley >= 2 ** zoom:
+        return HttpResponseBadRequest("Grid tiles are available for zoom levels {} to 30".format(settings.RASTER_UTFGRID_MIN_ZOOM))
+
+    instrumentation.tag("layer", layer_id)
+    instrumentation.tag("z", zoom)
+    with instrumentation.phase("registry"):
+        layer_state = get_layer_tile_state(layer_id)
+    if layer_state is None:
+        return HttpResponseBadRequest("Requested RasterLayer({}) Does Not Exist!".format(layer_id))
+    if layer_state.tile_index is not None and not layer_state.tile_index.contains(zoom, tilex, tiley):
+        content = get_empty_utfgrid()
+    else:
+        content = get_layer_utfgrid(layer_id, zoom, tilex, tiley)
+
+    # grids are stored gzip compressed
+    etag = '"{}"'.format(content_digest(content))
+    if is_not_modified(request, etag):
+        return cached_response(request, b"", "application/json", etag, settings.RASTER_TILE_CACHE_SECONDS)
+    if "gzip" in accepted_encodings(request):
+        response = precompressed_response(content, "gzip", content_type="application/json")
+    else:
+        response = precompressed_response(gzip.decompress(content), content_type="application/json")
+    response["ETag"] = etag
+    patch_response_headers(response, cache_timeout=settings.RASTER_TILE_CACHE_SECONDS)
+    return response
+
+
+def get_tile_timings(request):
+    """
+    Per-layer tile phase timing histograms (milliseconds) of the serving process.
+    (Each mod_wsgi process holds its own histograms, the responding process is identified by 'pid')
+    """
+    return json_response(request, instrumentation.get_histograms(), content_type="application/json")
@@ -0,0 +1,215 @@
+"""
+Zonal statistics of a raster layer within a polygon.
+
+The polygon is rasterized on the layer's pixel grid (pixel column/row = location / pixel size, see columnar.py)
+as column spans per grid row, and only the pixels within the spans are aggregated.
+The stored per-pixel aggregates (samples, mean, variance, minimum, maximum, sum) are combined with
+WelfordRunningVariance.merge_aggregate(), so the result is the statistics of all samples within the polygon
+without re-reading the samples.
+"""
+import math
+import bisect
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections
+
+from deso.functions import WelfordRunningVariance
+
+METERS_SRID = settings.METERS_SRID
+
+# per-pixel aggregates combined into the zonal statistics
+AGGREGATE_FIELDNAMES = ("samples", "mean", "variance", "minimum", "maximum", "sum")
+
+
+class ZonalQueryError(Exception):
+    pass
+
+
+def get_polygon_rings(geometry):
+    """
+    :param geometry: GEOS Polygon or MultiPolygon (with srid)
+    :return: list of rings, each a list of (x, y) in settings.METERS_SRID
+    """
+    if geometry.srid != METERS_SRID:
+        geometry = geometry.transform(METERS_SRID, clone=True)
+    if geometry.geom_type == "Polygon":
+        polygons = [geometry]
+    elif geometry.geom_type == "MultiPolygon":
+        polygons = list(geometry)
+    else:
+        raise ZonalQueryError("Polygon or MultiPolygon expected, got: {}".format(geometry.geom_type))
+    return [list(ring.coords) for polygon in polygons for ring in polygon]
+
+
+class GridSpans:
+    """
+    Polygon rasterized on a pixel grid (even-odd rule), a pixel is inside if its location is inside (or on the boundary of) the polygon.
+    """
+
+    def __init__(self, rings, pixel_size):
+        self.pixel_size = pixel_size
+        # --> { row: [crossing x, ...], ... }
+        crossings = defaultdict(list)
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+                if y1 == y2:
+                    continue
+                if y1 > y2:
+                    x1, y1, x2, y2 = x2, y2, x1, y1
+                slope = (x2 - x1) / (y2 - y1)
+                # rows located within [y1, y2)
+                for row in range(int(math.ceil(y1 / pixel_size)), int(math.ceil(y2 / pixel_size))):
+                    crossings[row].append(x1 + (row * pixel_size - y1) * slope)
+
+        # --> { row: ([span first column, ...], [span last column, ...]), ... }
+        self.rows = {}
+        for row, row_crossings in crossings.items():
+            row_crossings.sort()
+            starts = []
+            ends = []
+            for start, end in zip(row_crossings[0::2], row_crossings[1::2]):
+                first_column = int(math.ceil(start / pixel_size))
+                last_column = int(math.floor(end / pixel_size))
+                if first_column <= last_column:
+                    starts.append(first_column)
+                    ends.append(last_column)
+            if starts:
+                self.rows[row] = (starts, ends)
+
+        if self.rows:
+            self.bounds = (min(starts[0] for starts, _ in self.rows.values()),
+                           min(self.rows),
+                           max(ends[-1] for _, ends in self.rows.values()),
+                           max(self.rows))
+        else:
+            self.bounds = None
+
+    def cell_count(self):
+        """
+        :return: number of grid cells within the spans bounds
+        """
+        if self.bounds is None:
+            return 0
+        column_min, row_min, column_max, row_max = self.bounds
+        return (column_max - column_min + 1) * (row_max - row_min + 1)
+
+    def contains(self, column, row):
+        spans = self.rows.get(row, None)
+        if spans is None:
+            return False
+        starts, ends = spans
+        index = bisect.bisect_right(starts, column) - 1
+        return index >= 0 and column <= ends[index]
+
+
+def iter_grid_pixels(layer, bounds, fieldnames):
+    """
+    :param bounds: (column_min, row_min, column_max, row_max) grid bounds (inclusive)
+    :return: iterator of (column, row, value, ...) of the layer's pixels within the grid bounds
+    """
+    column_min, row_min, column_max, row_max = bounds
+    if layer.is_columnar:
+        reader = layer.get_columnar_reader()
+        if reader is None:
+            return iter(())
+        return reader.query_grid(column_min, row_min, column_max, row_max, fieldnames)
+
+    DataModel = layer.get_data_model()
+    connection = connections[layer.pixel_database]
+    sql = """
+        SELECT
+            floor(ST_X(location) / %(pixel_size)s + 0.5)::integer,
+            floor(ST_Y(location) / %(pixel_size)s + 0.5)::integer,
+            {fields}
+        FROM {table}
+        WHERE layer_id = %(layer_id)s
+          AND location && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s)
+    """.format(table=connection.ops.quote_name(DataModel._meta.db_table),
+               fields=", ".join(connection.ops.quote_name(name) for name in fieldnames))
+    pixel_size = layer.pixel_size_meters
+    params = {"pixel_size": float(pixel_size),
+              "layer_id": layer.id,
+              "xmin": (column_min - 0.5) * pixel_size,
+              "ymin": (row_min - 0.5) * pixel_size,
+              "xmax": (column_max + 0.5) * pixel_size,
+              "ymax": (row_max + 0.5) * pixel_size,
+              "srid": METERS_SRID}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return iter(cursor.fetchall())
+
+
+def get_histogram(values, bins):
+    """
+    :param values: [(value, samples), ...]
+    :param bins: number of equal width bins between the minimum and maximum value
+    :return: {"edges": [...], "pixels": [...], "samples": [...]}
+    """
+    if not values:
+        return {"edges": [], "pixels": [], "samples": []}
+    minimum = min(value for value, _ in values)
+    maximum = max(value for value, _ in values)
+    width = (maximum - minimum) / bins
+    pixel_counts = [0] * bins
+    sample_counts = [0] * bins
+    for value, samples in values:
+        index = min(int((value - minimum) / width), bins - 1) if width else 0
+        pixel_counts[index] += 1
+        sample_counts[index] += samples
+    edges = [minimum + width * i for i in range(bins)] + [maximum]
+    return {"edges": edges, "pixels": pixel_counts, "samples": sample_counts}
+
+
+def get_zonal_statistics(layer, geometry, bins=None):
+    """
+    Statistics of the layer's pixels located within the given polygon.
+    :param layer: RasterAggregatedLayer object (numeric pixels)
+    :param geometry: GEOS Polygon or MultiPolygon (with srid)
+    :param bins: histogram bins [DEFAULT=settings.RASTER_ZONAL_HISTOGRAM_BINS]
+    :return: {
+        "pixels": <pixels within the polygon>,
+        "samples": <total samples>,
+        "mean": <samples weighted mean>,
+        "variance": <sample variance of all samples>,
+        "stddev":, "minimum":, "maximum":, "sum":,
+        "histogram": {"fieldname": <layer value_fieldname>, "edges": [...], "pixels": [...], "samples": [...]}
+        }
+    """
+    if bins is None:
+        bins = settings.RASTER_ZONAL_HISTOGRAM_BINS
+    if not layer.is_columnar and layer.data_model != "NumericRasterAggregateData":
+        raise ZonalQueryError("Zonal statistics require numeric pixels: {}".format(layer.data_model))
+    spans = GridSpans(get_polygon_rings(geometry), layer.pixel_size_meters)
+    if spans.cell_count() > settings.RASTER_ZONAL_MAX_PIXELS:
+        raise ZonalQueryError("Polygon exceeds RASTER_ZONAL_MAX_PIXELS ({}) pixels".format(settings.RASTER_ZONAL_MAX_PIXELS))
+
+    running = WelfordRunningVariance()
+    pixel_count = 0
+    histogram_values = []
+    if spans.bounds is not None:
+        fieldnames = AGGREGATE_FIELDNAMES + (layer.value_fieldname,)
+        for column, row, samples, mean, variance, minimum, maximum, total, value in iter_grid_pixels(layer, spans.bounds, fieldnames):
+            if not spans.contains(column, row):
+                continue
+            pixel_count += 1
+            samples = samples or 0
+            if mean is not None:
+                running.merge_aggregate(samples, mean, variance, minimum, maximum, total)
+            if value is not None:
+                histogram_values.append((value, samples))
+
+    histogram = get_histogram(histogram_values, bins)
+    histogram["fieldname"] = layer.value_fieldname
+    has_samples = running.count() > 0
+    return {
+        "pixels": pixel_count,
+        "samples": running.count(),
+        "mean": running.mean(),
+        "variance": running.var() if has_samples else None,
+        "stddev": running.stddev() if has_samples else None,
+        "minimum": running.min(),
+        "maximum": running.max(),
+        "sum": running.sum(),
+        "histogram": histogram,
+    }
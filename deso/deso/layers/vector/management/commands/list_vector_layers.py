@@ -3,6 +3,7 @@ List the loaded site layers
 """
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from deso.hosts import expand_url
 from ...models import GeoJsonLayer
 
 WGS84_SRID = settings.WGS84_SRID
@@ -18,5 +19,5 @@ class Command(BaseCommand):
                                                  str(layer),
                                                  round(p.x, 5),
                                                  round(p.y, 5),
-                                                 layer.get_layer_url()))
+                                                 expand_url(layer.get_layer_url())))
 
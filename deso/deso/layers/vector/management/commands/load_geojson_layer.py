@@ -1,7 +1,9 @@
 """
 Load GEOJSON text file to vector.GeoJsonLayer model
 """
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
+
+from deso.profiling import ProfiledCommand, phase
 
 from ...models import GeoJsonLayer
 
@@ -9,21 +11,27 @@ from ...models import GeoJsonLayer
 WGS84_SRID = 4326
 
 def load_geojson_layer(geojson_filepath, opacity):
-    with open(geojson_filepath, "rt", encoding="utf8") as in_f:
-        geojson_text = in_f.read()
+    with phase("read"):
+        with open(geojson_filepath, "rt", encoding="utf8") as in_f:
+            geojson_text = in_f.read()
     geojson_layer = GeoJsonLayer(name=geojson_filepath,
                                  data=geojson_text,
                                  opacity=opacity)
-    bounds_polygon = geojson_layer.get_data_bounds_polygon()
-    geojson_layer.bounds_polygon = bounds_polygon
-    geojson_layer.clean()
-    geojson_layer.save()
-    geojson_layer.create_map_layer()
+    with phase("bounds"):
+        bounds_polygon = geojson_layer.get_data_bounds_polygon()
+        geojson_layer.bounds_polygon = bounds_polygon
+    with phase("validate"):
+        geojson_layer.clean()
+    # save includes the (gzip/brotli) compression of the data
+    with phase("save"):
+        geojson_layer.save()
+    with phase("map layer"):
+        geojson_layer.create_map_layer()
 
 
     return geojson_layer
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     help = __doc__
 
     def add_arguments(self, parser):
@@ -3,7 +3,9 @@ Load GEOJSON text files from a given directory to individua vector.GeoJsonLayer
 """
 import os
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
+
+from deso.profiling import ProfiledCommand, phase, progress
 
 from ...models import GeoJsonLayer
 
@@ -11,18 +13,24 @@ from ...models import GeoJsonLayer
 WGS84_SRID = 4326
 
 def load_geojson_layer(geojson_filepath):
-    with open(geojson_filepath, "rt", encoding="utf8") as in_f:
-        geojson_text = in_f.read()
+    with phase("read"):
+        with open(geojson_filepath, "rt", encoding="utf8") as in_f:
+            geojson_text = in_f.read()
     geojson_layer = GeoJsonLayer(name=geojson_filepath,
                                  data=geojson_text)
-    bounds_polygon = geojson_layer.get_data_bounds_polygon()
-    geojson_layer.bounds_polygon = bounds_polygon
-    geojson_layer.clean()
-    geojson_layer.save()
-    geojson_layer.create_map_layer()
+    with phase("bounds"):
+        bounds_polygon = geojson_layer.get_data_bounds_polygon()
+        geojson_layer.bounds_polygon = bounds_polygon
+    with phase("validate"):
+        geojson_layer.clean()
+    # save includes the (gzip/brotli) compression of the data
+    with phase("save"):
+        geojson_layer.save()
+    with phase("map layer"):
+        geojson_layer.create_map_layer()
     return geojson_layer
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     help = __doc__
 
     def add_arguments(self, parser):
@@ -44,4 +52,5 @@ class Command(BaseCommand):
         for filepath in found_geojson_filepaths:
             self.stdout.write("Loading ({})...".format(filepath))
             load_geojson_layer(filepath)
+            progress("files")
             self.stdout.write("Done!")
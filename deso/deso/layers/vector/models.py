@@ -10,6 +10,9 @@ from django.contrib.auth.models import User
 from django.apps import apps
 from django.conf import settings
 
+from deso.compression import gzip_compress, brotli_compress
+from deso.hosts import expand_url
+
 
 WGS84_SRID = settings.WGS84_SRID
 METERS_SRID = settings.SPHERICAL_MERCATOR_SRID
@@ -31,6 +34,9 @@ class GeoJsonLayer(models.Model):
                                          editable=False,
                                          srid=METERS_SRID)
     data = models.TextField(help_text="GeoJSON Text")
+    # pre-compressed 'data', served directly when the client accepts the encoding
+    data_gzip = models.BinaryField(null=True, editable=False)
+    data_brotli = models.BinaryField(null=True, editable=False)
 
     objects = models.GeoManager()
 
@@ -110,9 +116,10 @@ class GeoJsonLayer(models.Model):
             result = (min_p.x, min_p.y, max_p.x, max_p.y)
         return result
 
-    def info(self):
+    def info(self, request=None):
         """
         layer information dictionary to be converted to json
+        :param request: request used to expand the layer url (see deso.hosts.expand_url())
         """
         layer_center_point = self.bounds_polygon.centroid
         if layer_center_point:
@@ -124,7 +131,7 @@ class GeoJsonLayer(models.Model):
                  "name": self.name,
                  "created_datetime": self.created_datetime.isoformat(),
                  "id": layer_unique_id,
-                 "url": self.get_absolute_url(),
+                 "url": expand_url(self.get_absolute_url(), request),
                  "type": "GeoJSON",
                  "extent": self.extent(),
                  "opacity": self.opacity,
@@ -134,19 +141,61 @@ class GeoJsonLayer(models.Model):
             layer_info["centerlat"] = round(layer_center_point.y, 6)
         return layer_info
 
+    def get_feature_geometry(self, feature_id):
+        """
+        :param feature_id: feature 'id' properties attribute
+        :return: GEOSGeometry of the feature (in the layer srid), or None if not found
+        """
+        parsed_geojson = json.loads(self.data)
+        features = parsed_geojson.get("features", [parsed_geojson] if parsed_geojson.get("type") == "Feature" else [])
+        for feature in features:
+            if str(feature.get("properties", {}).get("id", None)) == str(feature_id):
+                geometry = GEOSGeometry(json.dumps(feature["geometry"]))
+                geometry.srid = self.srid
+                return geometry
+        return None
+
     def get_absolute_url(self):
         return "/vector/layer/{}/".format(self.id)
 
     def get_layer_url(self):
-        return "http://{}:{}/vector/layer/{}/".format(settings.HOST,
-                                                       settings.PORT,
-                                                       self.id)
+        """
+        :return: URL path from which the layer objects are served (see deso.hosts.expand_url())
+        """
+        return self.get_absolute_url()
+
+    def compress_data(self):
+        """
+        Populate the pre-compressed 'data' fields.
+        ('data_brotli' is only populated if the optional 'brotli' package is installed)
+        """
+        self.data_gzip = gzip_compress(self.data)
+        self.data_brotli = brotli_compress(self.data)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(GeoJsonLayer, cls).from_db(db, field_names, values)
+        # 'data' as loaded (None if deferred), so that save() detects changes without re-reading the GeoJSON text
+        instance._loaded_data = instance.__dict__.get("data", None)
+        return instance
 
     def save(self, *args, **kwargs):
         if not self.bounds_polygon:
             poly = self.get_data_bounds_polygon()
             self.bounds_polygon = poly
+        update_fields = kwargs.get("update_fields", None)
+        data_loaded = "data" not in self.get_deferred_fields()
+        if self.id and (update_fields is None or "data" in update_fields) and data_loaded:
+            # check if data changed since loaded
+            if self.data != getattr(self, "_loaded_data", None):
+                self.data_gzip = None
+        if self.data_gzip is None and data_loaded:
+            self.compress_data()
+            if update_fields is not None:
+                kwargs["update_fields"] = list(update_fields) + ["data_gzip", "data_brotli"]
         super(GeoJsonLayer, self).save(*args, **kwargs) # Call the "real" save() method.
+        if data_loaded:
+            self._loaded_data = self.data
 
     def create_map_layer(self):
         """
@@ -4,17 +4,27 @@ from django.http import HttpResponse, HttpResponseBadRequest
 from django.contrib.gis.geos import Polygon
 from django.conf import settings
 
+from deso import metrics
+from deso.compression import select_content_encoding, precompressed_response, json_response
 from .models import GeoJsonLayer
 
 
 WGS84_SRID = settings.WGS84_SRID
 METERS_SRID = settings.METERS_SRID
 
+# GeoJsonLayer field holding the 'data' for the given 'Content-Encoding'
+ENCODED_DATA_FIELDNAMES = {
+    "br": "data_brotli",
+    "gzip": "data_gzip",
+    None: "data",
+}
+
+
 def get_vector_layers(request):
     available_layers =[]
     for layer in GeoJsonLayer.objects.all():
-        available_layers.append(layer.info())
-    return HttpResponse(json.dumps(available_layers), content_type='application/json; charset=utf-8')
+        available_layers.append(layer.info(request))
+    return json_response(request, available_layers)
 
 
 def get_objects(request, layer_id=None):
@@ -66,10 +76,22 @@ def get_objects(request, layer_id=None):
     bbox_poly.srid = WGS84_SRID
     bbox_poly.transform(METERS_SRID)
 
+    # only retrieve the (potentially large) data field that will be served
+    content_encoding = select_content_encoding(request)
+    data_fieldname = ENCODED_DATA_FIELDNAMES[content_encoding]
     try:
-        layer = GeoJsonLayer.objects.get(id=layer_id,
-                                         bounds_polygon__intersects=bbox_poly)
-        return HttpResponse(layer.data, content_type='application/json')
+        layer = GeoJsonLayer.objects.only("id", data_fieldname).get(id=layer_id,
+                                                                    bounds_polygon__intersects=bbox_poly)
+        content = getattr(layer, data_fieldname)
+        if content is None:
+            # layer loaded before pre-compression was supported, populate now.
+            layer = GeoJsonLayer.objects.get(id=layer.id)
+            layer.compress_data()
+            layer.save(update_fields=["data_gzip", "data_brotli"])
+            content = getattr(layer, data_fieldname)
+        metrics.observe("vector_payload_bytes", len(content), buckets=metrics.PAYLOAD_BUCKETS_BYTES,
+                        layer=layer.id, encoding=content_encoding or "identity")
+        return precompressed_response(content, content_encoding, content_type='application/json')
     except GeoJsonLayer.DoesNotExist as e:
         # layer may exist, but query does not intersect.
         return HttpResponse(json.dumps([]), content_type='application/json; charset=utf-8')
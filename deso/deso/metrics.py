@@ -0,0 +1,262 @@
+"""
+Operational counters & histograms aggregated across (mod_wsgi) processes.
+
+Values are buffered in process memory and added to a single shared redis hash (settings.METRICS_KEY)
+at most every settings.METRICS_FLUSH_SECONDS (and at process exit), so recording a value never blocks a request on redis:
+
+    incr("tile_requests_total", layer=layer_id, format="png")
+    observe("tile_render_ms", milliseconds, layer=layer_id)
+
+The hash fields are the Prometheus series names, for example 'tile_requests_total{format="png",layer="12"}',
+'/metrics/' returns the aggregated values in the Prometheus text exposition format (or JSON with '?format=json').
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+from deso.compression import json_response
+from deso.instrumentation import HISTOGRAM_BUCKETS_MS
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# payload size histogram bucket upper bounds (bytes)
+PAYLOAD_BUCKETS_BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+_counters = {}  # { series name: value, ... }
+_gauges = {}  # { series name: value, ... }
+_types = {}  # { metric name: type, ... }
+_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def get_series_name(name, labels):
+    """
+    :param name: metric name
+    :param labels: dict of label names/values
+    :return: Prometheus series name, for example: 'tile_requests_total{format="png",layer="12"}'
+    """
+    if not labels:
+        return name
+    label_strs = []
+    for label_name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        label_strs.append('{}="{}"'.format(label_name, value))
+    return "{}{{{}}}".format(name, ",".join(label_strs))
+
+
+def get_redis_connection():
+    from django_redis import get_redis_connection as get_connection
+    return get_connection(settings.METRICS_CACHE)
+
+
+def incr(name, value=1, **labels):
+    """
+    Add value to the counter 'name' with the given labels.
+    """
+    series = get_series_name(name, labels)
+    with _lock:
+        _types[name] = COUNTER
+        _counters[series] = _counters.get(series, 0) + value
+    _flush_if_due()
+
+
+def set_gauge(name, value, **labels):
+    series = get_series_name(name, labels)
+    with _lock:
+        _types[name] = GAUGE
+        _gauges[series] = value
+    _flush_if_due()
+
+
+def observe(name, value, buckets=HISTOGRAM_BUCKETS_MS, **labels):
+    """
+    Add value to the (cumulative bucket) histogram 'name' with the given labels.
+    :param buckets: bucket upper bounds
+    """
+    series = [get_series_name(name + "_bucket", dict(labels, le=upper_bound)) for upper_bound in buckets if value <= upper_bound]
+    series.append(get_series_name(name + "_bucket", dict(labels, le="+Inf")))
+    with _lock:
+        _types[name] = HISTOGRAM
+        for bucket_series in series:
+            _counters[bucket_series] = _counters.get(bucket_series, 0) + 1
+        sum_series = get_series_name(name + "_sum", labels)
+        _counters[sum_series] = _counters.get(sum_series, 0) + value
+        count_series = get_series_name(name + "_count", labels)
+        _counters[count_series] = _counters.get(count_series, 0) + 1
+    _flush_if_due()
+
+
+def record_ingest(command, rows, seconds):
+    """
+    Record the rows loaded by a management command and flush (commands exit shortly after).
+    """
+    incr("ingest_rows_total", rows, command=command)
+    incr("ingest_seconds_total", seconds, command=command)
+    if seconds > 0:
+        set_gauge("ingest_last_rows_per_second", round(rows / seconds, 3), command=command)
+    flush()
+
+
+def _flush_if_due():
+    if time.time() - _last_flush >= settings.METRICS_FLUSH_SECONDS:
+        flush()
+
+
+def flush():
+    """
+    Add the buffered values of this process to the shared metrics hash.
+    (On failure the buffered values are dropped, metrics must not affect serving)
+    """
+    global _last_flush
+    with _lock:
+        counters = _counters.copy()
+        gauges = _gauges.copy()
+        types = _types.copy()
+        _counters.clear()
+        _gauges.clear()
+        _last_flush = time.time()
+    if not counters and not gauges:
+        return
+    try:
+        pipeline = get_redis_connection().pipeline(transaction=False)
+        for series, value in counters.items():
+            if isinstance(value, int):
+                pipeline.hincrby(settings.METRICS_KEY, series, value)
+            else:
+                pipeline.hincrbyfloat(settings.METRICS_KEY, series, value)
+        for series, value in gauges.items():
+            pipeline.hset(settings.METRICS_KEY, series, value)
+        pipeline.hmset(settings.METRICS_KEY + ":types", types)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning("Unable to flush metrics ({} series dropped): {}".format(len(counters) + len(gauges), e))
+
+atexit.register(flush)
+
+
+def get_metrics():
+    """
+    :return: (OrderedDict({ series name: value, ... }), { metric name: type, ... }) sorted by series name
+    """
+    connection = get_redis_connection()
+    values = connection.hgetall(settings.METRICS_KEY)
+    types = connection.hgetall(settings.METRICS_KEY + ":types")
+    decoded_values = OrderedDict()
+    for series, value in sorted(values.items()):
+        value = value.decode("utf8")
+        decoded_values[series.decode("utf8")] = float(value) if "." in value or "e" in value else int(value)
+    decoded_types = {name.decode("utf8"): metric_type.decode("utf8") for name, metric_type in types.items()}
+    return decoded_values, decoded_types
+
+
+def get_metric_name(series, types):
+    name = series.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and types.get(name[:-len(suffix)], None) == HISTOGRAM:
+            return name[:-len(suffix)]
+    return name
+
+
+def metrics_view(request):
+    """
+    Return the metrics aggregated from all processes in the Prometheus text format, or as JSON with '?format=json'.
+    """
+    flush()
+    values, types = get_metrics()
+    if request.GET.get("format", None) == "json":
+        return json_response(request, values)
+    lines = []
+    typed_names = set()
+    for series, value in values.items():
+        name = get_metric_name(series, types)
+        if name not in typed_names:
+            typed_names.add(name)
+            lines.append("# TYPE {} {}".format(name, types.get(name, "untyped")))
+        lines.append("{} {}".format(series, value))
+    lines.append("")
+    return HttpResponse("\n".join(lines), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class QueryCountingCursor(object):
+    """
+    Cursor proxy counting the executed queries in connection.metrics_query_count
+    (without the SQL formatting & query log of the debug cursor).
+    """
+
+    def __init__(self, cursor, connection):
+        self.cursor = cursor
+        self.connection = connection
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def execute(self, sql, params=None):
+        self.connection.metrics_query_count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.connection.metrics_query_count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+def reset_query_count(connection):
+    """
+    Reset the query count of the given connection, installing the QueryCountingCursor on first use.
+    """
+    if not hasattr(connection, "metrics_query_count"):
+        make_cursor = connection.make_cursor
+        make_debug_cursor = connection.make_debug_cursor
+        connection.make_cursor = lambda cursor: QueryCountingCursor(make_cursor(cursor), connection)
+        connection.make_debug_cursor = lambda cursor: QueryCountingCursor(make_debug_cursor(cursor), connection)
+    connection.metrics_query_count = 0
+
+
+class MetricsMiddleware(object):
+    """
+    Count requests, response bytes & database queries per view.
+    (Database queries are counted by a cursor proxy, see QueryCountingCursor & settings.METRICS_COUNT_DB_QUERIES)
+    """
+
+    def process_request(self, request):
+        request.metrics_view_name = None
+        if settings.METRICS_COUNT_DB_QUERIES:
+            for connection in connections.all():
+                reset_query_count(connection)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view_name = "{}.{}".format(view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        view_name = getattr(request, "metrics_view_name", None)
+        if view_name is None:
+            # not resolved to a view (404, or short-circuited by another middleware)
+            return response
+        incr("http_requests_total", view=view_name, status=response.status_code)
+        if not response.streaming:
+            incr("http_response_bytes_total", len(response.content), view=view_name)
+        if settings.METRICS_COUNT_DB_QUERIES:
+            query_count = 0
+            for connection in connections.all():
+                query_count += getattr(connection, "metrics_query_count", 0)
+            incr("db_queries_total", query_count, view=view_name)
+        return response
@@ -0,0 +1,172 @@
+"""
+Profiling of (long running) management commands.
+
+Commands derived from ProfiledCommand accept:
+    --profile             phase timings, periodic progress lines with throughput, and peak memory
+    --profile-interval    seconds between progress lines [DEFAULT=10]
+    --cprofile FILEPATH   write cProfile stats (pstats format) of the command to FILEPATH
+
+Code run by the command records into the active profiler with:
+
+    with phase("rasterize"):
+        ...
+        progress("rows", PROGRESS_ROWS)
+
+(Both are no-ops when profiling is not enabled)
+"""
+import io
+import sys
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+
+try:
+    import resource  # not available on windows
+except ImportError:
+    resource = None
+
+
+DEFAULT_PROGRESS_INTERVAL_SECONDS = 10
+CPROFILE_REPORT_FUNCTIONS = 20
+
+# number of rows/pixels processed between progress() calls in row loops
+PROGRESS_ROWS = 10000
+
+# active CommandProfiler (commands run in a single thread)
+_profiler = None
+
+
+def get_peak_memory_mb():
+    """
+    :return: peak resident memory (MB) of this process, or None if unavailable
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024  # linux reports kilobytes
+    return round(peak / (1024 * 1024), 1)
+
+
+class CommandProfiler:
+    """
+    Records phase durations & progress counts of a command, writing progress lines to the command's stdout.
+    """
+
+    def __init__(self, command, interval=DEFAULT_PROGRESS_INTERVAL_SECONDS):
+        self.command = command
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()  # { phase name: seconds, ... }
+        self.counts = OrderedDict()  # { count name: value, ... }
+        self.current_phase = None
+        self.phase_counts = {}  # counts of the current phase
+        self.phase_start = self.start
+        self.last_report = self.start
+
+    def write(self, message):
+        self.command.stdout.write("[profile] {}".format(message))
+
+    def begin_phase(self, name):
+        self.current_phase = name
+        self.phase_counts = {}
+        self.phase_start = self.last_report = time.perf_counter()
+        self.write("{}...".format(name))
+
+    def end_phase(self, name):
+        elapsed = time.perf_counter() - self.phase_start
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+        self.write("{} done in {:.3f}s{} peak memory({} MB)".format(name, elapsed, self.format_throughput(elapsed), get_peak_memory_mb()))
+        self.current_phase = None
+
+    def add_progress(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+        self.phase_counts[name] = self.phase_counts.get(name, 0) + value
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.write("--> {}{}".format(self.current_phase or "", self.format_throughput(now - self.phase_start)))
+
+    def format_throughput(self, elapsed):
+        """
+        :return: ' rows(120000, 35210.5/s) ...' for the counts of the current phase
+        """
+        return "".join(" {}({}, {:.1f}/s)".format(name, value, value / elapsed if elapsed else 0.0)
+                       for name, value in self.phase_counts.items())
+
+    def summary(self):
+        total = time.perf_counter() - self.start
+        self.write("{:<32}{:>12}{:>8}".format("phase", "seconds", "%"))
+        for name, seconds in self.phases.items():
+            self.write("{:<32}{:>12.3f}{:>8.1f}".format(name, seconds, seconds / total * 100 if total else 0.0))
+        self.write("{:<32}{:>12.3f}".format("total", total))
+        for name, value in self.counts.items():
+            self.write("{}: {} ({:.1f}/s overall)".format(name, value, value / total if total else 0.0))
+        self.write("peak memory: {} MB".format(get_peak_memory_mb()))
+
+
+@contextmanager
+def phase(name):
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+    profiler.begin_phase(name)
+    try:
+        yield
+    finally:
+        profiler.end_phase(name)
+
+
+def progress(name, value=1):
+    if _profiler is not None:
+        _profiler.add_progress(name, value)
+
+
+class ProfiledCommand(BaseCommand):
+    """
+    BaseCommand adding the '--profile', '--profile-interval' & '--cprofile' options.
+    """
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(ProfiledCommand, self).create_parser(prog_name, subcommand)
+        parser.add_argument("--profile",
+                            default=False,
+                            action="store_true",
+                            help="If given, phase timings, progress (with throughput) and peak memory are reported")
+        parser.add_argument("--profile-interval",
+                            type=float,
+                            default=DEFAULT_PROGRESS_INTERVAL_SECONDS,
+                            help="Seconds between '--profile' progress lines [DEFAULT={}]".format(DEFAULT_PROGRESS_INTERVAL_SECONDS))
+        parser.add_argument("--cprofile",
+                            default=None,
+                            help="If given, cProfile stats of the command are written to this filepath (view with 'python3 -m pstats')")
+        return parser
+
+    def execute(self, *args, **options):
+        global _profiler
+        profile = options.get("profile", False)
+        cprofile_filepath = options.get("cprofile", None)
+        if profile:
+            _profiler = CommandProfiler(self, options.get("profile_interval", DEFAULT_PROGRESS_INTERVAL_SECONDS))
+        cprofiler = cProfile.Profile() if cprofile_filepath else None
+        try:
+            if cprofiler is not None:
+                cprofiler.enable()
+            return super(ProfiledCommand, self).execute(*args, **options)
+        finally:
+            if cprofiler is not None:
+                cprofiler.disable()
+                cprofiler.dump_stats(cprofile_filepath)
+                self.stdout.write("cProfile stats written to: {}".format(cprofile_filepath))
+            if profile:
+                _profiler.summary()
+                _profiler = None
+                if cprofiler is not None:
+                    report = io.StringIO()
+                    pstats.Stats(cprofiler, stream=report).sort_stats("cumulative").print_stats(CPROFILE_REPORT_FUNCTIONS)
+                    self.stdout.write(report.getvalue())
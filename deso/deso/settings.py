@@ -28,6 +28,7 @@ AUTH_INFORMATION = {'LDAP': {'HOST': '',
                             'PORT': 389,
                             'BASE_DN': '',},}
 
+# 'auth.backends.LDAPBackend' imports 'ldap3' on first use (authentication), not on settings import
 AUTHENTICATION_BACKENDS = ('django.contrib.auth.backends.ModelBackend',
                            'auth.backends.LDAPBackend')
 
@@ -51,6 +52,7 @@ XS_SHARING_ALLOWED_ORIGINS = '*'
 XS_SHARING_ALLOWED_METHODS = ['GET']
 
 MIDDLEWARE_CLASSES = (
+    'deso.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -80,6 +82,13 @@ DATABASES = {
     }
 }
 
+# raster pixel data (NumericRasterAggregateData/TextRasterAggregateData) placement (see deso.layers.raster.routers)
+# --> the pixels of a layer are stored in RASTER_PIXEL_DATABASES[layer.id % len(RASTER_PIXEL_DATABASES)],
+#     additional databases are defined in DATABASES (local_settings.py) and created with 'migrate --database <alias>'
+# NOTE: changing this list moves existing layers to other databases (pixel data must be moved)
+RASTER_PIXEL_DATABASES = ("default",)
+DATABASE_ROUTERS = ("deso.layers.raster.routers.PixelDatabaseRouter",)
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -101,10 +110,14 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
-import socket
-ip = [(s.connect(('8.8.8.8', 80)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]
-HOST = ip
-PORT = 8086  # Configured in deso-apache.conf and in apache2/ports.conf
+# host/port used in served urls (may also be set in local_settings)
+# --> if HOST is not set, the host address is detected on first use (see deso.hosts.get_host())
+HOST = os.environ.get("DESO_HOST", None)
+PORT = int(os.environ.get("DESO_PORT", 8086))  # Configured in deso-apache.conf and in apache2/ports.conf
+
+# layer urls are stored as paths and expanded per request (see deso.hosts.expand_url())
+# --> if given, tile requests are spread over these hosts, for example: ("http://tiles1.example.com:8086", "http://tiles2.example.com:8086")
+TILE_HOSTS = ()
 
 
 CACHES = {
@@ -116,11 +129,81 @@ CACHES = {
         }
     },
   'tilecache': {
-    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    # in-process LRU (per process) in front of a hash-sharded directory store
+    'BACKEND': 'deso.tilecache.TieredTileCache',
     'LOCATION': os.path.join(BASE_DIR, ".tilecache"),
+    'OPTIONS': {
+        'LRU_MAX_BYTES': 64 * 1024 * 1024,
+        'LRU_MAX_ITEM_BYTES': 256 * 1024,
+        'LRU_TIMEOUT': 300,
+        'DEDUPLICATE': True,  # identical tiles are stored once, see 'clean_tilecache'
+    },
   },
 }
 
+# RasterAggregatedLayer tile occupancy index
+# --> tiles outside of the indexed layer data are served as a shared empty tile (no DB query or render)
+RASTER_TILE_INDEX_MAX_ZOOM = 19
+RASTER_TILE_INDEX_CACHE_SECONDS = 60 * 5  # in-process cache of layer indexes
+
+# RasterAggregatedLayer tile rendering
+# --> tiles are rendered in blocks of (RASTER_METATILE_SIZE x RASTER_METATILE_SIZE) tiles from a single query,
+#     and all resulting tiles are stored in the 'tilecache'
+RASTER_METATILE_SIZE = 8
+RASTER_TILE_CACHE_SECONDS = 60 * 60 * 24 * 5  # seconds * minutes * hours * days (also the tile browser cache max-age)
+RASTER_TILE_PALETTE = True  # render 8-bit palette tiles from the legend colors (RGBA if the legend colors exceed the palette)
+RASTER_PNG_COMPRESS_LEVEL = 6  # zlib level, see 'benchmark_tile_encoding'
+RASTER_WEBP_OPTIONS = {"lossless": True, "method": 1}  # method: 0 (fast) - 6 (small)
+RASTER_TILE_WEBP_URLS = True  # include '.webp' tile urls in the layer information, requested by browsers supporting webp
+RASTER_TILE_BATCH_MAX_TILES = 256  # maximum tiles per batch tile request
+RASTER_LEGEND_CACHE_SECONDS = 60 * 5  # legend html browser cache max-age & in-process legend version check interval
+
+# UTFGrid interaction tiles ('/raster/grid/<layer_id>/{z}/{x}/{y}.json', see deso.layers.raster.utfgrid)
+RASTER_UTFGRID_MIN_ZOOM = 12  # lower zoom levels cover too many pixels per grid cell
+
+# zonal statistics ('/raster/zonal/<layer_id>/', see deso.layers.raster.zonal)
+RASTER_ZONAL_MAX_PIXELS = 4000000  # maximum grid cells within the polygon bounds (limits the query time)
+RASTER_ZONAL_HISTOGRAM_BINS = 10  # default value histogram bins
+
+# default output directory of 'export_raster_mbtiles' archives
+RASTER_MBTILES_DIRECTORY = os.path.join(BASE_DIR, "mbtiles")
+
+# pixel files of columnar layers (RasterAggregatedLayer.data_model 'ColumnarRasterData', see deso.layers.raster.columnar)
+RASTER_COLUMNAR_DIRECTORY = os.path.join(BASE_DIR, "columnar")
+
+# single-flight (coalesced) tile rendering
+# --> concurrent renders of the same metatile are coordinated across processes with a lock in this cache
+SINGLEFLIGHT_LOCK_CACHE = "default"
+SINGLEFLIGHT_LOCK_SECONDS = 60  # lock expiry (in case the lock holding process dies)
+SINGLEFLIGHT_WAIT_SECONDS = 30  # maximum time to wait for another process, before rendering
+SINGLEFLIGHT_POLL_SECONDS = 0.05
+
+# operational metrics (see deso.metrics, served at '/metrics/')
+# --> each process buffers values and adds them to a shared redis hash in this cache every METRICS_FLUSH_SECONDS
+METRICS_CACHE = "default"
+METRICS_KEY = "deso:metrics"
+METRICS_FLUSH_SECONDS = 10
+METRICS_COUNT_DB_QUERIES = True  # count queries per view (a counter on the connection cursors, the query log is not enabled)
+
+# tile request phase timings (see deso.instrumentation)
+# --> one JSON line per tile request is logged to the 'deso.instrumentation' logger (stderr, mod_wsgi error log)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'deso.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 
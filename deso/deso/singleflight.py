@@ -0,0 +1,119 @@
+"""
+Single-flight execution of expensive functions (tile rendering).
+
+Concurrent calls for the same key are coalesced so that only one call executes the function:
+ - threads within a process wait on a per-key lock, and receive the result of the thread that executed the function.
+ - processes coordinate through a lock key 'add()'ed to a shared cache (redis), waiting processes
+   poll the given 'fetch' function for the result stored by the process holding the lock.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = 0
+        self.result = None
+        self.result_time = None
+
+
+# { key: _Flight, ... }
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def _acquire_flight(key):
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(key, None)
+        if flight is None:
+            flight = _Flight()
+            _FLIGHTS[key] = flight
+        flight.waiters += 1
+        return flight
+
+
+def _release_flight(key, flight):
+    with _FLIGHTS_LOCK:
+        flight.waiters -= 1
+        if flight.waiters <= 0 and _FLIGHTS.get(key, None) is flight:
+            del _FLIGHTS[key]
+
+
+def _run_with_shared_lock(key, func, fetch):
+    """
+    Run func() while holding the shared cache lock for the given key,
+    or wait for the lock holder to produce a result obtainable through fetch().
+    """
+    try:
+        lock_cache = caches[settings.SINGLEFLIGHT_LOCK_CACHE]
+    except Exception as e:
+        logger.warning("SINGLEFLIGHT_LOCK_CACHE unavailable, running without shared lock: {}".format(e))
+        return func()
+
+    lock_key = "singleflight:{}".format(key)
+    token = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+    deadline = time.time() + settings.SINGLEFLIGHT_WAIT_SECONDS
+    while True:
+        try:
+            acquired = lock_cache.add(lock_key, token, settings.SINGLEFLIGHT_LOCK_SECONDS)
+        except Exception as e:
+            logger.warning("Unable to obtain shared lock ({}), running without shared lock: {}".format(lock_key, e))
+            return func()
+
+        if acquired:
+            try:
+                # result may have been produced while waiting for the lock
+                result = fetch() if fetch else None
+                if result is None:
+                    result = func()
+                return result
+            finally:
+                try:
+                    if lock_cache.get(lock_key) == token:
+                        lock_cache.delete(lock_key)
+                except Exception as e:
+                    logger.warning("Unable to release shared lock ({}): {}".format(lock_key, e))
+
+        time.sleep(settings.SINGLEFLIGHT_POLL_SECONDS)
+        result = fetch() if fetch else None
+        if result is not None:
+            return result
+        if time.time() >= deadline:
+            logger.warning("Timed out waiting for shared lock ({}), running func()".format(lock_key))
+            return func()
+
+
+def do(key, func, fetch=None):
+    """
+    Execute func() once for concurrent calls with the same key.
+    :param key: str key identifying the work (for example, the tile or metatile being rendered)
+    :param func: function producing the result (expected to store the result where fetch() can find it)
+    :param fetch: (optional) function returning the already produced result, or None if not available
+    :return: result of func() (or fetch())
+    """
+    arrived = time.time()
+    flight = _acquire_flight(key)
+    try:
+        with flight.lock:
+            if flight.result is not None and flight.result_time >= arrived:
+                # produced by another thread in this process while waiting
+                return flight.result
+            result = fetch() if fetch else None
+            if result is None:
+                result = _run_with_shared_lock(key, func, fetch)
+            flight.result = result
+            flight.result_time = time.time()
+            return result
+    finally:
+        _release_flight(key, flight)
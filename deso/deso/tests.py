@@ -0,0 +1,18 @@
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+from deso.hosts import expand_url, expand_tile_url
+
+
+@override_settings(TILE_HOSTS=None)
+class ExpandUrlTestCase(SimpleTestCase):
+
+    def test_expand_url(self):
+        request = RequestFactory().get("/collections/", HTTP_HOST="h:8086")
+        self.assertEqual(expand_url("/raster/legend/1/", request), "http://h:8086/raster/legend/1/")
+        self.assertEqual(expand_url("http://other/legend/", request), "http://other/legend/")
+
+    def test_expand_tile_url_template(self):
+        request = RequestFactory().get("/collections/", HTTP_HOST="h:8086")
+        url, tile_hosts = expand_tile_url("/raster/layer/1/{z}/{x}/{y}.png", request)
+        self.assertEqual(url, "http://h:8086/raster/layer/1/{z}/{x}/{y}.png")
+        self.assertIsNone(tile_hosts)
@@ -0,0 +1,453 @@
+"""
+Tiered tile cache backend.
+
+A size bounded in-process LRU of encoded tile bytes, in front of a shared hash-sharded directory store.
+
+Byte values are stored content-addressed: each unique value (encoded tile image) is written once as a 'blob',
+and key entries only reference the blob's digest.  (Many tiles are identical, fully transparent or solid color tiles)
+Blobs no longer referenced by any key are removed by 'remove_unreferenced_blobs()'.
+
+Unlike django's FileBasedCache, the directory store never lists the cache directory
+(no '_cull()' on set), so 'get' and 'set' cost stays constant with millions of entries.
+
+Configure in settings.CACHES:
+
+    'tilecache': {
+        'BACKEND': 'deso.tilecache.TieredTileCache',
+        'LOCATION': '/path/to/tilecache',
+        'OPTIONS': {
+            'LRU_MAX_BYTES': 64 * 1024 * 1024,  # in-process LRU size (per process)
+            'LRU_MAX_ITEM_BYTES': 256 * 1024,  # larger values are only held in the shared store
+            'LRU_TIMEOUT': 300,  # seconds, limits how long entries removed by other processes may be served
+            'DEDUPLICATE': True,  # store identical byte values once
+        }
+    }
+"""
+import os
+import time
+import uuid
+import errno
+import pickle
+import shutil
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from deso import metrics
+
+
+DEFAULT_LRU_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_LRU_MAX_ITEM_BYTES = 256 * 1024
+DEFAULT_LRU_TIMEOUT = 300
+
+# namespace used for keys without a namespace, see ShardedFileStore.get_namespace()
+DEFAULT_NAMESPACE = "_"
+# directory of content-addressed values (namespaces of keys never start with '_' + name)
+BLOBS_DIRECTORY = "_blobs"
+
+# entry file header: expiry (0 == never), value type
+ENTRY_HEADER_FORMAT = "<dB"
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_HEADER_FORMAT)
+VALUE_TYPE_BYTES = 0
+VALUE_TYPE_PICKLE = 1
+VALUE_TYPE_BLOB = 2  # entry value is the digest of a content-addressed blob
+
+
+def content_digest(value):
+    """
+    :param value: bytes
+    :return: hex digest identifying the given content (used as blob name & tile ETag)
+    """
+    return hashlib.sha1(value).hexdigest()
+
+
+class LRUBytesCache:
+    """
+    Thread-safe, size (bytes) bounded LRU cache.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_LRU_MAX_BYTES, max_item_bytes=DEFAULT_LRU_MAX_ITEM_BYTES):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # { key: (expiry, value, size), ... }
+        self._lock = threading.Lock()
+
+    def _sizeof(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key):
+        """
+        :return: value or None if not found/expired
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            expiry, value, size = entry
+            if expiry is not None and expiry <= time.time():
+                del self._entries[key]
+                self.current_bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expiry):
+        size = self._sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_item_bytes:
+                return
+            self._entries[key] = (expiry, value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ShardedFileStore:
+    """
+    Directory store with entries placed by key hash:
+
+        <root>/<namespace>/<hash[0:2]>/<hash[2:4]>/<hash>
+
+    Where 'namespace' is the first 2 ':' separated parts of the key (for example, 'raster:12'),
+    allowing all entries of a namespace to be removed with a single directory removal.
+
+    If deduplicate is True, byte values are written once to:
+
+        <root>/_blobs/<digest[0:2]>/<digest[2:4]>/<digest>
+    """
+
+    def __init__(self, root, deduplicate=True):
+        self.root = os.path.abspath(root)
+        self.deduplicate = deduplicate
+
+    def get_namespace(self, key):
+        """
+        :param key: key as given to the cache (before 'make_key()')
+        """
+        parts = key.split(":")
+        if len(parts) < 3:
+            return DEFAULT_NAMESPACE
+        return "-".join(part.replace(os.sep, "_") for part in parts[:2])
+
+    def get_namespace_directory(self, namespace):
+        return os.path.join(self.root, namespace)
+
+    def get_path(self, namespace, made_key):
+        key_hash = hashlib.sha1(made_key.encode("utf8")).hexdigest()
+        return os.path.join(self.get_namespace_directory(namespace), key_hash[:2], key_hash[2:4], key_hash)
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.root, BLOBS_DIRECTORY, digest[:2], digest[2:4], digest)
+
+    def _read_file(self, path):
+        try:
+            with open(path, "rb") as in_f:
+                return in_f.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _write_file(self, path, *parts):
+        directory = os.path.dirname(path)
+        # write to a temporary file & rename, so readers never see partial entries
+        temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        for attempt in range(2):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                with open(temp_path, "wb") as out_f:
+                    for part in parts:
+                        out_f.write(part)
+                os.replace(temp_path, path)
+                break
+            except (IOError, OSError) as e:
+                # directory may have been removed by a concurrent clear(), retry once
+                if e.errno != errno.ENOENT or attempt:
+                    raise
+
+    def read(self, path):
+        """
+        :return: (expiry, value) or None if path (or the referenced blob) does not exist
+        """
+        data = self._read_file(path)
+        if data is None:
+            return None
+        expiry, value_type = struct.unpack_from(ENTRY_HEADER_FORMAT, data, 0)
+        value = data[ENTRY_HEADER_SIZE:]
+        if value_type == VALUE_TYPE_PICKLE:
+            value = pickle.loads(value)
+        elif value_type == VALUE_TYPE_BLOB:
+            value = self._read_file(self.get_blob_path(value.decode("ascii")))
+            if value is None:
+                return None
+        return (expiry or None), value
+
+    def write_blob(self, value):
+        """
+        Store the given bytes once by content.
+        :return: digest of the value
+        """
+        digest = content_digest(value)
+        blob_path = self.get_blob_path(digest)
+        try:
+            # existing blob, update mtime so that the blob is not seen as unreferenced during removal
+            os.utime(blob_path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._write_file(blob_path, value)
+        return digest
+
+    def write(self, path, value, expiry):
+        if isinstance(value, (bytes, bytearray)):
+            if self.deduplicate:
+                value_type = VALUE_TYPE_BLOB
+                payload = self.write_blob(bytes(value)).encode("ascii")
+            else:
+                value_type = VALUE_TYPE_BYTES
+                payload = bytes(value)
+        else:
+            value_type = VALUE_TYPE_PICKLE
+            payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        header = struct.pack(ENTRY_HEADER_FORMAT, expiry or 0, value_type)
+        self._write_file(path, header, payload)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+    def _remove_directory(self, directory):
+        if not os.path.exists(directory):
+            return
+        # rename first so that new entries are not written into the directory being removed
+        deleting_directory = "{}.{}.deleting".format(directory, uuid.uuid4().hex)
+        try:
+            os.rename(directory, deleting_directory)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        shutil.rmtree(deleting_directory, ignore_errors=True)
+
+    def remove_namespace(self, namespace):
+        """
+        NOTE: blobs referenced by the namespace entries remain until remove_unreferenced_blobs()
+        """
+        self._remove_directory(self.get_namespace_directory(namespace))
+
+    def _walk_files(self, directory):
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if not filename.endswith(".tmp"):
+                    yield os.path.join(dirpath, filename)
+
+    def remove_unreferenced_blobs(self, minimum_age_seconds=60 * 60):
+        """
+        Remove blobs not referenced by any entry.
+        Blobs modified within minimum_age_seconds are kept, as their entries may still be being written.
+        :return: (kept blob count, removed blob count)
+        """
+        referenced = set()
+        blobs_directory = os.path.join(self.root, BLOBS_DIRECTORY)
+        if not os.path.exists(self.root):
+            return 0, 0
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if name == BLOBS_DIRECTORY or name.endswith(".deleting") or not os.path.isdir(directory):
+                continue
+            for path in self._walk_files(directory):
+                data = self._read_file(path)
+                if data is None:
+                    continue
+                _, value_type = struct.unpack_from(ENTRY_HEADER_FORMAT, data, 0)
+                if value_type == VALUE_TYPE_BLOB:
+                    referenced.add(data[ENTRY_HEADER_SIZE:].decode("ascii"))
+
+        kept = removed = 0
+        oldest_mtime = time.time() - minimum_age_seconds
+        for path in self._walk_files(blobs_directory):
+            try:
+                if os.path.basename(path) in referenced or os.path.getmtime(path) > oldest_mtime:
+                    kept += 1
+                    continue
+            except OSError:
+                continue
+            if self.remove(path):
+                removed += 1
+        return kept, removed
+
+    def clear(self):
+        self._remove_directory(self.root)
+
+
+class TieredTileCache(BaseCache):
+    """
+    Django cache backend with an in-process LRU (tier 1) over a ShardedFileStore (tier 2).
+    Hit/Miss counters for each tier are recorded to deso.metrics (aggregated across processes, served at '/metrics/'):
+        tilecache_hits_total{tier="lru|store"}, tilecache_misses_total{tier="lru|store"}, tilecache_sets_total
+    and are available for this process through stats().
+    """
+
+    def __init__(self, location, params):
+        super(TieredTileCache, self).__init__(params)
+        options = params.get("OPTIONS", {})
+        self._lru = LRUBytesCache(max_bytes=int(options.get("LRU_MAX_BYTES", DEFAULT_LRU_MAX_BYTES)),
+                                  max_item_bytes=int(options.get("LRU_MAX_ITEM_BYTES", DEFAULT_LRU_MAX_ITEM_BYTES)))
+        self._lru_timeout = int(options.get("LRU_TIMEOUT", DEFAULT_LRU_TIMEOUT))
+        self._store = ShardedFileStore(location, deduplicate=bool(options.get("DEDUPLICATE", True)))
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self.reset_stats()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+        tier, _, result = name.partition("_")
+        if result:
+            metrics.incr("tilecache_{}_total".format(result), tier=tier)
+        else:
+            metrics.incr("tilecache_{}_total".format(name))
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {"lru_hits": 0,
+                           "lru_misses": 0,
+                           "store_hits": 0,
+                           "store_misses": 0,
+                           "sets": 0}
+
+    def stats(self):
+        """
+        :return: dictionary of per-tier hit/miss counters for this process
+        """
+        with self._stats_lock:
+            result = dict(self._stats)
+        result["lru_entries"] = len(self._lru)
+        result["lru_bytes"] = self._lru.current_bytes
+        return result
+
+    def _is_expired(self, expiry):
+        return expiry is not None and expiry <= time.time()
+
+    def _lru_set(self, made_key, value, expiry):
+        lru_expiry = time.time() + self._lru_timeout
+        if expiry is not None:
+            lru_expiry = min(lru_expiry, expiry)
+        self._lru.set(made_key, value, lru_expiry)
+
+    def _get_path(self, key, made_key):
+        return self._store.get_path(self._store.get_namespace(key), made_key)
+
+    def get(self, key, default=None, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        value = self._lru.get(made_key)
+        if value is not None:
+            self._count("lru_hits")
+            return value
+        self._count("lru_misses")
+
+        path = self._get_path(key, made_key)
+        entry = self._store.read(path)
+        if entry is None:
+            self._count("store_misses")
+            return default
+        expiry, value = entry
+        if self._is_expired(expiry):
+            self._store.remove(path)
+            self._count("store_misses")
+            return default
+        self._count("store_hits")
+        self._lru_set(made_key, value, expiry)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        expiry = self.get_backend_timeout(timeout)
+        if expiry is not None and expiry <= time.time():
+            # timeout of 0 (or negative) expires immediately
+            self.delete(key, version=version)
+            return
+        self._store.write(self._get_path(key, made_key), value, expiry)
+        self._lru_set(made_key, value, expiry)
+        self._count("sets")
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if self.has_key(key, version=version):
+            return False
+        self.set(key, value, timeout, version=version)
+        return True
+
+    def has_key(self, key, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        if self._lru.get(made_key) is not None:
+            return True
+        entry = self._store.read(self._get_path(key, made_key))
+        return entry is not None and not self._is_expired(entry[0])
+
+    def delete(self, key, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        self._lru.delete(made_key)
+        self._store.remove(self._get_path(key, made_key))
+
+    def delete_namespace(self, namespace, version=None):
+        """
+        Remove all entries for keys starting with the given namespace (for example, 'raster:12').
+        NOTE: LRU entries are only removed from the current process,
+              other processes may serve removed entries for up to 'LRU_TIMEOUT' seconds.
+        """
+        self._lru.delete_prefix(self.make_key(namespace, version=version) + ":")
+        self._store.remove_namespace(self._store.get_namespace(namespace + ":"))
+
+    def remove_unreferenced_blobs(self, minimum_age_seconds=60 * 60):
+        """
+        Remove stored values no longer referenced by any key (for example, after delete_namespace()).
+        :return: (kept blob count, removed blob count)
+        """
+        return self._store.remove_unreferenced_blobs(minimum_age_seconds)
+
+    def clear(self):
+        self._lru.clear()
+        self._store.clear()
@@ -0,0 +1,79 @@
+"""
+Consistent hashing of tiles onto tile hosts (settings.TILE_HOSTS).
+
+Tiles are routed by (layer, zoom, column band), a band being settings.RASTER_METATILE_SIZE tile columns,
+so that all tiles of a metatile are requested from (rendered & cached by) the same host,
+and adding or removing a host only moves the bands of that host.
+
+The ring is rebuilt by the map client (static/js/tilerouting.js) from the options returned by get_routing_options(),
+both implementations must produce the same ring.
+"""
+import bisect
+
+from django.conf import settings
+
+FNV32_OFFSET_BASIS = 0x811c9dc5
+FNV32_PRIME = 0x01000193
+
+# virtual points per host on the ring (more points, more even distribution)
+DEFAULT_RING_REPLICAS = 64
+
+
+def fnv1a_32(text):
+    """
+    :param text: ascii str
+    :return: 32 bit FNV-1a hash
+    """
+    value = FNV32_OFFSET_BASIS
+    for byte in text.encode("utf8"):
+        value ^= byte
+        value = (value * FNV32_PRIME) & 0xffffffff
+    return value
+
+
+class TileHostRing:
+    """
+    Consistent hash ring of tile hosts.
+    """
+
+    def __init__(self, hosts, replicas=DEFAULT_RING_REPLICAS, band_columns=None):
+        """
+        :param hosts: tile host base urls (for example, 'http://tiles1.example.com:8086')
+        :param replicas: virtual points per host
+        :param band_columns: tile columns routed together [DEFAULT=settings.RASTER_METATILE_SIZE]
+        """
+        if not hosts:
+            raise ValueError("At least one host is required")
+        self.hosts = list(hosts)
+        self.replicas = replicas
+        self.band_columns = band_columns or settings.RASTER_METATILE_SIZE
+        points = sorted((fnv1a_32("{}#{}".format(host, replica)), index)
+                        for index, host in enumerate(self.hosts) for replica in range(replicas))
+        self._point_values = [value for value, index in points]
+        self._point_hosts = [index for value, index in points]
+
+    def get_host_index(self, key, zoom, tilex):
+        """
+        :param key: layer routing key (the layer url path)
+        :return: index (in hosts) of the host serving the given tile column
+        """
+        value = fnv1a_32("{}:{}:{}".format(key, zoom, tilex // self.band_columns))
+        position = bisect.bisect_left(self._point_values, value)
+        if position == len(self._point_values):
+            position = 0
+        return self._point_hosts[position]
+
+    def get_host(self, key, zoom, tilex):
+        return self.hosts[self.get_host_index(key, zoom, tilex)]
+
+
+def get_routing_options(key, hosts):
+    """
+    :param key: layer routing key (the layer url path)
+    :param hosts: tile host base urls
+    :return: client ring options, see static/js/tilerouting.js
+    """
+    return {"key": key,
+            "hosts": list(hosts),
+            "replicas": DEFAULT_RING_REPLICAS,
+            "bandColumns": settings.RASTER_METATILE_SIZE}
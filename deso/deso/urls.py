@@ -1,6 +1,7 @@
 from django.conf.urls import patterns, include, url
 from django.views.generic import RedirectView
 from django.contrib import admin
+from deso.metrics import metrics_view
 
 admin.autodiscover()
 
@@ -10,6 +11,7 @@ urlpatterns = patterns('',
     url(r'^vector/', include('deso.layers.vector.urls')),
     url(r'^raster/', include('deso.layers.raster.urls')),
     url(r'^collections/', include('deso.layercollections.urls')),
+    url(r'^metrics/$', metrics_view),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^$', RedirectView.as_view(url="/static/index.html")),
 )
@@ -19,6 +19,12 @@ var overlayTileLayerOpacity = 0.80;//0.45;
 var collectionName = null;
 var initialRefresh = true;
 var vectorLayerCenterLatLng = undefined;
+var pixelInfoControl = undefined;
+// browsers able to decode webp request the layer's '.webp' tiles ('webpUrl'), when available
+var supportsWebp = (function(){
+    var canvas = document.createElement('canvas');
+    return !!(canvas.getContext && canvas.toDataURL('image/webp').indexOf('data:image/webp') === 0);
+})();
 
 var urlQSParams;
 (window.onpopstate = function () {
@@ -102,11 +108,84 @@ function createMarker(feature, latlng){
     return marker;
 }
 
+function formatPixelValues(name, values){
+    var content = '<div class="popup-content"><b>' + name + '</b></div>';
+    for (var key in values){
+        var value = values[key];
+        if (value !== null){
+            if (typeof value === "number" && Math.round(value) !== value){
+                value = value.toFixed(3);
+            }
+            content += '<div class="popup-content">' + key + ": " + value + "</div>";
+        }
+    }
+    return content;
+}
+
+function getPixelInfoControl(){
+    // displays the values of the raster layer pixel under the mouse
+    if (pixelInfoControl === undefined){
+        pixelInfoControl = L.control({position: 'bottomleft'});
+        pixelInfoControl.onAdd = function (map) {
+            this._div = L.DomUtil.create('div', 'info pixel-info');
+            this.update();
+            return this._div;
+        };
+        pixelInfoControl.update = function (name, values) {
+            this._div.innerHTML = name ? formatPixelValues(name, values) : "";
+            this._div.style.display = name ? "block" : "none";
+        };
+        pixelInfoControl.addTo(map);
+    }
+    return pixelInfoControl;
+}
+
+function createGridLayer(layer){
+    // hover readout from the layer's UTFGrid tiles (see utfgrid.js)
+    var gridLayer = new L.UtfGridLayer(layer.gridUrl, {minZoom: layer.gridMinZoom || 0,
+                                                       tileRouting: layer.tileRouting});
+    gridLayer.on('mouseover', function (e) {
+        getPixelInfoControl().update(layer.name, e.data);
+    });
+    gridLayer.on('mouseout', function () {
+        getPixelInfoControl().update();
+    });
+    return gridLayer;
+}
+
+function requestPointValues(name, latlng){
+    var xhrequest = new XMLHttpRequest();
+    xhrequest.onreadystatechange = function(){
+        if (xhrequest.readyState == 4 && xhrequest.status == 200){
+            var result = JSON.parse(xhrequest.responseText);
+            if (result.pixel !== null){
+                L.popup().setLatLng(latlng)
+                         .setContent(formatPixelValues(name, result.pixel.values))
+                         .openOn(map);
+            }
+        }
+    };
+    var url = overlayMaps[name].layerinfo.pointUrl + '?lon=' + latlng.lng + '&lat=' + latlng.lat;
+    xhrequest.open('GET', url, true);
+    xhrequest.send(null);
+}
+
+function onMapClick(e){
+    // value readout of the displayed raster layers at the clicked location
+    for (var name in overlayMaps){
+        if (overlayMaps[name].togglestate === true && overlayMaps[name].layerinfo.pointUrl !== undefined){
+            requestPointValues(name, e.latlng);
+        }
+    }
+}
 
 function onOverlayAdd(layer){
     if (!map.hasLayer(overlayMaps[layer.name])){
         overlayMaps[layer.name].addTo(map);
     }
+    if (overlayMaps[layer.name].gridLayer !== undefined && !map.hasLayer(overlayMaps[layer.name].gridLayer)){
+        overlayMaps[layer.name].gridLayer.addTo(map);
+    }
     if (overlayMaps[layer.name].legendControl !== undefined){
         overlayMaps[layer.name].legendControl.addTo(this);
     }
@@ -117,6 +196,9 @@ function onOverlayAdd(layer){
 
 function onOverlayRemove(layer){
     overlayMaps[layer.name].togglestate = false;
+    if (overlayMaps[layer.name].gridLayer !== undefined){
+        map.removeLayer(overlayMaps[layer.name].gridLayer);
+    }
     if (overlayMaps[layer.name].legendControl !== undefined){
         this.removeControl(overlayMaps[layer.name].legendControl);
     }
@@ -129,14 +211,13 @@ function initmap() {
 
 	// get collection
 	var collection_id = getParameterByName("collection");
+	// collections are requested from the server hosting this page (layer urls in the response are expanded for this host)
 	if (collection_id){
-        // TODO: Update to be more dynamic (don't use static IP here!)
-        var layerCollectionUrl = 'http://10.143.165.241:8086/collections/collection/' + collection_id + '/';
+        var layerCollectionUrl = '/collections/collection/' + collection_id + '/';
 	}
 	else{
 	    // default collection
-	    // TODO: Update to be more dynamic (don't use static IP here!)
-	    var layerCollectionUrl = 'http://10.143.165.241:8086/collections/collection/1/';
+	    var layerCollectionUrl = '/collections/collection/1/';
 	}
 
 	// retrieve layers from collection
@@ -175,11 +256,38 @@ function initmap() {
                             if (layer.opacity !== undefined && layer.opacity >= 0 && layer.opacity <= 1.0){
                                 layerOpacity = layer.opacity;
                             }
-                            var tileLayer = new L.TileLayer(layer.layerUrl, {tms: true,
-                                                                             minZoom:layer.minZoom,
-                                                                             maxZoom:layer.maxZoom,
-                                                                             attribution:layer.attribution,
-                                                                             opacity: overlayTileLayerOpacity});
+                            // high-dpi displays use the 512px '@2x' tiles (same tile count as standard displays)
+                            var useWebp = supportsWebp && layer.webpUrl;
+                            var tileLayerUrl = useWebp ? layer.webpUrl : layer.layerUrl;
+                            var tileScale = 1;
+                            if (L.Browser.retina && layer.hiDpiUrl){
+                                tileLayerUrl = (useWebp && layer.hiDpiWebpUrl) ? layer.hiDpiWebpUrl : layer.hiDpiUrl;
+                                tileScale = 2;
+                            }
+                            var tileLayerOptions = {tms: true,
+                                                    minZoom:layer.minZoom,
+                                                    maxZoom:layer.maxZoom,
+                                                    attribution:layer.attribution,
+                                                    opacity: overlayTileLayerOpacity};
+                            if (layer.tileRouting){
+                                // tile host substituted for '{s}' in the layer url selected per tile (see tilerouting.js)
+                                tileLayerOptions.tileRouting = layer.tileRouting;
+                            }
+                            var tileLayer;
+                            if (layer.batchUrl){
+                                // load all tiles of a pan/zoom update in a single request (see tilebatch.js)
+                                tileLayerOptions.batchUrl = layer.batchUrl;
+                                tileLayerOptions.scale = tileScale;
+                                tileLayerOptions.format = /\.webp$/.test(tileLayerUrl) ? "webp" : "png";
+                                tileLayer = new L.TileLayer.Batch(tileLayerUrl, tileLayerOptions);
+                            }
+                            else{
+                                tileLayer = new L.TileLayer(tileLayerUrl, tileLayerOptions);
+                            }
+
+                            if (layer.gridUrl){
+                                tileLayer.gridLayer = createGridLayer(layer);
+                            }
 
                             overlayMaps[layer.name] = tileLayer;
                             console.log(layer.name);
@@ -202,6 +310,9 @@ function initmap() {
                             updateLayerLegendControl(layer.name);
                         }
                         overlayMaps[layer.name].addTo(map);
+                        if (overlayMaps[layer.name].gridLayer !== undefined){
+                            overlayMaps[layer.name].gridLayer.addTo(map);
+                        }
                         console.log("Adding " + layer.type);
                     }
                 }
@@ -232,6 +343,7 @@ function initmap() {
                 map.on('moveend', onMapMove); // refreshGeoJSONLayers on mapMove
                 map.on('overlayadd', onOverlayAdd);
                 map.on('overlayremove', onOverlayRemove);
+                map.on('click', onMapClick);
                 refreshGeoJSONLayers();
             }
         }
@@ -0,0 +1,138 @@
+/* Batched tile loading */
+/*
+L.TileLayer.Batch loads the tiles requested by leaflet in a single request per zoom level (per 'batchSize' tiles)
+from the deso raster batch endpoint ('/raster/batch/<layer_id>/').
+
+Batch response records (little-endian):
+    zoom (uint8), tilex (uint32), tiley (uint32), length (uint32), <length bytes of encoded tile image>
+A length of 0 indicates an empty (fully transparent) tile.
+
+If a batch request fails, the tiles of the batch are loaded individually from the layer url.
+
+With the 'tileRouting' option (see tilerouting.js), tiles are batched per zoom level & tile host,
+each batch being requested from the host selected for its tiles.
+*/
+var BATCH_RECORD_HEADER_LENGTH = 13;
+
+L.TileLayer.Batch = L.TileLayer.extend({
+    options: {
+        batchUrl: null,
+        batchSize: 64,
+        scale: 1,  // 2 for high-dpi ('@2x') tiles
+        format: "png"
+    },
+
+    initialize: function (url, options) {
+        L.TileLayer.prototype.initialize.call(this, url, options);
+        this._pendingTiles = [];
+        this._flushTimer = null;
+    },
+
+    _loadTile: function (tile, tilePoint) {
+        tile._layer  = this;
+        tile.onload  = this._tileOnLoad;
+        tile.onerror = this._tileOnError;
+
+        this._adjustTilePoint(tilePoint);
+        this._pendingTiles.push({tile: tile, point: L.point(tilePoint.x, tilePoint.y), x: tilePoint.x, z: tilePoint.z});
+        if (!this._flushTimer){
+            // collect all tiles requested during the current update before sending
+            this._flushTimer = setTimeout(L.bind(this._flushTiles, this), 0);
+        }
+        this.fire('tileloadstart', {
+            tile: tile,
+            url: this.options.batchUrl
+        });
+    },
+
+    _flushTiles: function () {
+        var pending = this._pendingTiles;
+        this._pendingTiles = [];
+        this._flushTimer = null;
+
+        var batches = {};
+        for (var i=0;i<pending.length;i++){
+            var host = this.options.tileRouting ? this._getSubdomain(pending[i]) : "";
+            var key = pending[i].z + "|" + host;
+            if (!batches.hasOwnProperty(key)){
+                batches[key] = {zoom: pending[i].z, host: host, tiles: []};
+            }
+            batches[key].tiles.push(pending[i]);
+        }
+        for (var batchKey in batches){
+            var batch = batches[batchKey];
+            for (var start=0;start<batch.tiles.length;start+=this.options.batchSize){
+                this._requestBatch(batch.zoom, batch.tiles.slice(start, start + this.options.batchSize), batch.host);
+            }
+        }
+    },
+
+    _requestBatch: function (zoom, batchTiles, host) {
+        var layer = this;
+        var tilesByKey = {};
+        var tileParams = [];
+        for (var i=0;i<batchTiles.length;i++){
+            var point = batchTiles[i].point;
+            tilesByKey[point.x + "/" + point.y] = batchTiles[i];
+            tileParams.push(point.x + "," + point.y);
+        }
+        var batchUrl = host ? L.Util.template(this.options.batchUrl, {s: host}) : this.options.batchUrl;
+        var url = batchUrl + "?z=" + zoom + "&tiles=" + tileParams.join(";") +
+                  "&format=" + this.options.format + "&scale=" + this.options.scale;
+        var xhrequest = new XMLHttpRequest();
+        xhrequest.open('GET', url, true);
+        xhrequest.responseType = "arraybuffer";
+        xhrequest.onload = function () {
+            if (xhrequest.status !== 200){
+                layer._loadTilesIndividually(batchTiles);
+                return;
+            }
+            var contentType = xhrequest.getResponseHeader("X-Tile-Content-Type") || "image/png";
+            var buffer = xhrequest.response;
+            var view = new DataView(buffer);
+            var offset = 0;
+            while (offset + BATCH_RECORD_HEADER_LENGTH <= buffer.byteLength){
+                var tilex = view.getUint32(offset + 1, true);
+                var tiley = view.getUint32(offset + 5, true);
+                var length = view.getUint32(offset + 9, true);
+                offset += BATCH_RECORD_HEADER_LENGTH;
+                var batchTile = tilesByKey[tilex + "/" + tiley];
+                if (batchTile !== undefined){
+                    layer._setTileContent(batchTile.tile, buffer.slice(offset, offset + length), contentType);
+                }
+                offset += length;
+            }
+        };
+        xhrequest.onerror = function () {
+            layer._loadTilesIndividually(batchTiles);
+        };
+        xhrequest.send();
+    },
+
+    _setTileContent: function (tile, content, contentType) {
+        if (content.byteLength === 0){
+            // empty tile, nothing to display
+            tile.src = L.Util.emptyImageUrl;
+            return;
+        }
+        var objectUrl = URL.createObjectURL(new Blob([content], {type: contentType}));
+        var onload = tile.onload;
+        tile.onload = function () {
+            URL.revokeObjectURL(objectUrl);
+            tile.onload = onload;
+            onload.call(tile);
+        };
+        tile.src = objectUrl;
+    },
+
+    _loadTilesIndividually: function (batchTiles) {
+        for (var i=0;i<batchTiles.length;i++){
+            var point = batchTiles[i].point;
+            batchTiles[i].tile.src = this.getTileUrl({x: point.x, y: point.y, z: batchTiles[i].z});
+        }
+    }
+});
+
+L.tileLayer.batch = function (url, options) {
+    return new L.TileLayer.Batch(url, options);
+};
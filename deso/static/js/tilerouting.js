@@ -0,0 +1,63 @@
+/* Consistent tile host routing */
+/*
+Layers served from several tile hosts (settings.TILE_HOSTS) are returned with a '{s}' url template and 'tileRouting' options:
+    {key: <layer url path>, hosts: [<host base url>, ...], replicas: <points per host>, bandColumns: <tile columns per band>}
+
+Each (key, zoom, column band) is mapped to a host with the same consistent hash ring as deso.tilerouting.TileHostRing,
+so every tile (and metatile) of a layer is always requested from the same host, and cached only there.
+*/
+function fnv1a32(text){
+    // 32 bit FNV-1a of an ascii string
+    var value = 0x811c9dc5;
+    for (var i=0;i<text.length;i++){
+        value ^= text.charCodeAt(i);
+        value = Math.imul(value, 0x01000193) >>> 0;
+    }
+    return value >>> 0;
+}
+
+L.TileHostRing = L.Class.extend({
+    initialize: function (options) {
+        this.key = options.key;
+        this.hosts = options.hosts;
+        this.bandColumns = options.bandColumns;
+        var points = [];
+        for (var index=0;index<this.hosts.length;index++){
+            for (var replica=0;replica<options.replicas;replica++){
+                points.push([fnv1a32(this.hosts[index] + "#" + replica), index]);
+            }
+        }
+        points.sort(function (a, b) { return (a[0] - b[0]) || (a[1] - b[1]); });
+        this._points = points;
+    },
+
+    getHost: function (zoom, tilex) {
+        var value = fnv1a32(this.key + ":" + zoom + ":" + Math.floor(tilex / this.bandColumns));
+        // first point >= value (binary search), wrapping to the first point
+        var low = 0, high = this._points.length;
+        while (low < high){
+            var middle = (low + high) >>> 1;
+            if (this._points[middle][0] < value){
+                low = middle + 1;
+            }
+            else{
+                high = middle;
+            }
+        }
+        return this.hosts[this._points[low % this._points.length][1]];
+    }
+});
+
+// tile layers given a 'tileRouting' option select the '{s}' host per tile from the ring
+var defaultGetSubdomain = L.TileLayer.prototype._getSubdomain;
+L.TileLayer.include({
+    _getSubdomain: function (tilePoint) {
+        if (!this.options.tileRouting){
+            return defaultGetSubdomain.call(this, tilePoint);
+        }
+        if (!this._tileHostRing){
+            this._tileHostRing = new L.TileHostRing(this.options.tileRouting);
+        }
+        return this._tileHostRing.getHost(tilePoint.z, tilePoint.x);
+    }
+});
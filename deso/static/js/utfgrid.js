@@ -0,0 +1,123 @@
+/* UTFGrid interaction tiles */
+/*
+L.UtfGridLayer loads the UTFGrid tiles (layer 'gridUrl', see deso/layers/raster/utfgrid.py) of the tiles under the mouse,
+and fires 'mouseover' (with the values of the pixel under the mouse) and 'mouseout' events, without a request per mouse move.
+Each grid is requested once per tile (grids are kept for the current zoom level).
+
+With the 'tileRouting' option (see tilerouting.js), grids are requested from the host serving (and caching) the tile.
+*/
+L.UtfGridLayer = L.Class.extend({
+    includes: L.Mixin.Events,
+
+    options: {
+        minZoom: 0,
+        maxZoom: 30,
+        resolution: 4,  // tile pixels per grid cell
+        tileSize: 256,
+        tileRouting: null
+    },
+
+    initialize: function (url, options) {
+        L.setOptions(this, options);
+        this._url = url;
+        this._grids = {};
+        this._currentKey = null;
+    },
+
+    addTo: function (map) {
+        map.addLayer(this);
+        return this;
+    },
+
+    onAdd: function (map) {
+        this._map = map;
+        map.on('mousemove', this._onMouseMove, this);
+        map.on('mouseout zoomstart', this._mouseOut, this);
+        map.on('zoomend', this._onZoomEnd, this);
+    },
+
+    onRemove: function (map) {
+        map.off('mousemove', this._onMouseMove, this);
+        map.off('mouseout zoomstart', this._mouseOut, this);
+        map.off('zoomend', this._onZoomEnd, this);
+        this._grids = {};
+        this._mouseOut();
+    },
+
+    _onZoomEnd: function () {
+        this._grids = {};
+    },
+
+    _onMouseMove: function (e) {
+        var zoom = this._map.getZoom();
+        if (zoom < this.options.minZoom || zoom > this.options.maxZoom){
+            this._mouseOut();
+            return;
+        }
+        var tileSize = this.options.tileSize;
+        var point = this._map.project(e.latlng, zoom);
+        var tilex = Math.floor(point.x / tileSize);
+        var y = Math.floor(point.y / tileSize);
+        var tileCount = Math.pow(2, zoom);
+        if (tilex < 0 || y < 0 || tilex >= tileCount || y >= tileCount){
+            this._mouseOut();
+            return;
+        }
+        var tiley = tileCount - 1 - y;  // TMS tile y
+        var tileKey = zoom + "/" + tilex + "/" + tiley;
+        if (!this._grids.hasOwnProperty(tileKey)){
+            this._loadGrid(zoom, tilex, tiley, tileKey);
+        }
+        var grid = this._grids[tileKey];
+        if (grid === null){
+            // loading (or failed)
+            this._mouseOut();
+            return;
+        }
+        var row = grid.grid[Math.floor((point.y - y * tileSize) / this.options.resolution)];
+        var code = row ? row.charCodeAt(Math.floor((point.x - tilex * tileSize) / this.options.resolution)) : NaN;
+        // decode the UTFGrid character (skipping '"' and '\')
+        if (code >= 93){
+            code--;
+        }
+        if (code >= 35){
+            code--;
+        }
+        var key = grid.keys[code - 32];
+        if (!key){
+            this._mouseOut();
+            return;
+        }
+        if (key !== this._currentKey){
+            this._currentKey = key;
+            this.fire('mouseover', {latlng: e.latlng, key: key, data: grid.data[key]});
+        }
+    },
+
+    _mouseOut: function () {
+        if (this._currentKey !== null){
+            this._currentKey = null;
+            this.fire('mouseout');
+        }
+    },
+
+    _loadGrid: function (zoom, tilex, tiley, tileKey) {
+        var grids = this._grids;  // replaced on zoom, late responses are discarded
+        grids[tileKey] = null;
+        var host = "";
+        if (this.options.tileRouting){
+            if (!this._tileHostRing){
+                this._tileHostRing = new L.TileHostRing(this.options.tileRouting);
+            }
+            host = this._tileHostRing.getHost(zoom, tilex);
+        }
+        var xhrequest = new XMLHttpRequest();
+        xhrequest.onreadystatechange = function(){
+            if (xhrequest.readyState == 4 && xhrequest.status == 200){
+                grids[tileKey] = JSON.parse(xhrequest.responseText);
+            }
+        };
+        xhrequest.open('GET', L.Util.template(this._url, {s: host, z: zoom, x: tilex, y: tiley}), true);
+        xhrequest.send(null);
+    }
+});